@@ -1,6 +1,17 @@
 import argparse
+from contextlib import closing
+from datetime import datetime, timezone
 
+from curate1.resources.agent.filter_spec import Relevance
 from curate1.resources.database.database import Database
+from curate1.resources.hn_resource import HNAPIClient
+from curate1.resources.hn_snapshot.capture import (capture_snapshot,
+                                                   capture_snapshot_for_time)
+from curate1.resources.relevance_classifier.relevance_classifier import (
+    RelevanceClassifier, evaluate, fit_and_evaluate, format_report,
+    load_examples, spec_texts, split_examples)
+from curate1.resources.semantic_prefilter.semantic_prefilter import (
+    SemanticPrefilter, format_recall_report)
 
 
 def main():
@@ -14,10 +25,43 @@ def main():
   # Command 'db apply'
   db_push_parser = db_subparsers.add_parser('apply', help="Push data to the database")
   db_push_parser.add_argument('--db-path', type=str, required=True, help="Path to the database")
+
+  # Command 'snapshot'
+  snapshot_parser = subparsers.add_parser('snapshot', help="HN item snapshot operations")
+  snapshot_subparsers = snapshot_parser.add_subparsers(dest="snapshot_command", help="Snapshot commands")
+
+  # Command 'snapshot capture'
+  capture_parser = snapshot_subparsers.add_parser('capture', help="Capture a range of HN items into a snapshot file")
+  capture_parser.add_argument('--out', type=str, required=True, help="Path of the snapshot file to write")
+  capture_parser.add_argument('--start-time', type=parse_time, help="Start of the time range (ISO 8601, UTC if no offset)")
+  capture_parser.add_argument('--end-time', type=parse_time, help="End of the time range (ISO 8601, UTC if no offset)")
+  capture_parser.add_argument('--start-id', type=int, help="First item id to capture")
+  capture_parser.add_argument('--end-id', type=int, help="Last item id to capture")
+  capture_parser.add_argument('--stories-only', action='store_true', help="Keep full records for stories only")
+  capture_parser.add_argument('--concurrency', type=int, default=32, help="Number of concurrent requests")
+
+  # Command 'classifier'
+  classifier_parser = subparsers.add_parser('classifier', help="Local relevance classifiers distilled from LLM labels")
+  classifier_subparsers = classifier_parser.add_subparsers(dest="classifier_command", help="Classifier commands")
+
+  # Command 'classifier train'
+  train_parser = classifier_subparsers.add_parser('train', help="Train a classifier per spec and relevance tier from stored LLM labels")
+  add_classifier_arguments(train_parser)
+  train_parser.add_argument('--target-precision', type=float, default=0.95, help="Precision required of documents decided relevant without the LLM")
+  train_parser.add_argument('--target-recall', type=float, default=0.98, help="Share of relevant documents that must not be decided not relevant without the LLM")
+  train_parser.add_argument('--min-examples', type=int, default=100, help="Skip specs with fewer labelled documents than this")
+
+  # Command 'classifier eval'
+  eval_parser = classifier_subparsers.add_parser('eval', help="Evaluate trained classifiers against the held out labels stored now, and the semantic prefilter against the audited ones")
+  add_classifier_arguments(eval_parser)
   args = parser.parse_args()
 
   if args.command == 'db':
     handle_db_command(parser, args, args.db_command)
+  elif args.command == 'snapshot':
+    handle_snapshot_command(parser, args, args.snapshot_command)
+  elif args.command == 'classifier':
+    handle_classifier_command(parser, args, args.classifier_command)
   else:
     parser.print_help()
 
@@ -29,5 +73,64 @@ def handle_db_command(parser: argparse.ArgumentParser, args: argparse.Namespace,
   else:
     parser.print_help()
 
+def parse_time(value: str) -> datetime:
+  parsed = datetime.fromisoformat(value)
+  if parsed.tzinfo is None:
+    parsed = parsed.replace(tzinfo=timezone.utc)
+  return parsed
+
+def handle_snapshot_command(parser: argparse.ArgumentParser, args: argparse.Namespace, snapshot_command: str):
+  if snapshot_command == 'capture':
+    with closing(HNAPIClient(max_concurrency=args.concurrency)) as hn_client:
+      if args.start_time is not None and args.end_time is not None:
+        count = capture_snapshot_for_time(
+          hn_client, args.out, int(args.start_time.timestamp()), int(args.end_time.timestamp()), args.stories_only)
+      elif args.start_id is not None and args.end_id is not None:
+        count = capture_snapshot(hn_client, args.out, args.start_id, args.end_id, args.stories_only)
+      else:
+        parser.error("snapshot capture needs either --start-time and --end-time, or --start-id and --end-id")
+    print(f"Wrote {count} items to {args.out}")
+  else:
+    parser.print_help()
+
+def add_classifier_arguments(parser: argparse.ArgumentParser):
+  parser.add_argument('--db-path', type=str, required=True, help="Path to the database")
+  parser.add_argument('--model-dir', type=str, required=True, help="Directory the classifiers are kept in")
+  parser.add_argument('--spec', action='append', help="Spec to use, repeatable (default: every spec)")
+  parser.add_argument('--relevance', action='append', choices=[r.value for r in Relevance], help="Relevance tier to use, repeatable (default: every tier)")
+
+def handle_classifier_command(parser: argparse.ArgumentParser, args: argparse.Namespace, classifier_command: str):
+  if classifier_command not in ('train', 'eval'):
+    parser.print_help()
+    return
+
+  db = Database(args.db_path)
+  prefilter = SemanticPrefilter(db_path=args.db_path)
+  spec_names = args.spec or sorted(spec_texts())
+  relevances = [Relevance(r) for r in args.relevance] if args.relevance else list(Relevance)
+  for spec_name in spec_names:
+    for relevance in relevances:
+      name = f"{spec_name} ({relevance.value})"
+      examples = load_examples(db, spec_name, relevance)
+      if classifier_command == 'train':
+        if len(examples) < args.min_examples:
+          print(f"{name}: only {len(examples)} examples, skipping")
+          continue
+        classifier = fit_and_evaluate(examples, spec_name, relevance, args.target_precision, args.target_recall)
+        classifier.save(args.model_dir)
+        print(f"{name}: auto relevant at >= {classifier.positive_threshold:.3f}, auto not relevant at <= {classifier.negative_threshold:.3f}")
+        if classifier.report is not None:
+          print(format_report(f"{name} held out", classifier.report))
+      else:
+        report = prefilter.historical_recall(spec_name, f"filter_spec_{spec_name}_{relevance.value}")
+        print(format_recall_report(f"{name} prefilter", report, prefilter.target_recall))
+        classifier = RelevanceClassifier.load(args.model_dir, spec_name, relevance)
+        if classifier is None:
+          print(f"{name}: no classifier")
+          continue
+        # only the held out examples, since the classifier was fitted to the rest
+        _, held_out = split_examples(examples)
+        print(format_report(f"{name} held out", evaluate(classifier, held_out)))
+
 if __name__ == "__main__":
   main()
@@ -1,13 +1,15 @@
 from dagster import Definitions, load_assets_from_modules
 
 from .assets import items
-from .jobs import curate1_job, curate1_processing_job
+from .jobs import curate1_job, curate1_processing_job, curate1_stories_job
 from .resources import RESOURCES_LOCAL
+from .sensors import hn_tail_sensor, stories_done_sensor
 
 all_assets = load_assets_from_modules([items])
 
 defs = Definitions(
     assets=all_assets,
     resources=RESOURCES_LOCAL,
-    jobs=[curate1_job, curate1_processing_job],
+    jobs=[curate1_stories_job, curate1_job, curate1_processing_job],
+    sensors=[hn_tail_sensor, stories_done_sensor],
 )
@@ -1,5 +1,5 @@
 from datetime import datetime, timezone
-from typing import Any, Mapping, Tuple
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple
 
 from dagster import (
     AssetExecutionContext,
@@ -8,82 +8,100 @@ from dagster import (
 
 from curate1.resources.hn_resource import HNClient
 
-def binary_search_nearest_left(get_value, start, end, min_target):
-    mid = (start + end) // 2
-
-    while start <= end:
-        mid = (start + end) // 2
-        mid_timestamp = get_value(mid)
-
-        if mid_timestamp == min_target:
-            return mid
-        elif mid_timestamp < min_target:
-            start = mid + 1
-        elif mid_timestamp > min_target:
-            end = mid - 1
-
-    if mid == end:
-        return end + 1
-
-    return start
-
-
-def binary_search_nearest_right(get_value, start, end, max_target):
-    mid = (start + end) // 2
-
-    while start <= end:
-        mid = (start + end) // 2
-        mid_timestamp = get_value(mid)
-
-        if not mid_timestamp:
-            end = end - 1
-
-        if mid_timestamp == max_target:
-            return mid
-        elif mid_timestamp < max_target:
-            start = mid + 1
-        elif mid_timestamp > max_target:
-            end = mid - 1
-
-    if end == -1:
-        return None
-
-    if start > end:
-        return end
-
-    return end
+# (item id, item time), where time is None for the virtual points just outside the id range
+SearchPoint = Tuple[int, Optional[int]]
+
+
+def interpolation_search_first_at_or_after(
+    get_value: Callable[[int], int], low: SearchPoint, high: SearchPoint, target: int
+) -> Tuple[SearchPoint, SearchPoint]:
+    """Narrows `low`/`high` until they are adjacent ids, keeping value(low) < target <= value(high).
+
+    Probes are interpolated between the two bounds' timestamps, since item ids grow roughly
+    linearly with time. When a probe doesn't at least halve the range, the next one bisects
+    instead, so the search is never worse than a binary search.
+    """
+    bisect_next = False
+    while high[0] - low[0] > 1:
+        low_id, low_value = low
+        high_id, high_value = high
+        if bisect_next or low_value is None or high_value is None:
+            probe = (low_id + high_id) // 2
+        else:
+            fraction = (target - low_value) / (high_value - low_value)
+            probe = low_id + round(fraction * (high_id - low_id))
+        probe = min(max(probe, low_id + 1), high_id - 1)
+
+        probe_value = get_value(probe)
+        if probe_value < target:
+            low = (probe, probe_value)
+        else:
+            high = (probe, probe_value)
+        bisect_next = high[0] - low[0] > (high_id - low_id) // 2
+    return low, high
 
 
 def _id_range_for_time(start: int, end: int, hn_client: HNClient):
     check.invariant(end >= start, "End time comes before start time")
 
-    def _get_item_timestamp(item_id):
-        item = hn_client.fetch_item_by_id(item_id)
-        if not item:
-            raise ValueError(f"No item with id {item_id}")
-        return item["time"]
-
-    max_item_id = hn_client.fetch_max_item_id()
+    # every item time we've seen, including the checkpoints we were seeded with
+    known_times: Dict[int, int] = {}
+    fetched_ids = []
 
-    # declared by resource to allow testability against snapshot
-    min_item_id = hn_client.min_item_id()
-
-    start_id = binary_search_nearest_left(_get_item_timestamp, min_item_id, max_item_id, start)
-    end_id = check.not_none(
-        binary_search_nearest_right(_get_item_timestamp, min_item_id, max_item_id, end)
-    )
+    def _get_item_timestamp(item_id):
+        if item_id not in known_times:
+            item = hn_client.fetch_item_by_id(item_id)
+            if not item:
+                raise ValueError(f"No item with id {item_id}")
+            known_times[item_id] = item["time"]
+            fetched_ids.append(item_id)
+        return known_times[item_id]
+
+    max_item_id: Optional[int] = None
+
+    def _first_id_at_or_after(target: int) -> int:
+        nonlocal max_item_id
+        for checkpoint in hn_client.time_bracket(target):
+            if checkpoint is not None:
+                known_times.setdefault(*checkpoint)
+
+        # tightest bounds we know of, from the index and from earlier searches
+        lows = [(i, t) for i, t in known_times.items() if t < target]
+        highs = [(i, t) for i, t in known_times.items() if t >= target]
+        low = max(lows) if lows else None
+        high = min(highs) if highs else None
+        if low is not None and high is not None and low[0] >= high[0]:
+            # timestamps aren't strictly monotonic in ids, so the known points can disagree
+            low, high = None, None
+
+        if low is None:
+            # declared by resource to allow testability against snapshot
+            low = (hn_client.min_item_id() - 1, None)
+        if high is None:
+            if max_item_id is None:
+                max_item_id = hn_client.fetch_max_item_id()
+            high = (max_item_id + 1, None)
+
+        low, high = interpolation_search_first_at_or_after(_get_item_timestamp, low, high, target)
+        hn_client.record_time_checkpoints(p for p in (low, high) if p[1] is not None)
+        return high[0]
+
+    start_id = _first_id_at_or_after(start)
+    end_id = _first_id_at_or_after(end + 1) - 1
 
     start_timestamp = str(datetime.fromtimestamp(_get_item_timestamp(start_id), tz=timezone.utc))
     end_timestamp = str(datetime.fromtimestamp(_get_item_timestamp(end_id), tz=timezone.utc))
 
     metadata = {
-        "max_item_id": max_item_id,
         "start_id": start_id,
         "end_id": end_id,
         "items": end_id - start_id,
         "start_timestamp": start_timestamp,
         "end_timestamp": end_timestamp,
+        "search_fetches": len(fetched_ids),
     }
+    if max_item_id is not None:
+        metadata["max_item_id"] = max_item_id
 
     id_range = (start_id, end_id)
     return id_range, metadata
@@ -92,6 +110,8 @@ def _id_range_for_time(start: int, end: int, hn_client: HNClient):
 def id_range_for_time(
     context: AssetExecutionContext, hn_client: HNClient
 ) -> Tuple[Tuple[int, int], Mapping[str, Any]]:
-    """For the configured time partition, searches for the range of ids that were created in that time."""
+    """For the configured time partition, searches for the range of ids that were created in that time.
+    Both ends of the range are inclusive, and the partition's end isn't, so consecutive
+    partitions' ranges meet without overlapping."""
     start, end = context.partition_time_window
-    return _id_range_for_time(int(start.timestamp()), int(end.timestamp()), hn_client)
\ No newline at end of file
+    return _id_range_for_time(int(start.timestamp()), int(end.timestamp()) - 1, hn_client)
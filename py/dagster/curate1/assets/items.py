@@ -1,19 +1,29 @@
 import json
-from typing import Any, Dict, List, Optional, Tuple
+from collections import Counter
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
 
+import numpy as np
 import pandas as pd
 from curate1.partitions import hourly_partitions
 from curate1.resources.agent.agent_resource import AgentClient
 from curate1.resources.agent.filter_spec import Relevance
 from curate1.resources.agent.model import AnnotatedDoc
+from curate1.resources.agent.telemetry import rollup
+from curate1.resources.article_cache.article_cache import canonicalize_url
 from curate1.resources.article_resource import ArticleClient
+from curate1.resources.cascade_router.cascade_router import (
+    ACCEPT, AUDIT, ESCALATE, REJECT, CascadeRouter, escalation_cost)
 from curate1.resources.database.database import Document, DocumentAttribute
 from curate1.resources.database.database_resource import DatabaseResource
-from curate1.resources.hn_resource import HNClient
-from dagster import AssetExecutionContext, Output, asset
+from curate1.resources.hn_resource import HNClient, HNItemRecord
+from curate1.resources.semantic_prefilter.semantic_prefilter import (
+    SemanticPrefilter, document_text)
+from dagster import (AssetExecutionContext, AssetOut, BackfillPolicy, Output,
+                     asset, multi_asset)
 from pandas import DataFrame, Series
 
 from .id_range_for_time import id_range_for_time
+from .keyword_matcher import KEYWORD_TEXT_COLUMNS, KeywordMatcher
 
 schema = {
     "id": (pd.Int64Dtype(), 0),
@@ -30,42 +40,98 @@ schema = {
     "url": (pd.StringDtype(), "")
 }
 
-@asset(partitions_def=hourly_partitions)
+# number of items fetched and converted at a time, which bounds the memory used for raw items
+STORIES_BATCH_SIZE = 1000
+
+def is_live_story_with_url(item: Optional[HNItemRecord]) -> bool:
+    return (item is not None and item.get("type") == "story" and item.get("url", "") != ""
+            and not item.get("dead", False) and not item.get("deleted", False))
+
+def story_frame(items: List[Optional[HNItemRecord]]) -> DataFrame:
+    """Builds a frame of the live stories with urls in `items`, with each column typed per `schema`."""
+    stories = [item for item in items if is_live_story_with_url(item)]
+    columns = {}
+    for column, (dtype, default) in schema.items():
+        values = [item.get(column) for item in stories]
+        if column == "kids":
+            # kids is a list of ids, which is kept as its string form
+            values = [str(v) if v is not None else None for v in values]
+        columns[column] = pd.array([default if v is None else v for v in values], dtype=dtype)
+    return DataFrame(columns)
+
+@asset(partitions_def=hourly_partitions, backfill_policy=BackfillPolicy.single_run())
 def stories(
     context: AssetExecutionContext, 
     hn_client: HNClient
-) -> Output[DataFrame]:
-    """Items from the Hacker News API: each is a story or a comment on a story."""
+) -> Output[Dict[str, DataFrame]]:
+    """Items from the Hacker News API: each is a story or a comment on a story.
+
+    Backfills run as a single run over the whole range of partitions: the id range is resolved once
+    for the whole window and fetched in one sweep, then split by time into the hourly partitions.
+    The output is keyed by partition key, and the IO manager stores each partition separately.
+
+    Item times aren't strictly ordered by id, so a few items in the id range are timed outside
+    the window. Those are counted, and kept in the first or last partition, whichever is
+    nearer, however many partitions the run covers.
+    """
     (start_id, end_id), item_range_metadata = id_range_for_time(context, hn_client)
 
-    context.log.info(f"Downloading range {start_id} up to {end_id}: {end_id - start_id} items.")
-
-    rows: List[Dict[str, Any]] = []
-    for item_id in range(start_id, end_id):
-        item = hn_client.fetch_item_by_id(item_id)
-        if item is not None:  # Check if item is not None
-            if (item_id-start_id) % 100 == 0:
-                context.log.info(f"Downloaded {item_id-start_id} items!")
-            if ("type" in item and item["type"] == "story" and 
-                "url" in item and item["url"] != ""):
-                rows.append(item)
-
-    df = DataFrame(rows)
-    for column, dtype in schema.items():
-        if column not in df:
-            df[column] = dtype[1]
-        df[column] = df[column].fillna(dtype[1])
-        df[column] = df[column].astype(dtype[0])
-    
+    context.log.info(f"Downloading range {start_id} up to {end_id}: {end_id - start_id + 1} items.")
+
+    frames: List[DataFrame] = [story_frame([])]
+    for batch_start in range(start_id, end_id + 1, STORIES_BATCH_SIZE):
+        batch_ids = range(batch_start, min(batch_start + STORIES_BATCH_SIZE, end_id + 1))
+        frames.append(story_frame(hn_client.fetch_items_by_ids(batch_ids)))
+        context.log.info(f"Downloaded {batch_ids[-1] - start_id + 1} items!")
+
+    df = pd.concat(frames, ignore_index=True)
+
+    partitions, out_of_window = split_by_partition(df, context.partition_keys)
+    if out_of_window:
+        context.log.info(f"{out_of_window} items are timed outside the window, and kept in the nearest partition.")
+
     return Output(
-        df,
+        partitions,
         metadata={
-            "Rows": len(rows),
-            "Excluded items": end_id-start_id-len(rows),
+            "Rows": len(df),
+            "Excluded items": end_id-start_id+1-len(df),
+            "Out-of-window rows": out_of_window,
+            "Batches": len(frames) - 1,
+            "Partitions": len(partitions),
             **item_range_metadata,
         },
     )
 
+def split_by_partition(df: DataFrame, partition_keys: List[str]) -> Tuple[Dict[str, DataFrame], int]:
+    """Splits `df` into the consecutive hourly `partition_keys` by item time, returning the
+    parts and how many rows were timed outside all of them, which go to the nearest one."""
+    windows = [hourly_partitions.time_window_for_partition_key(key) for key in partition_keys]
+    starts = [int(window.start.timestamp()) for window in windows]
+    end = int(windows[-1].end.timestamp())
+    times = df["time"].to_numpy(dtype="int64")
+    positions = (np.searchsorted(starts, times, side="right") - 1).clip(0, len(partition_keys) - 1)
+    out_of_window = int(((times < starts[0]) | (times >= end)).sum())
+    partitions = {
+        partition_key: df[positions == i].reset_index(drop=True)
+        for i, partition_key in enumerate(partition_keys)
+    }
+    return partitions, out_of_window
+
+T = TypeVar("T")
+
+def map_unique_urls(df: DataFrame, fn: Callable[[DataFrame], List[T]]) -> List[T]:
+    """Applies `fn` to one row per canonical URL in `df`, then fans its results back out to
+    every row with that URL, so reposts of the same article are only fetched and annotated once.
+
+    Reposts in later partitions are picked up by the article and LLM response caches, which are
+    keyed by canonical URL and by prompt respectively.
+    """
+    keys = df["url"].map(canonicalize_url)
+    first = ~keys.duplicated()
+    results = fn(df[first])
+    result_by_key = dict(zip(keys[first], results))
+    return [result_by_key[key] for key in keys]
+
 #TODO: change to document_content
 @asset(partitions_def=hourly_partitions)
 def hackernews_documents( 
@@ -80,7 +146,12 @@ def hackernews_documents(
     story_urls: List[str] = stories_with_url["url"].tolist()
 
     context.log.info(f"Downloading {len(story_urls)} stories...")
-    story_contents: List[str|None] = article_client.fetch_article_content_batch(story_urls)
+    batch_metadata = {}
+    def fetch_batch(unique_stories: DataFrame) -> List[str|None]:
+        batch = article_client.fetch_article_batch(unique_stories["url"].tolist())
+        batch_metadata.update(batch.metadata)
+        return batch.contents
+    story_contents: List[str|None] = map_unique_urls(stories_with_url, fetch_batch)
 
     stories_with_content: DataFrame = stories_with_url.assign(contents=story_contents)
     stories_with_content["contents"] = stories_with_content["contents"].fillna("")
@@ -93,7 +164,44 @@ def hackernews_documents(
             "Stories without URLs": len(none_url),
             "Stories with content": len(with_content),
             "Stories without content": len(none_content),
+            "Unique URLs": stories_with_url["url"].map(canonicalize_url).nunique(),
             "Story URLs (first 10)": story_urls[:10],
+            **batch_metadata,
+        }
+    )
+
+SPEC_FILTER_MAP = {
+    "iac": ["terraform", "iac", "pulumi", "infrastructure", "cloudformation", "infrastructure as code", "tf"],
+    "coding-with-ai": ["llms", "llm", "ai", "coding", "code", "devin", "codegen", "code generation", "developer productivity", "coding assistant", "copilot", "cursor"],
+}
+
+keyword_matcher = KeywordMatcher(SPEC_FILTER_MAP)
+
+@asset(partitions_def=hourly_partitions)
+def keyword_matches(
+    context: AssetExecutionContext, 
+    hackernews_documents: DataFrame, 
+) -> Output[DataFrame]:
+    """Matches the keywords of every spec against each document's text in a single pass, giving
+    a boolean column per spec and the keywords that matched."""
+    texts = hackernews_documents.reindex(columns=KEYWORD_TEXT_COLUMNS).fillna("").astype(str)
+    documents = texts.agg("\n".join, axis=1) if len(texts) else Series([], dtype=str)
+    matched_keywords = [keyword_matcher.match(text) for text in documents]
+
+    matched_specs = [keyword_matcher.specs_for(keywords) for keywords in matched_keywords]
+
+    matches = DataFrame(index=hackernews_documents.index)
+    for spec in keyword_matcher.specs:
+        matches[spec] = [spec in specs for specs in matched_specs]
+    matches["matched_keywords"] = [",".join(sorted(keywords)) for keywords in matched_keywords]
+
+    keyword_counts = Counter(keyword for keywords in matched_keywords for keyword in keywords)
+    return Output(
+        matches,
+        metadata={
+            "Input size": len(hackernews_documents),
+            **{f"Matches ({spec})": int(matches[spec].sum()) for spec in keyword_matcher.specs},
+            "Keyword counts": dict(keyword_counts.most_common()),
         }
     )
 
@@ -101,103 +209,194 @@ def hackernews_documents(
 def candidate_docs_iac(
     context: AssetExecutionContext, 
     hackernews_documents: DataFrame, 
+    keyword_matches: DataFrame, 
 ) -> Output[Optional[DataFrame]]:
     return keyword_filter_router(
-        context, hackernews_documents, "iac")
+        context, hackernews_documents, keyword_matches, "iac")
 
 @asset(partitions_def=hourly_partitions)
 def candidate_docs_coding_with_ai(
     context: AssetExecutionContext, 
     hackernews_documents: DataFrame, 
+    keyword_matches: DataFrame, 
 ) -> Output[Optional[DataFrame]]:
     return keyword_filter_router(
-        context, hackernews_documents, "coding-with-ai")
-
-SPEC_FILTER_MAP = {
-    "iac": ["terraform", "iac", "pulumi", "infrastructure", "cloudformation", "infrastructure as code", "tf"],
-    "coding-with-ai": ["llms", "llm", "ai", "coding", "code", "devin", "codegen", "code generation", "developer productivity", "coding assistant", "copilot", "cursor"],
-}
+        context, hackernews_documents, keyword_matches, "coding-with-ai")
 
 def keyword_filter_router(
     context: AssetExecutionContext, 
     hackernews_documents: DataFrame, 
+    keyword_matches: DataFrame, 
     spec_name: str
 ) -> Output[Optional[DataFrame]]:
     if spec_name not in SPEC_FILTER_MAP:
         raise ValueError(f"Spec name '{spec_name}' is not defined in SPEC_FILTER_MAP.")
     keywords = SPEC_FILTER_MAP[spec_name]
-    keyword_pattern = r'\b(?:' + '|'.join(keywords) + r')\b'
-    
-    def matches_any_keyword(row: Series) -> bool:
-        return row.astype(str).str.contains(keyword_pattern, case=False, regex=True).any()
-    
-    filtered_df = hackernews_documents[hackernews_documents.apply(matches_any_keyword, axis=1)]
+    mask = keyword_matches[spec_name].reindex(hackernews_documents.index, fill_value=False)
+    filtered_df = hackernews_documents[mask.astype(bool)]
+
+    spec_keywords = set(keywords)
+    matched_counts = Counter(
+        keyword
+        for matched in keyword_matches.loc[filtered_df.index, "matched_keywords"]
+        for keyword in matched.split(",") if keyword in spec_keywords
+    )
     return Output(
         filtered_df, 
         metadata={
             "Spec": spec_name,
             "Keywords": keywords,
+            "Matched keywords": dict(matched_counts.most_common()),
             "Input size": len(hackernews_documents),
             "Output size": len(filtered_df),
         }
     )
 
-# TODO: use dynamic partitions for these
 @asset(partitions_def=hourly_partitions)
-def label_maybe_relevant_iac(
+def prefiltered_docs_iac(
     context: AssetExecutionContext, 
     candidate_docs_iac: DataFrame, 
-    agent_client: AgentClient
-) -> Output[Optional[DataFrame]]:
-    return relevance_filter_spec(
-        context, candidate_docs_iac, "iac", Relevance.MAYBE_RELEVANT, agent_client)
-    
+    prefilter: SemanticPrefilter
+) -> Output[DataFrame]:
+    return semantic_prefilter(context, candidate_docs_iac, "iac", prefilter)
+
 @asset(partitions_def=hourly_partitions)
-def label_maybe_relevant_coding_with_ai(
+def prefiltered_docs_coding_with_ai(
     context: AssetExecutionContext, 
     candidate_docs_coding_with_ai: DataFrame, 
-    agent_client: AgentClient
-) -> Output[Optional[DataFrame]]:
-    return relevance_filter_spec(
-        context, candidate_docs_coding_with_ai, "coding-with-ai", Relevance.MAYBE_RELEVANT, agent_client)
+    prefilter: SemanticPrefilter
+) -> Output[DataFrame]:
+    return semantic_prefilter(context, candidate_docs_coding_with_ai, "coding-with-ai", prefilter)
+
+def semantic_prefilter(
+    context: AssetExecutionContext, 
+    candidate_docs: DataFrame, 
+    spec_name: str,
+    prefilter: SemanticPrefilter
+) -> Output[DataFrame]:
+    """Drops keyword candidates that score below the spec's threshold, apart from a sample kept
+    for auditing. The admin `classifier eval` command reports the threshold's recall on the
+    audited documents."""
+    documents = [
+        document_text(title, contents)
+        for title, contents in zip(candidate_docs["title"].fillna(""), candidate_docs["contents"].fillna(""))
+    ]
+    scores = prefilter.score(spec_name, documents)
+    threshold = prefilter.threshold(spec_name)
+    audited = Series([prefilter.is_audited(document) for document in documents], index=candidate_docs.index, dtype=bool)
+    filtered_df = candidate_docs.assign(prefilter_score=scores)
+    above_threshold = filtered_df["prefilter_score"] >= threshold
+    filtered_df = filtered_df[above_threshold | audited]
+
+    metadata: Dict[str, Any] = {
+        "Spec": spec_name,
+        "Threshold": threshold,
+        "Input size": len(candidate_docs),
+        "Output size": len(filtered_df),
+        "Audited below threshold": int((audited & ~above_threshold).sum()),
+    }
+    context.log.info(f"Metadata: {metadata}")
+    return Output(filtered_df, metadata=metadata)
+
+LABELLED_SPECS = ["iac", "coding-with-ai"]
+
+def spec_asset_name(prefix: str, spec_name: str) -> str:
+    return f"{prefix}_{spec_name.replace('-', '_')}"
 
 # TODO: use dynamic partitions for these
-@asset(partitions_def=hourly_partitions)
-def label_highly_relevant_iac(
+@multi_asset(
+    outs={spec_asset_name("label_maybe_relevant", spec): AssetOut(is_required=False) for spec in LABELLED_SPECS},
+    partitions_def=hourly_partitions,
+    can_subset=True,
+)
+def label_maybe_relevant(
     context: AssetExecutionContext, 
-    maybe_relevant_iac: DataFrame, 
-    agent_client: AgentClient
-) -> Output[Optional[DataFrame]]:
-    return relevance_filter_spec(
-        context, maybe_relevant_iac, "iac", Relevance.HIGHLY_RELEVANT, agent_client)
+    prefiltered_docs_iac: DataFrame, 
+    prefiltered_docs_coding_with_ai: DataFrame, 
+    agent_client: AgentClient,
+    cascade_router: CascadeRouter
+):
+    yield from relevance_filter_specs(
+        context,
+        {"iac": prefiltered_docs_iac, "coding-with-ai": prefiltered_docs_coding_with_ai},
+        "label_maybe_relevant",
+        Relevance.MAYBE_RELEVANT,
+        agent_client,
+        confidence=cascade_router.request_confidence)
 
-@asset(partitions_def=hourly_partitions)
-def label_highly_relevant_coding_with_ai(
+# TODO: use dynamic partitions for these
+@multi_asset(
+    outs={spec_asset_name("label_highly_relevant", spec): AssetOut(is_required=False) for spec in LABELLED_SPECS},
+    partitions_def=hourly_partitions,
+    can_subset=True,
+)
+def label_highly_relevant(
     context: AssetExecutionContext, 
+    maybe_relevant_iac: DataFrame, 
     maybe_relevant_coding_with_ai: DataFrame, 
     agent_client: AgentClient
-) -> Output[Optional[DataFrame]]:
-    return relevance_filter_spec(
-        context, maybe_relevant_coding_with_ai, "coding-with-ai", Relevance.HIGHLY_RELEVANT, agent_client)
+):
+    yield from relevance_filter_specs(
+        context,
+        {"iac": maybe_relevant_iac, "coding-with-ai": maybe_relevant_coding_with_ai},
+        "label_highly_relevant",
+        Relevance.HIGHLY_RELEVANT,
+        agent_client)
 
 # TODO: use dynamic partitions for these
 @asset(partitions_def=hourly_partitions)
 def maybe_relevant_iac(
     context: AssetExecutionContext, 
     label_maybe_relevant_iac: DataFrame, 
-    agent_client: AgentClient
+    cascade_router: CascadeRouter
 ) -> Output[Optional[DataFrame]]:
-    return filter_relevance_labelled(
-        context, label_maybe_relevant_iac)
+    return route_cascade(
+        context, label_maybe_relevant_iac, "iac", cascade_router)
     
 @asset(partitions_def=hourly_partitions)
 def maybe_relevant_coding_with_ai(
     context: AssetExecutionContext, 
     label_maybe_relevant_coding_with_ai: DataFrame, 
-    agent_client: AgentClient
+    cascade_router: CascadeRouter
 ) -> Output[Optional[DataFrame]]:
-    return filter_relevance_labelled(
-        context, label_maybe_relevant_coding_with_ai)
+    return route_cascade(
+        context, label_maybe_relevant_coding_with_ai, "coding-with-ai", cascade_router)
+
+def route_cascade(
+    context: AssetExecutionContext,
+    relevance_labelled: DataFrame,
+    spec_name: str,
+    router: CascadeRouter,
+) -> Output[Optional[DataFrame]]:
+    """Passes on the documents the cheap model's verdict leaves uncertain, and a sample of the
+    rest audited to keep the calibration honest, to be escalated to the expensive model, and
+    those it's sure enough are relevant, marked as accepted so they are labelled highly relevant
+    without asking it. The rest are dropped."""
+    calibration = router.calibration(spec_name)
+    routes = router.route(
+        spec_name, relevance_labelled["value"].tolist(), relevance_labelled["contents"].fillna("").tolist(), calibration)
+    routed = relevance_labelled.assign(
+        route=[route for route, _ in routes],
+        calibrated_probability=[probability for _, probability in routes])
+    passed = routed[routed["route"] != REJECT]
+
+    counts = Counter(route for route, _ in routes)
+    # documents the cheap model found relevant would otherwise all have been escalated
+    spared = routed[routed["relevant"].astype(bool) & routed["route"].isin([ACCEPT, REJECT])]
+    metadata = {
+        "Input size": len(relevance_labelled),
+        "Output size": len(passed),
+        "Accepted": counts[ACCEPT],
+        "Escalated": counts[ESCALATE],
+        "Rejected": counts[REJECT],
+        "Audited": counts[AUDIT],
+        "Escalation rate": (counts[ESCALATE] + counts[AUDIT]) / len(routes) if routes else 0,
+        "Escalated despite not relevant": int((~routed["relevant"].astype(bool) & (routed["route"] == ESCALATE)).sum()),
+        "Estimated cost saved (USD)": escalation_cost(spec_name, spared["contents"].tolist()),
+        "Calibration samples": calibration.samples,
+    }
+    context.log.info(f"Metadata: {metadata}")
+    return Output(passed, metadata=metadata)
 
 # TODO: use dynamic partitions for these
 @asset(partitions_def=hourly_partitions)
@@ -229,26 +428,115 @@ def filter_relevance_labelled(
         },
     )
 
-# should return document_id, highly_relevant, reasoning, label, value
-def relevance_filter_spec(
+def annotate_relevance(
+    docs_by_spec: Dict[str, DataFrame],
+    relevance: Relevance,
+    agent_client: AgentClient,
+    confidence: bool = False
+) -> Tuple[Dict[Tuple[str, str], Optional[AnnotatedDoc]], Dict[str, int]]:
+    """Annotates every unique document against each spec it's a candidate for, keyed by
+    (spec name, canonical URL).
+
+    A document that is a candidate for several specs is judged against all of them in one
+    request. Documents with a single spec keep the single-spec prompt, so that their cached
+    responses stay valid.
+    """
+    contents_by_url: Dict[str, str] = {}
+    specs_by_url: Dict[str, List[str]] = {}
+    for spec_name, docs in docs_by_spec.items():
+        for url, contents in zip(docs["url"].map(canonicalize_url), docs["contents"]):
+            contents_by_url.setdefault(url, contents)
+            spec_names = specs_by_url.setdefault(url, [])
+            if spec_name not in spec_names:
+                spec_names.append(spec_name)
+
+    urls_by_specs: Dict[Tuple[str, ...], List[str]] = {}
+    for url, spec_names in specs_by_url.items():
+        urls_by_specs.setdefault(tuple(spec_names), []).append(url)
+
+    annotations: Dict[Tuple[str, str], Optional[AnnotatedDoc]] = {}
+    requests = {"Single-spec requests": 0, "Multi-spec requests": 0}
+    for spec_names, urls in urls_by_specs.items():
+        contents = [contents_by_url[url] for url in urls]
+        if len(spec_names) == 1:
+            requests["Single-spec requests"] += len(urls)
+            annotated_docs = agent_client.filter_spec_batch(spec_names[0], relevance, contents, confidence)
+            annotations.update(((spec_names[0], url), doc) for url, doc in zip(urls, annotated_docs))
+        else:
+            requests["Multi-spec requests"] += len(urls)
+            annotated_by_spec = agent_client.filter_multi_spec_batch(list(spec_names), relevance, contents, confidence)
+            for url, by_spec in zip(urls, annotated_by_spec):
+                annotations.update(((spec_name, url), doc) for spec_name, doc in by_spec.items())
+    requests["Requests saved"] = sum(
+        (len(spec_names) - 1) * len(urls) for spec_names, urls in urls_by_specs.items())
+    return annotations, requests
+
+def relevance_filter_specs(
     context: AssetExecutionContext, 
-    hackernews_documents: DataFrame, 
-    spec_name: str,
+    docs_by_spec: Dict[str, DataFrame],
+    asset_prefix: str,
     relevance: Relevance,
-    agent_client: AgentClient
-) -> Output[Optional[DataFrame]]:
-    contents: List[str] = hackernews_documents["contents"].tolist()
+    agent_client: AgentClient,
+    confidence: bool = False
+) -> Iterator[Output[DataFrame]]:
+    """Labels the documents of each selected spec, yielding one output per spec. With
+    `confidence`, the verdicts also say how sure the model is of them."""
+    docs_by_spec = {
+        spec_name: docs for spec_name, docs in docs_by_spec.items()
+        if spec_asset_name(asset_prefix, spec_name) in context.selected_output_names
+    }
+    # documents the cascade router accepted keep the cheap model's verdict
+    accepted = {
+        (spec_name, url): cascade_annotation(contents, value)
+        for spec_name, docs in docs_by_spec.items() if "route" in docs
+        for url, contents, value, route in zip(docs["url"].map(canonicalize_url), docs["contents"], docs["value"], docs["route"])
+        if route == ACCEPT
+    }
+    to_annotate = {
+        spec_name: docs[docs["route"] != ACCEPT] if "route" in docs else docs
+        for spec_name, docs in docs_by_spec.items()
+    }
+    context.log.info(f"Annotating {sum(len(docs) for docs in to_annotate.values())} docs...")
+    mark = agent_client.call_metrics_mark()
+    annotations, requests = annotate_relevance(to_annotate, relevance, agent_client, confidence)
+    annotations.update(accepted)
+    call_metrics = rollup(agent_client.call_metrics_since(mark))
+    context.log.info(f"Requests: {requests}, calls: {call_metrics}")
+
+    # the requests and calls are shared between the specs, so only the first output reports
+    # them, and the others say where to find them, so that summing over outputs doesn't
+    # count them more than once
+    output_names = [spec_asset_name(asset_prefix, spec_name) for spec_name in docs_by_spec]
+    for output_name, (spec_name, docs) in zip(output_names, docs_by_spec.items()):
+        annotated_docs = [annotations[(spec_name, url)] for url in docs["url"].map(canonicalize_url)]
+        labelled, metadata = label_relevance(docs, spec_name, relevance, annotated_docs)
+        metadata["Accepted by cascade"] = int((docs["route"] == ACCEPT).sum()) if "route" in docs else 0
+        context.log.info(f"Metadata ({spec_name}): {metadata}")
+        if output_name == output_names[0]:
+            shared = {**requests, **call_metrics}
+            if len(output_names) > 1:
+                shared["LLM calls shared with"] = ", ".join(output_names[1:])
+        else:
+            shared = {"LLM calls reported by": output_names[0]}
+        yield Output(
+            labelled,
+            output_name=output_name,
+            metadata={**metadata, **shared},
+        )
 
-    context.log.info(f"Annotating {len(contents)} docs...")
-    annotated_docs = agent_client.filter_spec_batch(
-        spec_name,
-        relevance,
-        contents
-    )
+def cascade_annotation(contents: str, verdict: Dict[str, Any]) -> AnnotatedDoc:
+    return AnnotatedDoc(doc=contents, annotation=json.dumps({**verdict, "decided_by": "cascade"}))
 
-    json_annotations = [a.annotation if a is not None else '{}' for a in annotated_docs]  # Handle None in annotations
+# should return document_id, highly_relevant, reasoning, label, value
+def label_relevance(
+    hackernews_documents: DataFrame, 
+    spec_name: str,
+    relevance: Relevance,
+    annotated_docs: List[Optional[AnnotatedDoc]],
+) -> Tuple[DataFrame, Dict[str, Any]]:
+    hackernews_documents, annotated, failed = drop_failed(hackernews_documents, annotated_docs)
 
-    annotations = [json.loads(a) for a in json_annotations]
+    annotations = [json.loads(a.annotation) for a in annotated]
     relevant = [a["relevant"] for a in annotations]
     reasoning = [a["reasoning"] for a in annotations]
 
@@ -261,20 +549,43 @@ def relevance_filter_spec(
     empty_annotations = [a for a in annotations if a == ""]
 
     num_relevant = len([h for h in relevant if h])
-    num_not_relevant = len(annotated_docs) - num_relevant
+    num_not_relevant = len(annotated) - num_relevant
 
     metadata = {
         "Non-empty annotations": len(non_empty_annotations),
         "Empty annotations": len(empty_annotations),
         "Relevant": num_relevant,
         "Not relevant": num_not_relevant,
+        "Failed annotations": failed,
+        **token_metadata(annotated),
+    }
+    return hackernews_documents, metadata
+
+def drop_failed(
+    docs: DataFrame,
+    annotated_docs: List[Optional[AnnotatedDoc]],
+) -> Tuple[DataFrame, List[AnnotatedDoc], int]:
+    """Leaves out the documents whose annotation failed, so that they are neither stored nor
+    passed on, and are annotated again when the partition is rerun. Fails if every one did,
+    which is more likely a problem with the API than with the documents."""
+    succeeded = [a is not None for a in annotated_docs]
+    failed = succeeded.count(False)
+    if failed and failed == len(annotated_docs):
+        raise Exception(f"Annotating all {failed} documents failed")
+    return docs[Series(succeeded, index=docs.index, dtype=bool)].copy(), [a for a in annotated_docs if a is not None], failed
+
+def token_metadata(annotated_docs: List[AnnotatedDoc]) -> Dict[str, float]:
+    """Document token counts, how many documents were too long for one request and were sent in
+    chunks, and how many were short enough to be packed several to a request."""
+    packed = [a.pack_size for a in annotated_docs if a.pack_size > 1]
+    return {
+        "Document tokens": sum(a.tokens for a in annotated_docs),
+        "Max document tokens": max((a.tokens for a in annotated_docs), default=0),
+        "Chunked documents": sum(a.chunks > 1 for a in annotated_docs),
+        "Chunks": sum(a.chunks for a in annotated_docs),
+        "Packed documents": len(packed),
+        "Average pack size": sum(packed) / len(packed) if packed else 0,
     }
-    context.log.info(f"Metadata: {metadata}")
-
-    return Output(
-        hackernews_documents,
-        metadata=metadata,
-    )
 
 @asset(partitions_def=hourly_partitions)
 def summary_perspective_summarizer_iac(
@@ -304,23 +615,30 @@ def summary_perspective_summarizer(
     contents_with_reasoning: List[Tuple[str, str]] = list(zip(relevance_filtered['contents'], relevance_filtered['reasoning']))
     
     context.log.info(f"Annotating {len(contents_with_reasoning)} docs...")
-    annotated_docs: List[AnnotatedDoc|None] = agent_client.perspective_summarizer_batch(
-        contents_with_reasoning
-    )
+    mark = agent_client.call_metrics_mark()
+    annotated_docs: List[AnnotatedDoc|None] = map_unique_urls(
+        relevance_filtered,
+        lambda unique_docs: agent_client.perspective_summarizer_batch(
+            list(zip(unique_docs['contents'], unique_docs['reasoning']))
+        ))
 
-    annotations = [json.loads(a.annotation) if a is not None else {} for a in annotated_docs]  # Handle None in annotations
+    summarized, annotated, failed = drop_failed(relevance_filtered, annotated_docs)
+    annotations = [json.loads(a.annotation) for a in annotated]
     summary = [a["summary"] for a in annotations]
     reasoning = [a["reasoning"] for a in annotations]
 
-    assert len(summary) == len(contents_with_reasoning)
-    assert len(reasoning) == len(contents_with_reasoning)
+    assert len(summary) == len(contents_with_reasoning) - failed
+    assert len(reasoning) == len(contents_with_reasoning) - failed
 
-    df = relevance_filtered.assign(summary=summary, reasoning=reasoning, value=annotations, label=label)
+    df = summarized.assign(summary=summary, reasoning=reasoning, value=annotations, label=label)
     return Output(
         df,
         metadata={
             "Input size": len(contents_with_reasoning),
             "Output size": len(summary),
+            "Failed summaries": failed,
+            **token_metadata(annotated),
+            **rollup(agent_client.call_metrics_since(mark)),
         },
     )
 
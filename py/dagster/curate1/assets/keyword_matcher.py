@@ -0,0 +1,78 @@
+import re
+from collections import defaultdict
+from typing import Dict, Iterable, List, Mapping, Set
+
+# the only columns of a document that can mention a keyword
+KEYWORD_TEXT_COLUMNS = ["title", "url", "text", "contents"]
+
+
+def _trie_pattern(keywords: Iterable[str]) -> str:
+    """Builds a regex that matches the longest of `keywords` starting at a position.
+
+    The alternation is factored into a trie, so the engine follows one branch per character
+    instead of trying every keyword in turn, and matching costs the same however many
+    keywords there are.
+    """
+    trie: Dict = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def pattern(node: Dict) -> str:
+        branches = [re.escape(char) + pattern(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        group = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if "" in node:
+            # a keyword ends here, but a longer one may continue from it
+            return f"(?:{group})?"
+        return group
+
+    return pattern(trie)
+
+
+class KeywordMatcher:
+    """Matches the keywords of many specs against a text in a single scan.
+
+    Keywords are matched as whole words, case insensitively, as the per-spec regexes did.
+    Every position is tried, so overlapping keywords are all found, e.g. both
+    "infrastructure as code" and "code".
+    """
+
+    def __init__(self, spec_keywords: Mapping[str, List[str]]):
+        self.specs = list(spec_keywords)
+        self.keyword_specs: Dict[str, Set[str]] = defaultdict(set)
+        for spec, keywords in spec_keywords.items():
+            for keyword in keywords:
+                self.keyword_specs[keyword.lower()].add(spec)
+
+        keywords = list(self.keyword_specs)
+        # only the longest keyword at a position is captured, so it also stands for every
+        # shorter keyword that is a whole-word prefix of it
+        self.prefixes: Dict[str, List[str]] = {
+            keyword: [
+                other for other in keywords
+                if keyword.startswith(other)
+                and (len(other) == len(keyword) or not _is_word_char(keyword[len(other)]))
+            ]
+            for keyword in keywords
+        }
+        self.pattern = re.compile(
+            r"(?=\b(" + _trie_pattern(keywords) + r")\b)", re.IGNORECASE
+        )
+
+    def match(self, text: str) -> Set[str]:
+        """The keywords that occur in `text`."""
+        matched: Set[str] = set()
+        for found in self.pattern.finditer(text):
+            matched.update(self.prefixes.get(found.group(1).lower(), ()))
+        return matched
+
+    def specs_for(self, keywords: Iterable[str]) -> Set[str]:
+        return {spec for keyword in keywords for spec in self.keyword_specs[keyword]}
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == "_"
@@ -1,10 +1,22 @@
-from dagster import define_asset_job
+from dagster import AssetSelection, define_asset_job
 
 from .partitions import hourly_partitions
 
+# stories backfills a window of partitions in a single run, and a job's assets must all share
+# a backfill policy, so it has a job of its own. The two always run together: start (or
+# backfill) curate1_stories_job, and stories_done_sensor runs curate1_job for each partition
+# once its stories are materialized. curate1_job on its own only works for partitions whose
+# stories already exist.
+curate1_stories_job = define_asset_job(
+  "curate1_stories_job",
+  partitions_def = hourly_partitions,
+  selection=["stories"],
+)
+
 curate1_job = define_asset_job(
   "curate1_job",
   partitions_def = hourly_partitions,
+  selection=AssetSelection.all() - AssetSelection.keys("stories"),
   config={
     "execution": {
       "config": {
@@ -19,7 +31,7 @@ curate1_job = define_asset_job(
 curate1_processing_job = define_asset_job(
   "curate1_processing_job",
   partitions_def = hourly_partitions,
-  selection=["candidate_docs_iac*", "candidate_docs_coding_with_ai*"],
+  selection=["keyword_matches", "candidate_docs_iac*", "candidate_docs_coding_with_ai*"],
   config={
     "execution": {
       "config": {
@@ -1,9 +1,12 @@
 import os
 
 from .agent import agent_resource
-from .article_resource import WebArticleClient
+from .article_resource import AsyncWebArticleClient
+from .cascade_router.cascade_router import CascadeRouter
 from .database.database_resource import SqliteDatabaseResource
-from .hn_resource import HNAPIClient
+from .hn_resource import CachingHNClient, HNAPIClient
+from .partition_range_io_manager import PartitionRangeFilesystemIOManager
+from .semantic_prefilter.semantic_prefilter import SemanticPrefilter
 
 db_path = os.getenv('SQLITE_DATABASE_PATH')
 if db_path is None:
@@ -11,9 +14,28 @@ if db_path is None:
 
 database_resource = SqliteDatabaseResource(db_path=db_path)
 
+hn_item_store_path = os.getenv(
+    'HN_ITEM_STORE_PATH', os.path.join(os.path.dirname(db_path), "hn_items.db"))
+
+# for backfills, LLM requests can be sent as offline batch jobs, through "openai" or "local"
+llm_batch_backend = os.getenv('LLM_BATCH_BACKEND')
+agent_client = agent_resource.OpenAIAgentClient()
+if llm_batch_backend is not None:
+    agent_client = agent_resource.BatchAgentClient(
+        batch_backend=llm_batch_backend,
+        local_batch_dir=os.path.join(os.path.dirname(db_path), "llm_batches"))
+
+# classifiers distilled from earlier LLM verdicts decide the documents they're confident about
+relevance_model_dir = os.getenv('RELEVANCE_MODEL_DIR')
+if relevance_model_dir is not None:
+    agent_client = agent_resource.DistilledAgentClient(inner=agent_client, model_dir=relevance_model_dir)
+
 RESOURCES_LOCAL = {
-  "hn_client": HNAPIClient(),
-  "article_client": WebArticleClient(),
-  "agent_client": agent_resource.OpenAIAgentClient(),
+  "hn_client": CachingHNClient(inner=HNAPIClient(), store_path=hn_item_store_path),
+  "article_client": AsyncWebArticleClient(),
+  "prefilter": SemanticPrefilter(),
+  "cascade_router": CascadeRouter(),
+  "agent_client": agent_client,
   "database_resource": database_resource,
+  "io_manager": PartitionRangeFilesystemIOManager(),
 }
@@ -1,60 +1,301 @@
+import json
+import logging
 from abc import ABC, abstractmethod
-from concurrent.futures import ThreadPoolExecutor
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 from dagster import ConfigurableResource, file_relative_path
+from openai import OpenAI
 
+from ..llm_response_cache.llm_response_cache import DbResponseCache
+from ..relevance_classifier.relevance_classifier import RelevanceClassifier
+from .batch import (BatchBackend, DbPendingBatchStore, LocalBatchBackend,
+                    OpenAIBatchBackend, request_key, run_batches)
 from .filter_spec import FilterSpec, Relevance
+from .llm_executor import (DEFAULT_REQUESTS_PER_MINUTE,
+                           DEFAULT_TOKENS_PER_MINUTE, LlmExecutor)
+from .middleware import LlmRequest
 from .model import AnnotatedDoc
 from .perspective_summarizer import PerspectiveSummarizer
+from .telemetry import CallMetric
+
+logger = logging.getLogger(__name__)
 
-PARALLELISM = 4
 
 class AgentClient(ConfigurableResource, ABC):
     @abstractmethod
-    def filter_spec_batch(self, spec_file: str, relevance: Relevance, contents: List[str]) -> List[Optional[AnnotatedDoc]]:
+    def filter_spec_batch(self, spec_file: str, relevance: Relevance, contents: List[str], confidence: bool = False) -> List[Optional[AnnotatedDoc]]:
         pass
 
     @abstractmethod
     def perspective_summarizer_batch(self, contents_with_reasoning: List[Tuple[str, str]]) -> List[Optional[AnnotatedDoc]]:
         pass
 
+    def filter_multi_spec_batch(self, spec_names: List[str], relevance: Relevance, contents: List[str], confidence: bool = False) -> List[Dict[str, Optional[AnnotatedDoc]]]:
+        """Judges each document against every spec in `spec_names`, returning an annotation per spec
+        for each document. Clients that can judge several specs in one request override this.
+
+        With `confidence`, the maybe relevant tier also states how sure it is of each verdict."""
+        annotations_by_spec = {
+            spec_name: self.filter_spec_batch(spec_name, relevance, contents, confidence) for spec_name in spec_names
+        }
+        return [
+            {spec_name: annotations[i] for spec_name, annotations in annotations_by_spec.items()}
+            for i in range(len(contents))
+        ]
+
+    def call_metrics_mark(self) -> int:
+        """A mark to pass to `call_metrics_since`."""
+        return 0
+
+    def call_metrics_since(self, mark: int) -> List[CallMetric]:
+        """The metrics of the LLM calls made in this process since `mark` was taken. A mark
+        is read once, after which the metrics only it needed are dropped."""
+        return []
+
 
 class OpenAIAgentClient(AgentClient):
-    def filter_spec_batch(self, spec_name: str, relevance: Relevance, contents: List[str]) -> List[Optional[AnnotatedDoc]]:
+    """Sends every document in a batch at once to the process's shared LLM executor, which
+    admits requests as each model's requests-per-minute and tokens-per-minute limits allow.
+
+    A document whose requests fail is annotated None rather than failing the batch, and the
+    failed calls are counted in the call metrics. Every response is cached as it arrives, so a
+    rerun only sends the requests that failed.
+    """
+
+    requests_per_minute: Dict[str, int] = DEFAULT_REQUESTS_PER_MINUTE
+    tokens_per_minute: Dict[str, int] = DEFAULT_TOKENS_PER_MINUTE
+    max_in_flight: int = 64
+    # whether short documents are packed several to a request, where the relevance tier allows
+    pack_documents: bool = True
+
+    def _executor(self) -> LlmExecutor:
+        return LlmExecutor.shared(self.requests_per_minute, self.tokens_per_minute, self.max_in_flight)
+
+    def call_metrics_mark(self) -> int:
+        return self._executor().recorder.mark()
+
+    def call_metrics_since(self, mark: int) -> List[CallMetric]:
+        return self._executor().recorder.since(mark)
+
+    def _packs(self, filter_spec: FilterSpec, contents: List[str], spec_file: str) -> List[List[int]]:
+        if not self.pack_documents:
+            return [[i] for i in range(len(contents))]
+        # on the executor's loop, since packing looks documents up in its response cache
+        return self._executor().run(filter_spec.packs(contents, spec_file))
+
+    def filter_spec_batch(self, spec_name: str, relevance: Relevance, contents: List[str], confidence: bool = False) -> List[Optional[AnnotatedDoc]]:
         spec_file = file_relative_path(__file__, f"prompts/specs/{spec_name}.txt")
+        executor = self._executor()
+        filter_spec = FilterSpec.from_executor(executor, relevance, confidence)
+        packs = self._packs(filter_spec, contents, spec_file)
 
-        def annotate_post(content: str) -> Optional[AnnotatedDoc]:
+        async def annotate_pack(pack: List[int]) -> List[Optional[AnnotatedDoc]]:
+            docs = [contents[i] for i in pack]
             try:
-                filter_spec = FilterSpec.from_env(relevance)
-                docs = [content]
-                annotation = filter_spec.apply(docs, spec_file)
-                # TOOD: switch to non array
-                return annotation[0]
+                return list(await filter_spec.apply_packed(docs, spec_file))
             except Exception as e:
-                print(f"Error annotating {content[:20]}...: {e}")
-                raise
+                logger.warning("Error annotating %s...: %s", docs[0][:20], e)
+                return [None] * len(docs)
 
-        annotated_posts = []
-
-        with ThreadPoolExecutor(max_workers=PARALLELISM) as executor:
-            annotated_posts = list(executor.map(annotate_post, contents))
-        
-        return annotated_posts
+        annotated_docs: List[Optional[AnnotatedDoc]] = [None] * len(contents)
+        for pack, annotated_pack in zip(packs, executor.run_all([annotate_pack(pack) for pack in packs])):
+            for i, annotated_doc in zip(pack, annotated_pack):
+                annotated_docs[i] = annotated_doc
+        return annotated_docs
     
+    def filter_multi_spec_batch(self, spec_names: List[str], relevance: Relevance, contents: List[str], confidence: bool = False) -> List[Dict[str, Optional[AnnotatedDoc]]]:
+        spec_files = {
+            spec_name: file_relative_path(__file__, f"prompts/specs/{spec_name}.txt") for spec_name in spec_names
+        }
+        executor = self._executor()
+        filter_spec = FilterSpec.from_executor(executor, relevance, confidence)
+
+        async def annotate_post(content: str) -> Dict[str, Optional[AnnotatedDoc]]:
+            try:
+                return dict(await filter_spec.apply_multi(content, spec_files))
+            except Exception as e:
+                logger.warning("Error annotating %s...: %s", content[:20], e)
+                return {spec_name: None for spec_name in spec_names}
+
+        return executor.run_all([annotate_post(content) for content in contents])
+
     def perspective_summarizer_batch(self, contents_with_reasoning: List[Tuple[str, str]]) -> List[Optional[AnnotatedDoc]]:
-        def annotate_post(pair: Tuple[str, str]) -> Optional[AnnotatedDoc]:
+        executor = self._executor()
+        summarizer = PerspectiveSummarizer.from_executor(executor)
+
+        async def annotate_post(pair: Tuple[str, str]) -> Optional[AnnotatedDoc]:
             contents, reasoning = pair
             try:
-                summarizer = PerspectiveSummarizer.from_env()
-                annotation = summarizer.apply(contents, reasoning)
-                return annotation
+                return await summarizer.apply(contents, reasoning)
             except Exception as e:
-                print(f"Error annotating {contents[:20]}...: {e}")
-                raise
-
-        annotated_posts = []
-        with ThreadPoolExecutor(max_workers=PARALLELISM) as executor:
-            annotated_posts = list(executor.map(annotate_post, contents_with_reasoning))
-        
-        return annotated_posts
+                logger.warning("Error annotating %s...: %s", contents[:20], e)
+                return None
+
+        return executor.run_all([annotate_post(pair) for pair in contents_with_reasoning])
+
+
+class BatchAgentClient(OpenAIAgentClient):
+    """For backfills, where cost and rate limits matter more than latency.
+
+    Every request a batch of documents needs is first sent as offline JSONL batch jobs, and
+    the responses are put in the response cache, from which the documents are then annotated
+    as usual. Requests the batch jobs didn't answer are sent as ordinary requests. Submitted
+    batches are kept in the database until they're collected, so a run that stops or gives up
+    waiting leaves them for the next run to poll, rather than to submit again.
+
+    `batch_backend` is "openai" for the OpenAI batch API, or "local" for a stand-in that keeps
+    batches in `local_batch_dir` and runs them against the chat completions endpoint.
+    """
+
+    batch_backend: str = "openai"
+    local_batch_dir: str = ".batches"
+    poll_interval_seconds: float = 60
+    timeout_seconds: float = 24 * 60 * 60
+
+    def _run_batches(self, requests: List[LlmRequest]) -> List[Tuple[str, str]]:
+        """Runs the batch jobs, returning the keys of the requests they answered, which are
+        prepaid until `_forget_prepaid` is called with them."""
+        if self.batch_backend == "openai":
+            backend: BatchBackend = OpenAIBatchBackend(OpenAI())
+        elif self.batch_backend == "local":
+            backend = LocalBatchBackend(self.local_batch_dir)
+        else:
+            raise ValueError(f"Unknown batch backend: {self.batch_backend}")
+        answered: List[Tuple[LlmRequest, CallMetric]] = []
+        stats = run_batches(
+            backend, DbResponseCache.from_env(), requests, self.poll_interval_seconds, self.timeout_seconds,
+            record=lambda request, metric: answered.append((request, metric)), store=DbPendingBatchStore.from_env())
+        logger.info("Batch stats: %s", stats)
+
+        # recorded through the executor, which owns the recorder, so they count toward the
+        # calls made for these documents, and answering the documents from the cache next
+        # doesn't count them again
+        executor = self._executor()
+
+        async def record_all():
+            for _, metric in answered:
+                await executor.db(executor.recorder.record, metric)
+        executor.run(record_all())
+        keys = [request_key(request) for request, _ in answered]
+        executor.recorder.prepay(keys)
+        return keys
+
+    def _forget_prepaid(self, keys: List[Tuple[str, str]]):
+        self._executor().recorder.forget_prepaid(keys)
+
+    def filter_spec_batch(self, spec_name: str, relevance: Relevance, contents: List[str], confidence: bool = False) -> List[Optional[AnnotatedDoc]]:
+        spec_file = file_relative_path(__file__, f"prompts/specs/{spec_name}.txt")
+        filter_spec = FilterSpec.from_executor(self._executor(), relevance, confidence)
+        requests = []
+        for pack in self._packs(filter_spec, contents, spec_file):
+            if len(pack) > 1:
+                requests.append(filter_spec.pack_request([contents[i] for i in pack], spec_file))
+            else:
+                requests += [filter_spec.request(chunk, spec_file) for chunk in filter_spec.split(contents[pack[0]])]
+        keys = self._run_batches(requests)
+        try:
+            return super().filter_spec_batch(spec_name, relevance, contents, confidence)
+        finally:
+            self._forget_prepaid(keys)
+
+    def filter_multi_spec_batch(self, spec_names: List[str], relevance: Relevance, contents: List[str], confidence: bool = False) -> List[Dict[str, Optional[AnnotatedDoc]]]:
+        spec_files = {
+            spec_name: file_relative_path(__file__, f"prompts/specs/{spec_name}.txt") for spec_name in spec_names
+        }
+        filter_spec = FilterSpec.from_executor(self._executor(), relevance, confidence)
+        keys = self._run_batches([
+            filter_spec.multi_request(chunk, spec_files) for content in contents for chunk in filter_spec.split(content)
+        ])
+        try:
+            return super().filter_multi_spec_batch(spec_names, relevance, contents, confidence)
+        finally:
+            self._forget_prepaid(keys)
+
+    def perspective_summarizer_batch(self, contents_with_reasoning: List[Tuple[str, str]]) -> List[Optional[AnnotatedDoc]]:
+        summarizer = PerspectiveSummarizer.from_executor(self._executor())
+        keys = self._run_batches([
+            summarizer.request(chunk, reasoning)
+            for contents, reasoning in contents_with_reasoning for chunk in summarizer.split(contents)
+        ])
+        try:
+            return super().perspective_summarizer_batch(contents_with_reasoning)
+        finally:
+            self._forget_prepaid(keys)
+
+
+class DistilledAgentClient(AgentClient):
+    """Decides relevance locally where a classifier distilled from earlier LLM verdicts is
+    confident, and asks `inner` about the rest.
+
+    Classifiers are trained with the admin `classifier train` command and read from
+    `model_dir`. Specs and relevance tiers without a classifier always go to `inner`.
+    """
+
+    inner: AgentClient
+    model_dir: str
+
+    def _classifier(self, spec_name: str, relevance: Relevance) -> Optional[RelevanceClassifier]:
+        return RelevanceClassifier.load(self.model_dir, spec_name, relevance)
+
+    def _decide(self, spec_name: str, relevance: Relevance, contents: List[str]) -> List[Optional[AnnotatedDoc]]:
+        """The classifier's verdict for each document, or None where it isn't confident."""
+        classifier = self._classifier(spec_name, relevance)
+        if classifier is None:
+            return [None] * len(contents)
+        decided: List[Optional[AnnotatedDoc]] = []
+        for content, probability in zip(contents, classifier.predict(contents)):
+            decision = classifier.decide(probability)
+            if decision is None:
+                decided.append(None)
+                continue
+            annotation = json.dumps({
+                "relevant": decision,
+                "reasoning": f"Decided by the local classifier, with probability {probability:.2f} of being relevant.",
+                "decided_by": "classifier",
+            })
+            decided.append(AnnotatedDoc(doc=content, annotation=annotation))
+        return decided
+
+    def filter_spec_batch(self, spec_name: str, relevance: Relevance, contents: List[str], confidence: bool = False) -> List[Optional[AnnotatedDoc]]:
+        decided = self._decide(spec_name, relevance, contents)
+        uncertain = [i for i, doc in enumerate(decided) if doc is None]
+        logger.info("Classifier decided %d of %d docs for %s", len(contents) - len(uncertain), len(contents), spec_name)
+        if uncertain:
+            for i, doc in zip(uncertain, self.inner.filter_spec_batch(spec_name, relevance, [contents[i] for i in uncertain], confidence)):
+                decided[i] = doc
+        return decided
+
+    def filter_multi_spec_batch(self, spec_names: List[str], relevance: Relevance, contents: List[str], confidence: bool = False) -> List[Dict[str, Optional[AnnotatedDoc]]]:
+        decided = {spec_name: self._decide(spec_name, relevance, contents) for spec_name in spec_names}
+        results: List[Dict[str, Optional[AnnotatedDoc]]] = [
+            {spec_name: decided[spec_name][i] for spec_name in spec_names} for i in range(len(contents))
+        ]
+
+        # documents are grouped by the specs the classifiers weren't sure about, so each still
+        # needs only one request
+        uncertain_by_specs: Dict[Tuple[str, ...], List[int]] = {}
+        for i, result in enumerate(results):
+            uncertain_specs = tuple(spec_name for spec_name, doc in result.items() if doc is None)
+            if uncertain_specs:
+                uncertain_by_specs.setdefault(uncertain_specs, []).append(i)
+
+        for uncertain_specs, indices in uncertain_by_specs.items():
+            uncertain_contents = [contents[i] for i in indices]
+            if len(uncertain_specs) == 1:
+                annotated = self.inner.filter_spec_batch(uncertain_specs[0], relevance, uncertain_contents, confidence)
+                for i, doc in zip(indices, annotated):
+                    results[i][uncertain_specs[0]] = doc
+            else:
+                annotated_by_spec = self.inner.filter_multi_spec_batch(list(uncertain_specs), relevance, uncertain_contents, confidence)
+                for i, by_spec in zip(indices, annotated_by_spec):
+                    results[i].update(by_spec)
+        return results
+
+    def perspective_summarizer_batch(self, contents_with_reasoning: List[Tuple[str, str]]) -> List[Optional[AnnotatedDoc]]:
+        return self.inner.perspective_summarizer_batch(contents_with_reasoning)
+
+    def call_metrics_mark(self) -> int:
+        return self.inner.call_metrics_mark()
+
+    def call_metrics_since(self, mark: int) -> List[CallMetric]:
+        return self.inner.call_metrics_since(mark)
@@ -0,0 +1,330 @@
+import json
+import logging
+import os
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from openai import OpenAI
+
+from ..database.database import Database
+from ..llm_response_cache.llm_response_cache import LlmResponseCache
+from .middleware import LlmRequest, parse_response
+from .telemetry import CallMetric, Completion, estimate_cost
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+# the batch API's limit on requests per batch
+MAX_REQUESTS_PER_BATCH = 50000
+
+# batch statuses after which nothing more will happen
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+# batch requests cost this fraction of the same requests sent one by one
+BATCH_PRICE_FACTOR = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+class BatchBackend(ABC):
+  """Somewhere JSONL batch jobs can be submitted, polled and collected, in the format of the
+  OpenAI batch API."""
+
+  @abstractmethod
+  def submit(self, jsonl: str) -> str:
+    """Submits a batch and returns its id."""
+    pass
+
+  @abstractmethod
+  def status(self, batch_id: str) -> str:
+    pass
+
+  @abstractmethod
+  def output(self, batch_id: str) -> str:
+    """The JSONL output of a completed batch."""
+    pass
+
+
+class OpenAIBatchBackend(BatchBackend):
+  def __init__(self, openai: OpenAI):
+    self.openai = openai
+
+  def submit(self, jsonl: str) -> str:
+    input_file = self.openai.files.create(file=("batch.jsonl", jsonl.encode()), purpose="batch")
+    batch = self.openai.batches.create(
+      input_file_id=input_file.id,
+      endpoint=BATCH_ENDPOINT,
+      completion_window="24h",
+    )
+    return batch.id
+
+  def status(self, batch_id: str) -> str:
+    return self.openai.batches.retrieve(batch_id).status
+
+  def output(self, batch_id: str) -> str:
+    output_file_id = self.openai.batches.retrieve(batch_id).output_file_id
+    if output_file_id is None:
+      return ""
+    return self.openai.files.content(output_file_id).text
+
+
+class LocalBatchBackend(BatchBackend):
+  """A stand-in for the batch API, which keeps batches as files in `batch_dir` and runs them
+  through `complete`, by default the chat completions endpoint, the first time they're polled.
+  `complete` takes a request body and returns a chat completion response body.
+  """
+
+  def __init__(self, batch_dir: str, complete: Optional[Callable[[dict], dict]] = None):
+    self.batch_dir = batch_dir
+    self.complete = complete or self._chat_completion
+    os.makedirs(batch_dir, exist_ok=True)
+
+  @staticmethod
+  def _chat_completion(body: dict) -> dict:
+    return OpenAI().chat.completions.create(**body).model_dump()
+
+  def _path(self, batch_id: str, kind: str) -> str:
+    return os.path.join(self.batch_dir, f"{batch_id}.{kind}.jsonl")
+
+  def submit(self, jsonl: str) -> str:
+    batch_id = f"batch_{uuid.uuid4().hex}"
+    with open(self._path(batch_id, "input"), "w") as f:
+      f.write(jsonl)
+    return batch_id
+
+  def status(self, batch_id: str) -> str:
+    if not os.path.exists(self._path(batch_id, "output")):
+      self._run(batch_id)
+    return "completed"
+
+  def _run(self, batch_id: str):
+    lines = []
+    with open(self._path(batch_id, "input"), "r") as f:
+      for line in f:
+        request = json.loads(line)
+        try:
+          response = {"status_code": 200, "body": self.complete(request["body"])}
+          lines.append({"custom_id": request["custom_id"], "response": response, "error": None})
+        except Exception as e:
+          lines.append({"custom_id": request["custom_id"], "response": None, "error": {"message": str(e)}})
+    with open(self._path(batch_id, "output"), "w") as f:
+      f.write("".join(json.dumps(line) + "\n" for line in lines))
+
+  def output(self, batch_id: str) -> str:
+    with open(self._path(batch_id, "output"), "r") as f:
+      return f.read()
+
+
+@dataclass
+class PendingBatch:
+  """A submitted batch, with its requests by custom id."""
+  batch_id: str
+  requests: Dict[str, LlmRequest]
+  submitted_at: float
+
+
+class PendingBatchStore(ABC):
+  """Keeps the batches submitted until they're collected, so that a run which stops while
+  waiting for them picks them up again rather than paying for their requests twice."""
+
+  @abstractmethod
+  def get_batches(self) -> List[PendingBatch]:
+    pass
+
+  @abstractmethod
+  def put_batch(self, batch: PendingBatch):
+    pass
+
+  @abstractmethod
+  def delete_batch(self, batch_id: str):
+    pass
+
+
+class DbPendingBatchStore(PendingBatchStore):
+  """Requests are stored without their validators, which can't be serialized."""
+
+  def __init__(self, database: Database):
+    self.database = database
+
+  def get_batches(self) -> List[PendingBatch]:
+    batches = []
+    for batch_id, requests, submitted_at in self.database.get_llm_pending_batches():
+      batches.append(PendingBatch(
+        batch_id=batch_id,
+        requests={
+          custom_id: LlmRequest(messages=request["messages"], model=request["model"])
+          for custom_id, request in json.loads(requests).items()
+        },
+        submitted_at=submitted_at,
+      ))
+    return batches
+
+  def put_batch(self, batch: PendingBatch):
+    requests = {
+      custom_id: {"messages": request.messages, "model": request.model}
+      for custom_id, request in batch.requests.items()
+    }
+    self.database.insert_llm_pending_batch(batch.batch_id, json.dumps(requests), batch.submitted_at)
+
+  def delete_batch(self, batch_id: str):
+    self.database.delete_llm_pending_batch(batch_id)
+
+  @staticmethod
+  def from_env() -> PendingBatchStore:
+    db_path = os.getenv('SQLITE_DATABASE_PATH')
+    if db_path is None:
+      raise ValueError("SQLITE_DATABASE_PATH environment variable is not set.")
+    database = Database(db_path=db_path)
+    database.create_tables()
+    return DbPendingBatchStore(database)
+
+
+def request_key(request: LlmRequest) -> Tuple[str, str]:
+  """The request's key in the response cache."""
+  return json.dumps(request.messages), request.model
+
+
+def batch_jsonl(requests: Dict[str, LlmRequest]) -> str:
+  return "".join(
+    json.dumps({
+      "custom_id": custom_id,
+      "method": "POST",
+      "url": BATCH_ENDPOINT,
+      "body": {"model": request.model, "messages": request.messages},
+    }) + "\n"
+    for custom_id, request in requests.items()
+  )
+
+
+def batch_responses(jsonl: str) -> Dict[str, Completion]:
+  """Responses by custom id, for the requests in a batch's output that succeeded. Their
+  latency is left for the caller to fill in."""
+  contents = {}
+  for line in jsonl.splitlines():
+    if not line.strip():
+      continue
+    result = json.loads(line)
+    response = result.get("response") or {}
+    if response.get("status_code") != 200:
+      continue
+    body = response["body"]
+    content = body["choices"][0]["message"]["content"]
+    if content is not None:
+      usage = body.get("usage") or {}
+      contents[result["custom_id"]] = Completion(
+        content, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), latency_seconds=0)
+  return contents
+
+
+def run_batches(
+  backend: BatchBackend,
+  cache: LlmResponseCache,
+  requests: Sequence[LlmRequest],
+  poll_interval_seconds: float,
+  timeout_seconds: float,
+  record: Optional[Callable[[LlmRequest, CallMetric], None]] = None,
+  store: Optional[PendingBatchStore] = None,
+) -> Dict[str, int]:
+  """Sends the requests that aren't cached yet as batch jobs, one per model, and caches every
+  valid response. Requests whose responses are missing or invalid are left uncached, so they
+  are sent as ordinary requests afterwards, where invalid responses can still be repaired.
+
+  Batches are kept in `store` until they're collected. Those left by an earlier run, which
+  stopped or gave up waiting, are polled again before anything new is submitted, and their
+  requests aren't sent again. Responses to their requests that aren't among `requests` have no
+  validator to check them against, so they're only kept as raw responses, to be validated by
+  whichever run asks for them.
+
+  Every response received, valid or not, is passed to `record` with its request as a call
+  metric, at batch prices, with the batch's turnaround as its latency.
+  """
+  current = {request_key(request): request for request in requests}
+  batches: Dict[str, PendingBatch] = {}
+  for batch in store.get_batches() if store is not None else []:
+    logger.info("Resuming batch %s with %d requests", batch.batch_id, len(batch.requests))
+    batches[batch.batch_id] = PendingBatch(
+      batch_id=batch.batch_id,
+      # requests being made now bring back their validators
+      requests={
+        custom_id: current.get(request_key(request), request) for custom_id, request in batch.requests.items()
+      },
+      submitted_at=batch.submitted_at,
+    )
+  in_batches = {request_key(request) for batch in batches.values() for request in batch.requests.values()}
+
+  pending: Dict[str, Dict[str, LlmRequest]] = {}
+  for key, request in current.items():
+    if key in in_batches or cache.get_llm_response(*key) is not None:
+      continue
+    by_id = pending.setdefault(request.model, {})
+    by_id[f"request-{len(by_id)}"] = request
+
+  stats = {
+    "Batch requests": 0, "Batch requests resumed": sum(len(batch.requests) for batch in batches.values()),
+    "Batch responses cached": 0, "Batch responses invalid": 0, "Batch responses kept for other runs": 0,
+    "Batch requests failed": 0,
+  }
+  for model_requests in pending.values():
+    ids = list(model_requests)
+    for start in range(0, len(ids), MAX_REQUESTS_PER_BATCH):
+      chunk = {custom_id: model_requests[custom_id] for custom_id in ids[start:start + MAX_REQUESTS_PER_BATCH]}
+      batch = PendingBatch(batch_id=backend.submit(batch_jsonl(chunk)), requests=chunk, submitted_at=time.time())
+      if store is not None:
+        store.put_batch(batch)
+      logger.info("Submitted batch %s with %d requests", batch.batch_id, len(chunk))
+      batches[batch.batch_id] = batch
+      stats["Batch requests"] += len(chunk)
+
+  deadline = time.time() + timeout_seconds
+  remaining = dict(batches)
+  while remaining:
+    for batch_id in list(remaining):
+      status = backend.status(batch_id)
+      if status not in TERMINAL_STATUSES:
+        continue
+      logger.info("Batch %s %s", batch_id, status)
+      batch = remaining.pop(batch_id)
+      contents = batch_responses(backend.output(batch_id)) if status == "completed" else {}
+      for custom_id, request in batch.requests.items():
+        completion = contents.get(custom_id)
+        key = request_key(request)
+        if completion is None:
+          if key in current:
+            stats["Batch requests failed"] += 1
+          continue
+        if record is not None:
+          record(request, CallMetric(
+            model=request.model,
+            prompt_tokens=completion.prompt_tokens,
+            completion_tokens=completion.completion_tokens,
+            latency_seconds=time.time() - batch.submitted_at,
+            attempts=1,
+            cache_hit=False,
+            cost=estimate_cost(request.model, completion.prompt_tokens, completion.completion_tokens) * BATCH_PRICE_FACTOR,
+          ))
+        content = completion.content
+        cache.insert_raw_response(*key, content)
+        if key not in current:
+          stats["Batch responses kept for other runs"] += 1
+          continue
+        try:
+          parse_response(content, request.validate)
+        except ValueError as e:
+          logger.warning("Invalid batch response for %s: %s", custom_id, e)
+          stats["Batch responses invalid"] += 1
+          continue
+        cache.insert_llm_response(*key, content)
+        stats["Batch responses cached"] += 1
+      if store is not None:
+        store.delete_batch(batch_id)
+    if remaining:
+      if time.time() >= deadline:
+        # they're left in the store, so the next run collects them
+        logger.warning("Gave up waiting for batches %s", list(remaining))
+        stats["Batch requests failed"] += sum(
+          request_key(request) in current for batch in remaining.values() for request in batch.requests.values())
+        break
+      time.sleep(poll_interval_seconds)
+  return stats
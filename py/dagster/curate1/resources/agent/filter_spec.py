@@ -1,14 +1,19 @@
+import asyncio
 import json
+import logging
+import re
 from enum import Enum
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple
 
-from openai import OpenAI
 from openai.types.chat import ChatCompletionMessageParam
 
-from ..llm_response_cache.llm_response_cache import (DbResponseCache,
-                                                     LlmResponseCache)
-from .middleware import create_completion
+from ..llm_response_cache.llm_response_cache import LlmResponseCache
+from .llm_executor import LlmExecutor, read_prompt_file
+from .middleware import LlmRequest, create_completion, extract_json
 from .model import AnnotatedDoc
+from .tokens import count_tokens, split_tokens
+
+logger = logging.getLogger(__name__)
 
 system_prompt_template_highly_relevant = """
 You are a research assistant and your job is to search for articles relevant to my interests. 
@@ -149,58 +154,292 @@ DOCUMENT CONTENT:
 {document_content}
 """
 
+multi_spec_prompt_suffix = """
+Sometimes I will provide several search descriptions at once, each under its own name, like SEARCH DESCRIPTION (iac).
+In that case, judge the document against each search description separately, exactly as you would if it were the only one.
+Your response should then be json, with one field per search description name, each holding an object with the fields:
+- relevant: bool
+- reasoning: str
+"""
+
+multi_spec_user_prompt_template = """
+{search_descriptions}
+
+DOCUMENT CONTENT:
+{document_content}
+"""
+
+multi_spec_search_description_template = """SEARCH DESCRIPTION ({spec_name}):
+{search_description}
+"""
+
+confidence_prompt_suffix = """
+In every judgement you give, also include the field:
+- confidence: float, from 0 to 1, the probability that your relevant verdict is correct
+"""
+
+packed_prompt_suffix = """
+Sometimes I will provide several documents at once, numbered like DOCUMENT 1, DOCUMENT 2 and so on.
+In that case, judge each document against the search description separately, exactly as you would if it were the only one.
+Your response should then be a json array with one object per document, in order, each with the fields:
+- index: int, the number of the document
+- relevant: bool
+- reasoning: str
+"""
+
+packed_user_prompt_template = """
+SEARCH DESCRIPTION:
+{search_description}
+
+{documents}
+"""
+
+packed_document_template = """DOCUMENT {index}:
+{document_content}
+"""
+
 MODEL = "gpt-4o"
 
+# documents up to this many tokens may be packed into one request with others
+PACKABLE_DOCUMENT_TOKENS = 1000
+
+# the most documents packed into one request, which bounds the length of the response
+MAX_PACK_DOCUMENTS = 20
+
 class Relevance(Enum):
   HIGHLY_RELEVANT = "highly_relevant"
   MAYBE_RELEVANT = "maybe_relevant"
 
 
 class FilterSpec:
-  def __init__(self, openai: OpenAI, cache: LlmResponseCache, relevance: Relevance):
-    self.openai = openai
+  def __init__(self, llm: LlmExecutor, cache: LlmResponseCache, relevance: Relevance, confidence: bool = False):
+    self.llm = llm
     self.cache = cache
     self.recall = relevance
     
     if self.recall == Relevance.MAYBE_RELEVANT:
-      self.system_prompt = system_prompt_template_maybe_relevant
+      # the confidence lets the cascade router decide which verdicts need the expensive tier, but
+      # asking for it changes the prompt, so none of the responses cached without it are used
+      self.system_prompt = system_prompt_template_maybe_relevant + (confidence_prompt_suffix if confidence else "")
       self.model = "gpt-3.5-turbo"
-      self.content_limit = 10000
+      self.document_token_limit = 2500
+      # short documents are packed into requests of up to this many document tokens
+      self.pack_token_limit: Optional[int] = 6000
     elif self.recall == Relevance.HIGHLY_RELEVANT:
       self.system_prompt = system_prompt_template_highly_relevant
       self.model = "gpt-4o"
-      self.content_limit = 116000
+      self.document_token_limit = 29000
+      self.pack_token_limit = None
     else:
       raise ValueError(f"Invalid relevance: {self.recall}")
 
-    print(f"Using model: {self.model}, relevance: {self.recall}")
+    logger.info("Using model: %s, relevance: %s", self.model, self.recall)
 
-  def apply(self, docs: List[str], spec_file: str) -> List[AnnotatedDoc]:
+  def request(self, doc: str, spec_file: str) -> LlmRequest:
+    user_prompt = user_prompt_template.format(document_content=doc, search_description=read_prompt_file(spec_file))
+    
+    messages: List[ChatCompletionMessageParam] = [
+      {"role": "system", "content": self.system_prompt}, 
+      {"role": "user", "content": user_prompt}
+    ]
+    return LlmRequest(messages=messages, model=self.model)
+
+  def multi_request(self, doc: str, spec_files: Dict[str, str]) -> LlmRequest:
+    search_descriptions = []
+    for spec_name, spec_file in spec_files.items():
+      search_descriptions.append(
+        multi_spec_search_description_template.format(spec_name=spec_name, search_description=read_prompt_file(spec_file)))
+
+    user_prompt = multi_spec_user_prompt_template.format(
+      document_content=doc, search_descriptions="\n".join(search_descriptions))
+    messages: List[ChatCompletionMessageParam] = [
+      {"role": "system", "content": self.system_prompt + multi_spec_prompt_suffix},
+      {"role": "user", "content": user_prompt}
+    ]
+
+    def validate(annotations: Any):
+      for spec_name in spec_files:
+        annotation = annotations.get(spec_name) if isinstance(annotations, dict) else None
+        if not isinstance(annotation, dict) or "relevant" not in annotation or "reasoning" not in annotation:
+          raise ValueError(f"Missing annotation for spec {spec_name}: {annotations}")
+
+    return LlmRequest(messages=messages, model=self.model, validate=validate)
+
+  def pack_request(self, docs: List[str], spec_file: str) -> LlmRequest:
+    documents = "\n".join(
+      packed_document_template.format(index=i, document_content=doc) for i, doc in enumerate(docs, start=1))
+    user_prompt = packed_user_prompt_template.format(
+      search_description=read_prompt_file(spec_file), documents=documents)
+    messages: List[ChatCompletionMessageParam] = [
+      {"role": "system", "content": self.system_prompt + packed_prompt_suffix},
+      {"role": "user", "content": user_prompt}
+    ]
+
+    def validate(verdicts: Any):
+      if not isinstance(verdicts, list) or len(verdicts) != len(docs):
+        raise ValueError(f"Expected {len(docs)} verdicts: {verdicts}")
+      for i, verdict in enumerate(verdicts, start=1):
+        if not isinstance(verdict, dict) or verdict.get("index") != i or "relevant" not in verdict or "reasoning" not in verdict:
+          raise ValueError(f"Invalid verdict for document {i}: {verdict}")
+
+    return LlmRequest(messages=messages, model=self.model, validate=validate)
+
+  async def _cached(self, request: LlmRequest) -> bool:
+    return await self.llm.db(self.cache.get_llm_response, json.dumps(request.messages), request.model) is not None
+
+  async def packs(self, docs: List[str], spec_file: str) -> List[List[int]]:
+    """Groups the indices of `docs` into packs, each judged in one request. Short documents
+    share packs up to the pack token limit, in the order given; long documents, and those with
+    a cached verdict of their own, are packs of their own.
+
+    Which documents share a pack depends on what else is being judged, so packed verdicts are
+    cached per document as well (see `apply_packed`), and only cache misses are packed."""
+    packs: List[List[int]] = []
+    pack: List[int] = []
+    pack_tokens = 0
+    for i, doc in enumerate(docs):
+      tokens = count_tokens(doc, self.model)
+      if (
+        self.pack_token_limit is None
+        or tokens > PACKABLE_DOCUMENT_TOKENS
+        or await self._cached(self.request(doc, spec_file))
+      ):
+        packs.append([i])
+        continue
+      if pack and (pack_tokens + tokens > self.pack_token_limit or len(pack) == MAX_PACK_DOCUMENTS):
+        packs.append(pack)
+        pack, pack_tokens = [], 0
+      pack.append(i)
+      pack_tokens += tokens
+    if pack:
+      packs.append(pack)
+    return packs
+
+  def split(self, doc: str) -> List[str]:
+    """The document in chunks that each fit the document token limit, judged separately."""
+    return split_tokens(doc, self.document_token_limit, self.model)
+
+  async def apply(self, docs: List[str], spec_file: str) -> List[AnnotatedDoc]:
+    """Longer documents than the token limit are judged chunk by chunk, and are relevant if
+    any of their chunks is."""
     annotated_docs: List[AnnotatedDoc] = []
 
-    spec = ""
-    with open(spec_file, "r") as f:
-      spec = f.read()
-      
     for doc in docs:
-      if len(doc) > self.content_limit:        
-        json_str = json.dumps({"relevant": True, "reasoning": "The document is too long to process, but it might be relevant to you. Please review it yourself."})
-        annotated_docs.append(AnnotatedDoc(doc=doc, annotation=json_str))  
-        
-      user_prompt = user_prompt_template.format(document_content=doc, search_description=spec)
-      
-      messages: List[ChatCompletionMessageParam] = [
-        {"role": "system", "content": self.system_prompt}, 
-        {"role": "user", "content": user_prompt}
-      ]
-      
-      json_str = create_completion(self.cache, self.openai, messages, self.model)
-      annotated_docs.append(AnnotatedDoc(doc=doc, annotation=json_str))
+      chunks = self.split(doc)
+      json_strs = await asyncio.gather(*[
+        create_completion(self.cache, self.llm, request.messages, request.model)
+        for request in [self.request(chunk, spec_file) for chunk in chunks]
+      ])
+      json_str = json_strs[0] if len(chunks) == 1 else merge_verdicts([json.loads(s) for s in json_strs])
+      annotated_docs.append(AnnotatedDoc(
+        doc=doc, annotation=json_str, tokens=count_tokens(doc, self.model), chunks=len(chunks)))
+
+    return annotated_docs
 
+  async def apply_packed(self, docs: List[str], spec_file: str) -> List[AnnotatedDoc]:
+    """Judges a pack of documents in one request, so the system prompt is sent once for all of
+    them. If the response doesn't have a valid verdict for each document, they are judged one
+    by one instead.
+
+    Each verdict is also cached as the response to its document's own request, so the document
+    is a cache hit wherever it turns up again, whatever it's packed with."""
+    if len(docs) == 1:
+      return await self.apply(docs, spec_file)
+
+    request = self.pack_request(docs, spec_file)
+    try:
+      json_str = await create_completion(self.cache, self.llm, request.messages, request.model, request.validate)
+    except ValueError as e:
+      logger.warning("Falling back to one request per document for a pack of %d: %s", len(docs), e)
+      annotated = await asyncio.gather(*[self.apply([doc], spec_file) for doc in docs])
+      return [annotated_docs[0] for annotated_docs in annotated]
+
+    annotated_docs = []
+    for doc, verdict in zip(docs, json.loads(json_str)):
+      annotation = json.dumps({key: value for key, value in verdict.items() if key != "index"})
+      doc_request = self.request(doc, spec_file)
+      await self.llm.db(self.cache.insert_llm_response, json.dumps(doc_request.messages), doc_request.model, annotation)
+      annotated_docs.append(AnnotatedDoc(
+        doc=doc, annotation=annotation, tokens=count_tokens(doc, self.model), pack_size=len(docs)))
     return annotated_docs
 
+  async def apply_multi(self, doc: str, spec_files: Dict[str, str]) -> Dict[str, AnnotatedDoc]:
+    """Judges one document against several specs in a single request, so the system prompt
+    and the document are only sent once. Returns an annotation per spec name."""
+    chunks = self.split(doc)
+    json_strs = await asyncio.gather(*[
+      create_completion(self.cache, self.llm, request.messages, request.model, request.validate)
+      for request in [self.multi_request(chunk, spec_files) for chunk in chunks]
+    ])
+    annotations = [json.loads(json_str) for json_str in json_strs]
+    tokens = count_tokens(doc, self.model)
+    return {
+      spec_name: AnnotatedDoc(
+        doc=doc,
+        annotation=json.dumps(annotations[0][spec_name]) if len(chunks) == 1 else merge_verdicts([a[spec_name] for a in annotations]),
+        tokens=tokens,
+        chunks=len(chunks),
+      )
+      for spec_name in spec_files
+    }
+
   @staticmethod
-  def from_env(relevance: Relevance):
-      openai = OpenAI()
-      cache = DbResponseCache.from_env()
-      return FilterSpec(openai, cache, relevance)
+  def from_executor(llm: LlmExecutor, relevance: Relevance, confidence: bool = False):
+      return FilterSpec(llm, llm.cache, relevance, confidence)
+
+
+def merge_verdicts(verdicts: List[Dict[str, Any]]) -> str:
+  """Reduces the verdicts on a document's chunks to one: relevant if any chunk is, with the
+  reasoning of the chunks that decided it, and the highest confidence among them."""
+  relevant = any(verdict["relevant"] for verdict in verdicts)
+  deciding = [(i, verdict) for i, verdict in enumerate(verdicts, start=1) if bool(verdict["relevant"]) == relevant]
+  merged: Dict[str, Any] = {
+    "relevant": relevant,
+    "reasoning": " ".join(f"Part {i} of {len(verdicts)}: {verdict['reasoning']}" for i, verdict in deciding),
+  }
+  confidences = [verdict["confidence"] for _, verdict in deciding if isinstance(verdict.get("confidence"), (int, float))]
+  if confidences:
+    merged["confidence"] = max(confidences)
+  return json.dumps(merged)
+
+
+def parse_cached_verdicts(request_str: str, response: str, spec_texts: Dict[str, str]) -> List[Tuple[Relevance, str, str, bool]]:
+  """Recovers (relevance, spec name, document, relevant) verdicts from a cached filter spec
+  request and its response. `spec_texts` maps spec names to their descriptions, which is how
+  single-spec requests are matched to a spec. Requests for anything else give no verdicts."""
+  messages = json.loads(request_str)
+  if len(messages) != 2 or messages[0].get("role") != "system":
+    return []
+  system_prompt, user_prompt = messages[0]["content"], messages[1]["content"]
+  templates = {
+    system_prompt_template_maybe_relevant: Relevance.MAYBE_RELEVANT,
+    system_prompt_template_highly_relevant: Relevance.HIGHLY_RELEVANT,
+  }
+  multi_spec = system_prompt.endswith(multi_spec_prompt_suffix)
+  system_prompt = system_prompt.removesuffix(multi_spec_prompt_suffix).removesuffix(confidence_prompt_suffix)
+  relevance = templates.get(system_prompt)
+  if relevance is None:
+    return []
+
+  descriptions, separator, document = user_prompt.partition("\n\nDOCUMENT CONTENT:\n")
+  if not separator:
+    return []
+  document = document[:-1] if document.endswith("\n") else document
+  try:
+    verdicts = json.loads(extract_json(response))
+  except ValueError:
+    return []
+
+  if multi_spec:
+    spec_names = re.findall(r"^SEARCH DESCRIPTION \((.+)\):$", descriptions, re.MULTILINE)
+    return [
+      (relevance, spec_name, document, bool(verdicts[spec_name]["relevant"]))
+      for spec_name in spec_names
+      if isinstance(verdicts.get(spec_name), dict) and "relevant" in verdicts[spec_name]
+    ]
+
+  description = descriptions.removeprefix("\nSEARCH DESCRIPTION:\n")
+  spec_name = next((name for name, text in spec_texts.items() if text == description), None)
+  if spec_name is None or "relevant" not in verdicts:
+    return []
+  return [(relevance, spec_name, document, bool(verdicts["relevant"]))]
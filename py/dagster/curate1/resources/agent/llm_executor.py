@@ -0,0 +1,196 @@
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletionMessageParam
+
+from ..llm_response_cache.llm_response_cache import (DbResponseCache,
+                                                     LlmResponseCache)
+from .telemetry import CallRecorder, Completion
+
+T = TypeVar("T")
+
+# tokens a response is assumed to take until the API reports what it actually used
+COMPLETION_TOKENS_ESTIMATE = 400
+
+DEFAULT_REQUESTS_PER_MINUTE = {"gpt-4o": 500, "gpt-3.5-turbo": 3500}
+DEFAULT_TOKENS_PER_MINUTE = {"gpt-4o": 30000, "gpt-3.5-turbo": 60000}
+
+# for models missing from the limits above
+FALLBACK_REQUESTS_PER_MINUTE = 500
+FALLBACK_TOKENS_PER_MINUTE = 30000
+
+
+@lru_cache(maxsize=None)
+def read_prompt_file(path: str) -> str:
+  """Prompt files are read once per process."""
+  with open(path, "r") as f:
+    return f.read()
+
+
+def estimate_tokens(messages: List[ChatCompletionMessageParam]) -> int:
+  return len(json.dumps(messages)) // 4 + COMPLETION_TOKENS_ESTIMATE
+
+
+class TokenBucket:
+  """Allows `per_minute` units a minute, refilled continuously, with bursts of up to a
+  minute's worth. Only used from the executor's event loop, so needs no locking."""
+
+  def __init__(self, per_minute: int):
+    self.per_minute = per_minute
+    self.level = float(per_minute)
+    self.updated = time.monotonic()
+
+  def _refill(self):
+    now = time.monotonic()
+    self.level = min(self.per_minute, self.level + (now - self.updated) * self.per_minute / 60)
+    self.updated = now
+
+  async def acquire(self, amount: int):
+    amount = min(amount, self.per_minute)
+    while True:
+      self._refill()
+      if self.level >= amount:
+        self.level -= amount
+        return
+      await asyncio.sleep((amount - self.level) * 60 / self.per_minute)
+
+  def adjust(self, amount: int):
+    """Takes `amount` more, or gives it back if negative, once the real usage is known."""
+    self._refill()
+    self.level -= amount
+
+
+class LlmExecutor:
+  """Runs every LLM request of the process on one event loop, over one pooled async client.
+
+  Requests are admitted by per-model requests-per-minute and tokens-per-minute buckets, so
+  concurrency adapts to the rate limits rather than to a fixed number of threads, and every
+  asset running in the process shares the same limits. The response cache and the recorder of
+  call metrics are opened once, on a database thread of their own, and every call to them goes
+  through `db`, so their sqlite reads and writes never hold up the loop.
+  """
+
+  _shared: Optional["LlmExecutor"] = None
+  _shared_lock = threading.Lock()
+
+  def __init__(self, requests_per_minute: Dict[str, int], tokens_per_minute: Dict[str, int], max_in_flight: int):
+    self.requests_per_minute = requests_per_minute
+    self.tokens_per_minute = tokens_per_minute
+    self.max_in_flight = max_in_flight
+    self.request_buckets: Dict[str, TokenBucket] = {}
+    self.token_buckets: Dict[str, TokenBucket] = {}
+
+    self.db_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm-executor-db")
+    self.cache: LlmResponseCache = self.db_thread.submit(DbResponseCache.from_env).result()
+    self.recorder = self.db_thread.submit(CallRecorder.from_env).result()
+
+    self._ready = threading.Event()
+    self.loop = asyncio.new_event_loop()
+    threading.Thread(target=self._run_loop, name="llm-executor", daemon=True).start()
+    self._ready.wait()
+
+  def _run_loop(self):
+    asyncio.set_event_loop(self.loop)
+    # requests are retried by `create_completion`, which counts them
+    self.openai = AsyncOpenAI(max_retries=0)
+    self.in_flight = asyncio.Semaphore(self.max_in_flight)
+    self._ready.set()
+    self.loop.run_forever()
+    self.loop.close()
+
+  @staticmethod
+  def shared(
+    requests_per_minute: Dict[str, int] = DEFAULT_REQUESTS_PER_MINUTE,
+    tokens_per_minute: Dict[str, int] = DEFAULT_TOKENS_PER_MINUTE,
+    max_in_flight: int = 64,
+  ) -> "LlmExecutor":
+    """The process's executor, created on first use. Later calls update its limits."""
+    with LlmExecutor._shared_lock:
+      executor = LlmExecutor._shared
+      if executor is None:
+        executor = LlmExecutor._shared = LlmExecutor(requests_per_minute, tokens_per_minute, max_in_flight)
+      else:
+        executor.loop.call_soon_threadsafe(executor._set_limits, requests_per_minute, tokens_per_minute)
+      return executor
+
+  @staticmethod
+  def reset_shared():
+    """Stops the process's executor, so the next one is created from the current environment,
+    with a new OpenAI client and response cache. For tests."""
+    with LlmExecutor._shared_lock:
+      executor = LlmExecutor._shared
+      LlmExecutor._shared = None
+    if executor is not None:
+      executor.close()
+
+  def close(self):
+    """Cancels the requests still running and waits for them to finish, closes the OpenAI
+    client, then stops the loop and closes the databases on their thread."""
+    asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+    self.loop.call_soon_threadsafe(self.loop.stop)
+    self.db_thread.submit(self._close_databases).result()
+    self.db_thread.shutdown()
+
+  async def _shutdown(self):
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await self.openai.close()
+
+  def _close_databases(self):
+    self.cache.close()
+    self.recorder.close()
+
+  def _set_limits(self, requests_per_minute: Dict[str, int], tokens_per_minute: Dict[str, int]):
+    self.requests_per_minute = requests_per_minute
+    self.tokens_per_minute = tokens_per_minute
+    for model, bucket in self.request_buckets.items():
+      bucket.per_minute = requests_per_minute.get(model, FALLBACK_REQUESTS_PER_MINUTE)
+    for model, bucket in self.token_buckets.items():
+      bucket.per_minute = tokens_per_minute.get(model, FALLBACK_TOKENS_PER_MINUTE)
+
+  def _buckets(self, model: str):
+    if model not in self.request_buckets:
+      self.request_buckets[model] = TokenBucket(self.requests_per_minute.get(model, FALLBACK_REQUESTS_PER_MINUTE))
+      self.token_buckets[model] = TokenBucket(self.tokens_per_minute.get(model, FALLBACK_TOKENS_PER_MINUTE))
+    return self.request_buckets[model], self.token_buckets[model]
+
+  async def db(self, fn: Callable[..., T], *args: Any) -> T:
+    """Calls `fn`, a method of the response cache or the recorder, on the database thread."""
+    return await self.loop.run_in_executor(self.db_thread, fn, *args)
+
+  async def complete(self, messages: List[ChatCompletionMessageParam], model: str) -> Completion:
+    """Sends one chat completion request once the model's rate limits allow it. Its latency
+    is the request's own, without the time spent waiting for the limits."""
+    request_bucket, token_bucket = self._buckets(model)
+    estimate = estimate_tokens(messages)
+    await request_bucket.acquire(1)
+    await token_bucket.acquire(estimate)
+    async with self.in_flight:
+      start = time.monotonic()
+      response = await self.openai.chat.completions.create(messages=messages, model=model)
+      latency = time.monotonic() - start
+    content = response.choices[0].message.content
+    if response.usage is None:
+      return Completion(content, estimate - COMPLETION_TOKENS_ESTIMATE, COMPLETION_TOKENS_ESTIMATE, latency)
+    token_bucket.adjust(response.usage.total_tokens - estimate)
+    return Completion(content, response.usage.prompt_tokens, response.usage.completion_tokens, latency)
+
+  def run(self, awaitable: Awaitable[T]) -> T:
+    """Runs `awaitable` on the executor's loop, blocking the calling thread until it's done."""
+    async def wrapper() -> T:
+      return await awaitable
+    return asyncio.run_coroutine_threadsafe(wrapper(), self.loop).result()
+
+  def run_all(self, awaitables: List[Awaitable[T]]) -> List[T]:
+    """Runs `awaitables` concurrently, returning their results in order."""
+    async def gather() -> List[Any]:
+      return list(await asyncio.gather(*awaitables))
+    return asyncio.run_coroutine_threadsafe(gather(), self.loop).result()
@@ -1,31 +1,193 @@
+import asyncio
 import json
+import logging
+import random
 import re
-from typing import List, Optional
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, List, Optional
 
-from openai import OpenAI
+import openai
 from openai.types.chat.chat_completion_message_param import \
     ChatCompletionMessageParam
 
 from ..llm_response_cache.llm_response_cache import LlmResponseCache
+from .llm_executor import LlmExecutor
+from .telemetry import CallMetric, Completion, estimate_cost
 
 
-def create_completion(cache: LlmResponseCache, openai: OpenAI, messages: List[ChatCompletionMessageParam], model: str) -> str:
-  request_str = json.dumps(messages)
-  
-  cached_response = cache.get_llm_response(request_str, model)
-  content = cached_response
-  if cached_response is None:
-    response = openai.chat.completions.create(
-      messages=messages,
-      model=model,
-    )
-    content = response.choices[0].message.content  
+@dataclass
+class LlmRequest:
+  """A request as sent to the model, with the check its response must pass to be cached."""
+  messages: List[ChatCompletionMessageParam]
+  model: str
+  validate: Optional[Callable[[Any], None]] = None
+
+
+# attempts at a valid response to one request per run, the first included
+MAX_ATTEMPTS = 3
+
+# resends of a request the API turned away or never answered, before the call fails
+MAX_RETRIES = 4
+# the first resend's delay, doubling with each one after, when the API doesn't say how long to wait
+RETRY_BASE_DELAY_SECONDS = 0.5
+MAX_RETRY_DELAY_SECONDS = 30
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+logger = logging.getLogger(__name__)
+
+reask_prompt_template = """
+Your response couldn't be used: {error}
+Please respond again with only the corrected json.
+"""
+
+
+async def create_completion(
+  cache: LlmResponseCache,
+  llm: LlmExecutor,
+  messages: List[ChatCompletionMessageParam],
+  model: str,
+  validate: Optional[Callable[[Any], None]] = None,
+) -> str:
+  """Returns the JSON in the model's response, caching the response once it has been validated.
   
-  json_str = '{}'
-  if content is None:
-    raise ValueError("No content in response")
+  `validate` is given the decoded JSON, and should raise if it isn't the expected shape.
+
+  Every response is stored as soon as it arrives, so none that were paid for are lost. Responses
+  stored by earlier runs are tried before the model is asked. If a response can't be used, the
+  model is shown the error and asked again, up to `MAX_ATTEMPTS` times. Requests turned away
+  by a rate limit or a server error are resent after the delay the API asks for, up to
+  `MAX_RETRIES` times.
+
+  Each call's tokens, latency, attempts, retries, cache hit, cost and any error are recorded by
+  the executor.
+  """
+  request_str = json.dumps(messages)
+  start = time.monotonic()
+  metric = CallMetric(
+    model=model, prompt_tokens=0, completion_tokens=0, latency_seconds=0, attempts=0, cache_hit=True, cost=0)
+  try:
+    return await _create_completion(cache, llm, messages, request_str, model, validate, metric)
+  except Exception as e:
+    metric.error = type(e).__name__
+    raise
+  finally:
+    if metric.cache_hit:
+      metric.latency_seconds = time.monotonic() - start
+    metric.cost = estimate_cost(model, metric.prompt_tokens, metric.completion_tokens)
+    # a batch already recorded the call that answered it
+    if not (metric.cache_hit and llm.recorder.claim_prepaid((request_str, model))):
+      await llm.db(llm.recorder.record, metric)
+
+
+async def _create_completion(
+  cache: LlmResponseCache,
+  llm: LlmExecutor,
+  messages: List[ChatCompletionMessageParam],
+  request_str: str,
+  model: str,
+  validate: Optional[Callable[[Any], None]],
+  metric: CallMetric,
+) -> str:
+  cached_response = await llm.db(cache.get_llm_response, request_str, model)
+  if cached_response is not None:
+    return parse_response(cached_response, validate)
+
+  for content in await llm.db(cache.get_raw_responses, request_str, model):
+    try:
+      json_str = parse_response(content, validate)
+    except ValueError:
+      continue
+    await llm.db(cache.insert_llm_response, request_str, model, content)
+    return json_str
 
-  # Check if content is wrapped in a markdown code block
+  metric.cache_hit = False
+  attempt_messages = list(messages)
+  error: Optional[ValueError] = None
+  for attempt in range(1, MAX_ATTEMPTS + 1):
+    completion = await complete_with_retries(llm, attempt_messages, model, metric)
+    metric.attempts = attempt
+    metric.prompt_tokens += completion.prompt_tokens
+    metric.completion_tokens += completion.completion_tokens
+    metric.latency_seconds += completion.latency_seconds
+    content = completion.content
+    try:
+      if content is None:
+        raise ValueError("No content in response")
+      await llm.db(cache.insert_raw_response, request_str, model, content)
+      json_str = parse_response(content, validate)
+    except ValueError as e:
+      error = e
+      logger.warning("Invalid response (attempt %d of %d): %s", attempt, MAX_ATTEMPTS, e)
+      attempt_messages = messages + [
+        {"role": "assistant", "content": content or ""},
+        {"role": "user", "content": reask_prompt_template.format(error=e)},
+      ]
+      continue
+
+    # Do this after we validate it.
+    await llm.db(cache.insert_llm_response, request_str, model, content)
+    return json_str
+
+  raise ValueError(f"No valid response after {MAX_ATTEMPTS} attempts: {error}")
+
+
+async def complete_with_retries(
+  llm: LlmExecutor,
+  messages: List[ChatCompletionMessageParam],
+  model: str,
+  metric: CallMetric,
+) -> Completion:
+  """The executor's completion of `messages`, counting each resend in `metric`."""
+  retry = 0
+  while True:
+    try:
+      return await llm.complete(messages, model)
+    except RETRYABLE_ERRORS as e:
+      if retry == MAX_RETRIES:
+        raise
+      delay = retry_delay_seconds(e, retry)
+      retry += 1
+      metric.retries += 1
+      logger.warning("%s, retrying in %.2fs (retry %d of %d)", type(e).__name__, delay, retry, MAX_RETRIES)
+      await asyncio.sleep(delay)
+
+
+def retry_delay_seconds(error: Exception, retry: int) -> float:
+  """As long as the API's response asks, or backing off exponentially, with jitter, if it doesn't."""
+  response = getattr(error, "response", None)
+  if response is not None:
+    for header, seconds_per_unit in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+      try:
+        return min(max(float(response.headers[header]) * seconds_per_unit, 0), MAX_RETRY_DELAY_SECONDS)
+      except (KeyError, ValueError):
+        pass
+  return min(RETRY_BASE_DELAY_SECONDS * 2 ** retry, MAX_RETRY_DELAY_SECONDS) * random.uniform(0.5, 1)
+
+
+def parse_response(content: str, validate: Optional[Callable[[Any], None]] = None) -> str:
+  json_str = extract_json(content)
+  if validate is not None:
+    validate(json.loads(json_str))
+  return json_str
+
+
+def repair_json(content: str) -> Optional[str]:
+  """Recovers the JSON from a response that has text around it or trailing commas, or None."""
+  starts = [i for i in (content.find("{"), content.find("[")) if i >= 0]
+  end = max(content.rfind("}"), content.rfind("]"))
+  if not starts or end < min(starts):
+    return None
+  json_str = re.sub(r",\s*([}\]])", r"\1", content[min(starts):end + 1])
+  try:
+    json.loads(json_str)
+  except json.JSONDecodeError:
+    return None
+  return json_str
+
+
+def extract_json(content: str) -> str:
+  """Returns the JSON in a model response, which may be wrapped in a markdown code block."""
   json_pattern = re.compile(r'^\s*```json\s*(.*?)\s*```', re.DOTALL)
   match = json_pattern.search(content)
   if match:
@@ -33,16 +195,17 @@ def create_completion(cache: LlmResponseCache, openai: OpenAI, messages: List[Ch
     try:
       json.loads(json_str)
     except json.JSONDecodeError:
-      raise ValueError(f"Failed to decode JSON in ```json block: {content}")
+      repaired = repair_json(json_str)
+      if repaired is None:
+        raise ValueError(f"Failed to decode JSON in ```json block: {content}")
+      json_str = repaired
   else:
     try:
       json.loads(content)
       json_str = content
     except json.JSONDecodeError:
-      raise ValueError(f"Failed to decode directly embedded JSON: {content}")
-
-  # Do this after we validate it.
-  if cached_response is None:
-    cache.insert_llm_response(request_str, model, content)
-
-  return json_str
\ No newline at end of file
+      repaired = repair_json(content)
+      if repaired is None:
+        raise ValueError(f"Failed to decode directly embedded JSON: {content}")
+      json_str = repaired
+  return json_str
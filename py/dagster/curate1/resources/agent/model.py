@@ -3,4 +3,9 @@ from pydantic import BaseModel
 
 class AnnotatedDoc(BaseModel):
   doc: str
-  annotation: str
\ No newline at end of file
+  annotation: str
+  # the document's length in tokens, and the number of chunks it was sent to the model in
+  tokens: int = 0
+  chunks: int = 1
+  # the number of documents judged in the same request as this one
+  pack_size: int = 1
@@ -1,12 +1,14 @@
+import asyncio
+import json
 from typing import List
 
-from openai import OpenAI
 from openai.types.chat import ChatCompletionMessageParam
 
-from ..llm_response_cache.llm_response_cache import (DbResponseCache,
-                                                     LlmResponseCache)
-from .middleware import create_completion
+from ..llm_response_cache.llm_response_cache import LlmResponseCache
+from .llm_executor import LlmExecutor
+from .middleware import LlmRequest, create_completion
 from .model import AnnotatedDoc
+from .tokens import count_tokens, split_tokens
 
 system_prompt_template = """
 You are a research assistant and your job is to summarize articles for me in a manner which emphasizes information relevant to my interests. 
@@ -75,24 +77,39 @@ DOCUMENT CONTENT:
 
 MODEL = "gpt-4o"
 
+# longer documents are summarized chunk by chunk, and then the chunks' summaries together
+DOCUMENT_TOKEN_LIMIT = 29000
+
 class PerspectiveSummarizer:
-  def __init__(self, openai: OpenAI, cache: LlmResponseCache):
-    self.openai = openai
+  def __init__(self, llm: LlmExecutor, cache: LlmResponseCache):
+    self.llm = llm
     self.cache = cache
 
-  def apply(self, contents: str, reasoning: str) -> AnnotatedDoc:
+  def request(self, contents: str, reasoning: str) -> LlmRequest:
     system_prompt = system_prompt_template
     user_prompt = user_prompt_template.format(document_content=contents, search_description=reasoning)
     messages: List[ChatCompletionMessageParam] = [
       {"role": "system", "content": system_prompt}, 
       {"role": "user", "content": user_prompt}
     ]
-    
-    json_str = create_completion(self.cache, self.openai, messages, MODEL)
-    return AnnotatedDoc(doc=contents, annotation=json_str)
+    return LlmRequest(messages=messages, model=MODEL)
+
+  def split(self, contents: str) -> List[str]:
+    return split_tokens(contents, DOCUMENT_TOKEN_LIMIT, MODEL)
+
+  async def apply(self, contents: str, reasoning: str) -> AnnotatedDoc:
+    chunks = self.split(contents)
+    json_strs = await asyncio.gather(*[
+      create_completion(self.cache, self.llm, request.messages, request.model)
+      for request in [self.request(chunk, reasoning) for chunk in chunks]
+    ])
+    json_str = json_strs[0]
+    if len(chunks) > 1:
+      summaries = "\n\n".join(json.loads(s)["summary"] for s in json_strs)
+      request = self.request(summaries, reasoning)
+      json_str = await create_completion(self.cache, self.llm, request.messages, request.model)
+    return AnnotatedDoc(doc=contents, annotation=json_str, tokens=count_tokens(contents, MODEL), chunks=len(chunks))
 
   @staticmethod
-  def from_env():
-      openai = OpenAI()
-      cache = DbResponseCache.from_env()
-      return PerspectiveSummarizer(openai, cache)
+  def from_executor(llm: LlmExecutor):
+      return PerspectiveSummarizer(llm, llm.cache)
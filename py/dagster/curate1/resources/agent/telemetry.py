@@ -0,0 +1,146 @@
+import math
+import os
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from ..database.database import Database
+
+# US dollars per million (prompt, completion) tokens
+PRICES_PER_MILLION_TOKENS = {"gpt-4o": (5.0, 15.0), "gpt-3.5-turbo": (0.5, 1.5)}
+
+# for models missing from the prices above
+FALLBACK_PRICES_PER_MILLION_TOKENS = (5.0, 15.0)
+
+
+@dataclass
+class Completion:
+  content: Optional[str]
+  prompt_tokens: int
+  completion_tokens: int
+  latency_seconds: float
+
+
+@dataclass
+class CallMetric:
+  """One call to `create_completion`, over all of its attempts."""
+  model: str
+  prompt_tokens: int
+  completion_tokens: int
+  latency_seconds: float
+  attempts: int
+  cache_hit: bool
+  cost: float
+  # the name of the exception the call failed with, if it did
+  error: Optional[str] = None
+  # requests resent after a rate limit, a server error or a dropped connection
+  retries: int = 0
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+  prompt_price, completion_price = PRICES_PER_MILLION_TOKENS.get(model, FALLBACK_PRICES_PER_MILLION_TOKENS)
+  return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+
+class CallRecorder:
+  """Stores the metrics of every call in the metrics table, and keeps those of this process in
+  memory while a caller has a `mark` open, so it can roll up the calls made since it took it.
+  Reading them with `since` closes the mark, and the metrics no open mark can ask for any more
+  are dropped, so a long-running process holds only those of the assets still measuring.
+
+  Requests answered by a batch are recorded as calls when the batch's responses arrive, and
+  marked `prepaid` by their (prompt, model) key, so that answering them from the cache
+  afterwards doesn't count as another call.
+  """
+
+  def __init__(self, database: Optional[Database]):
+    self.database = database
+    self.metrics: List[CallMetric] = []
+    # how many metrics were dropped from the front of `metrics`, so marks keep their positions
+    self.dropped = 0
+    # the positions of the open marks, by how many times each was taken
+    self.open_marks: Counter = Counter()
+    self.prepaid: Set[Tuple[str, str]] = set()
+    self.lock = threading.Lock()
+
+  def record(self, metric: CallMetric):
+    with self.lock:
+      if self.open_marks:
+        self.metrics.append(metric)
+    if self.database is not None:
+      self.database.insert_llm_call_metric(
+        metric.model, metric.prompt_tokens, metric.completion_tokens, metric.latency_seconds,
+        metric.attempts, metric.cache_hit, metric.cost)
+
+  @staticmethod
+  def from_env() -> "CallRecorder":
+    db_path = os.getenv('SQLITE_DATABASE_PATH')
+    if db_path is None:
+      raise ValueError("SQLITE_DATABASE_PATH environment variable is not set.")
+    database = Database(db_path=db_path)
+    database.create_tables()
+    return CallRecorder(database)
+
+  def close(self):
+    if self.database is not None:
+      self.database.close()
+
+  def prepay(self, keys: Iterable[Tuple[str, str]]):
+    with self.lock:
+      self.prepaid.update(keys)
+
+  def claim_prepaid(self, key: Tuple[str, str]) -> bool:
+    """Whether the request was prepaid, after which it no longer is."""
+    with self.lock:
+      if key not in self.prepaid:
+        return False
+      self.prepaid.remove(key)
+      return True
+
+  def forget_prepaid(self, keys: Iterable[Tuple[str, str]]):
+    """Drops the keys of prepaid requests that were never answered from the cache."""
+    with self.lock:
+      self.prepaid.difference_update(keys)
+
+  def mark(self) -> int:
+    with self.lock:
+      mark = self.dropped + len(self.metrics)
+      self.open_marks[mark] += 1
+      return mark
+
+  def since(self, mark: int) -> List[CallMetric]:
+    """The metrics recorded since `mark` was taken, after which the mark is closed."""
+    with self.lock:
+      metrics = self.metrics[mark - self.dropped:]
+      self.open_marks[mark] -= 1
+      if self.open_marks[mark] <= 0:
+        del self.open_marks[mark]
+      keep_from = min(self.open_marks, default=self.dropped + len(self.metrics))
+      del self.metrics[:keep_from - self.dropped]
+      self.dropped = keep_from
+      return metrics
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+  ranked = sorted(values)
+  return ranked[max(math.ceil(q * len(ranked)) - 1, 0)]
+
+
+def rollup(metrics: Sequence[CallMetric]) -> Dict[str, float]:
+  """Totals for asset metadata. Latencies are over the calls that weren't answered from the cache."""
+  sent = [m for m in metrics if not m.cache_hit]
+  latencies = [m.latency_seconds for m in sent]
+  return {
+    "LLM calls": len(metrics),
+    "LLM calls failed": sum(m.error is not None for m in metrics),
+    "LLM cache hits": len(metrics) - len(sent),
+    "LLM cache hit rate": (len(metrics) - len(sent)) / len(metrics) if metrics else 0,
+    "LLM re-asks": sum(m.attempts - 1 for m in sent),
+    "LLM retries": sum(m.retries for m in sent),
+    "LLM prompt tokens": sum(m.prompt_tokens for m in sent),
+    "LLM completion tokens": sum(m.completion_tokens for m in sent),
+    "LLM estimated cost (USD)": sum(m.cost for m in sent),
+    "LLM latency p50 (s)": percentile(latencies, 0.5) if latencies else 0,
+    "LLM latency p95 (s)": percentile(latencies, 0.95) if latencies else 0,
+  }
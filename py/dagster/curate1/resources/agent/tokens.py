@@ -0,0 +1,50 @@
+from functools import lru_cache
+from typing import List
+
+# characters per token assumed when no tokenizer is available; English prose averages about
+# four, so this overestimates, which keeps chunks within their budget
+FALLBACK_CHARS_PER_TOKEN = 3
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str):
+  try:
+    import tiktoken
+  except ImportError:
+    return None
+  try:
+    return tiktoken.encoding_for_model(model)
+  except Exception:
+    # an unknown model, or an encoding that couldn't be downloaded
+    return None
+
+
+def count_tokens(text: str, model: str) -> int:
+  encoding = _encoding(model)
+  if encoding is None:
+    return -(-len(text) // FALLBACK_CHARS_PER_TOKEN)
+  return len(encoding.encode(text, disallowed_special=()))
+
+
+def split_tokens(text: str, max_tokens: int, model: str) -> List[str]:
+  """Splits `text` into consecutive chunks of at most `max_tokens` tokens each."""
+  encoding = _encoding(model)
+  if encoding is not None:
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+      return [text]
+    return [encoding.decode(tokens[start:start + max_tokens]) for start in range(0, len(tokens), max_tokens)]
+
+  max_chars = max_tokens * FALLBACK_CHARS_PER_TOKEN
+  chunks = []
+  start = 0
+  while len(text) - start > max_chars:
+    end = start + max_chars
+    # break at whitespace, so words aren't split across chunks
+    space = max(text.rfind(" ", start, end), text.rfind("\n", start, end))
+    if space > start:
+      end = space
+    chunks.append(text[start:end])
+    start = end
+  chunks.append(text[start:])
+  return chunks
@@ -0,0 +1,102 @@
+import os
+from abc import ABC, abstractmethod
+from typing import Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from pydantic import BaseModel
+
+from ..database.database import Database
+
+# statuses of cached fetches
+STATUS_OK = "ok"
+# the page is gone, e.g. a 404 or 410; cached so dead links aren't retried on every run
+STATUS_DEAD = "dead"
+# the link isn't to an article page, e.g. a PDF or a video
+STATUS_SKIPPED = "skipped"
+
+
+class CachedArticle(BaseModel):
+  url: str
+  content: Optional[str]
+  status: str
+  etag: Optional[str]
+  last_modified: Optional[str]
+  fetched_at: float
+
+
+class ArticleContentCache(ABC):
+  @abstractmethod
+  def get_article(self, url: str) -> Optional[CachedArticle]:
+    pass
+
+  @abstractmethod
+  def put_article(self, article: CachedArticle):
+    pass
+
+class DbArticleContentCache(ArticleContentCache):
+  def __init__(self, database: Database):
+    self.database = database
+
+  def get_article(self, url: str) -> Optional[CachedArticle]:
+    row = self.database.get_article_content(url)
+    if row is None:
+      return None
+    url, content, status, etag, last_modified, fetched_at = row
+    return CachedArticle(
+      url=url, content=content, status=status, etag=etag, last_modified=last_modified, fetched_at=fetched_at)
+
+  def put_article(self, article: CachedArticle):
+    self.database.upsert_article_content(
+      article.url, article.content, article.status, article.etag, article.last_modified, article.fetched_at)
+
+  @staticmethod
+  def from_env() -> ArticleContentCache:
+    db_path = os.getenv('SQLITE_DATABASE_PATH')
+    if db_path is None:
+        raise ValueError("SQLITE_DATABASE_PATH environment variable is not set.")
+    database=Database(db_path=db_path)
+    database.create_tables()
+    return DbArticleContentCache(database)
+
+
+# query parameters that only track where a click came from
+TRACKING_PARAMS = {
+  "fbclid", "gclid", "dclid", "msclkid", "yclid", "igshid", "mc_cid", "mc_eid",
+  "_hsenc", "_hsmi", "ref", "ref_src", "ref_url", "si",
+}
+
+# code hosts where `ref` names a branch or tag rather than a referrer
+REF_HOSTS = {"github.com", "gitlab.com", "bitbucket.org"}
+
+def canonicalize_url(url: str) -> str:
+  """Normalizes a URL so that reposts of the same article under different variants share a key.
+
+  http and https, a www. prefix, default ports, fragments, trailing slashes, tracking parameters
+  and query parameter order are all ignored. Fragments starting with / or ! are kept, since
+  single page apps route on them, and so is `ref` on code hosts, where it names a branch. A URL
+  that can't be parsed, like one with a malformed port, is returned as it is.
+  """
+  try:
+    parts = urlsplit(url.strip())
+    port = parts.port
+  except ValueError:
+    return url
+  host = (parts.hostname or "").lower()
+  if host.startswith("www."):
+    host = host[len("www."):]
+  if port is not None and port not in (80, 443):
+    host = f"{host}:{port}"
+
+  path = parts.path.rstrip("/") or "/"
+  query = urlencode(sorted(
+    (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+    if not _is_tracking_param(key.lower(), host)
+  ))
+  fragment = parts.fragment if parts.fragment.startswith(("/", "!")) else ""
+  return urlunsplit(("https", host, path, query, fragment))
+
+
+def _is_tracking_param(key: str, host: str) -> bool:
+  if key == "ref" and (host in REF_HOSTS or host.endswith(tuple("." + h for h in REF_HOSTS))):
+    return False
+  return key in TRACKING_PARAMS or key.startswith("utm_")
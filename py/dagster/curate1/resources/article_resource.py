@@ -1,10 +1,33 @@
+import asyncio
+import email.utils
+import logging
+import math
+import os
+import time
 from abc import ABC, abstractmethod
-from concurrent.futures import ThreadPoolExecutor
-from typing import List, Optional
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
 
+import httpx
 import tenacity
 from dagster import ConfigurableResource
 from newspaper import Article
+from pydantic import BaseModel
+
+from .article_cache.article_cache import (STATUS_DEAD, STATUS_OK, STATUS_SKIPPED,
+                                          ArticleContentCache, CachedArticle,
+                                          DbArticleContentCache,
+                                          canonicalize_url)
+
+logger = logging.getLogger(__name__)
+
+
+class ArticleBatch(BaseModel):
+    contents: List[Optional[str]]
+    metadata: Dict[str, Any] = {}
 
 
 class ArticleClient(ConfigurableResource, ABC):
@@ -12,6 +35,10 @@ class ArticleClient(ConfigurableResource, ABC):
     def fetch_article_content_batch(self, urls: List[str]) -> List[Optional[str]]:
         pass
 
+    def fetch_article_batch(self, urls: List[str]) -> ArticleBatch:
+        """Like `fetch_article_content_batch`, along with metadata about how the batch went."""
+        return ArticleBatch(contents=self.fetch_article_content_batch(urls))
+
 
 class WebArticleClient(ArticleClient):
     def fetch_article_content_batch(self, urls: List[str]) -> List[Optional[str]]:
@@ -24,24 +51,446 @@ retry_strategy = (
 @tenacity.retry(retry=retry_strategy, wait=tenacity.wait_exponential(multiplier=2), stop=tenacity.stop_after_attempt(5))
 def fetch_article_content(url):
     try:
-        print(f"Fetching content for {url}")
+        logger.info("Fetching content for %s", url)
         article = Article(url)
         article.download()
         article.parse()
-        print(f"Got content for {url}, length {len(article.text)}")
+        logger.info("Got content for %s, length %d", url, len(article.text))
         return article.text
     except Exception as e:
-        print(f"Error fetching content for {url}: {e}")
+        logger.warning("Error fetching content for %s: %s", url, e)
         raise
 
 def fetch_article_content_with_retry(url):
     try:
         return fetch_article_content(url)
     except Exception as e:
-        print(f"Error fetching content for {url}: {e}")
+        logger.warning("Error fetching content for %s: %s", url, e)
         return None
 
 def fetch_article_content_batch(urls, parallelism=10):
     with ThreadPoolExecutor(max_workers=parallelism) as executor:
         post_contents = list(executor.map(fetch_article_content_with_retry, urls))
     return post_contents
+
+
+RETRYABLE_STATUS_CODES = {429, 503}
+
+DEAD_LINK_STATUS_CODES = {404, 410, 451}
+
+USER_AGENT = "Mozilla/5.0 (compatible; curate1/0.1)"
+
+# links to these are never articles, so they're skipped without a request
+SKIPPED_EXTENSIONS = (
+    ".pdf", ".mp4", ".mov", ".avi", ".mkv", ".webm", ".mp3", ".wav", ".zip", ".tar", ".gz",
+    ".tgz", ".exe", ".dmg", ".iso", ".png", ".jpg", ".jpeg", ".gif",
+)
+
+TEXT_CONTENT_TYPES = ("text/html", "application/xhtml+xml", "text/plain")
+
+TIME_BUDGET_EXHAUSTED = "time budget exhausted"
+CIRCUIT_OPEN = "circuit open"
+# skips that say nothing about the page itself, so aren't cached
+TRANSIENT_SKIP_PREFIXES = (TIME_BUDGET_EXHAUSTED, CIRCUIT_OPEN)
+
+
+class SkipArticle(Exception):
+    """Raised to give up on an article without counting it as a failure of its host."""
+
+
+class CircuitBreaker:
+    """Stops requests to a host after `threshold` consecutive failures, letting one request
+    through again once `cooldown_seconds` have passed."""
+
+    def __init__(self, threshold: int, cooldown_seconds: float):
+        self.threshold = threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.time() - self.opened_at >= self.cooldown_seconds:
+            # half open: the next outcome decides whether it closes or opens again
+            self.opened_at = None
+            self.failures = self.threshold - 1
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.time()
+
+
+@dataclass
+class DownloadResult:
+    status_code: int
+    headers: httpx.Headers
+    text: str
+    size: int
+
+
+@dataclass
+class DownloadedArticle:
+    index: int
+    url: str
+    canonical_url: str
+    html: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+
+@dataclass
+class BatchStats:
+    cache_hits: int = 0
+    revalidated: int = 0
+    downloads: int = 0
+    download_bytes: int = 0
+    download_end: float = 0
+    parsed: int = 0
+    parse_cpu_seconds: float = 0
+    parse_start: Optional[float] = None
+    parse_end: float = 0
+    skipped: Dict[str, str] = field(default_factory=dict)
+    failed: Dict[str, str] = field(default_factory=dict)
+
+    def metadata(self, start: float) -> Dict[str, Any]:
+        download_seconds = max(self.download_end - start, 0)
+        parse_seconds = max(self.parse_end - (self.parse_start or self.parse_end), 0)
+        return {
+            "Cache hits": self.cache_hits,
+            "Revalidated unchanged": self.revalidated,
+            "Downloads": self.downloads,
+            "Download MB": round(self.download_bytes / 1e6, 2),
+            "Download seconds": round(download_seconds, 2),
+            "Downloads per second": round(self.downloads / download_seconds, 2) if download_seconds else 0,
+            "Parsed": self.parsed,
+            "Parse seconds": round(parse_seconds, 2),
+            "Parse CPU seconds": round(self.parse_cpu_seconds, 2),
+            "Parses per second": round(self.parsed / parse_seconds, 2) if parse_seconds else 0,
+            "Batch seconds": round(time.time() - start, 2),
+            "Skipped": len(self.skipped),
+            "Skipped URLs": self.skipped,
+            "Failed": len(self.failed),
+            "Failed URLs": self.failed,
+        }
+
+
+class AsyncWebArticleClient(ArticleClient):
+    """Downloads articles over pooled keep-alive connections with an async HTTP client.
+
+    At most `max_concurrency` downloads run at once, and at most `max_per_host` against any one
+    host, so a burst of links to one site doesn't get us rate limited. 429 and 503 responses are
+    retried after the delay the server asks for in Retry-After, and otherwise with exponential
+    backoff.
+
+    A batch gives up on whatever it hasn't finished once `time_budget_seconds` have passed, and
+    stops sending requests to a host for `breaker_cooldown_seconds` after
+    `breaker_failure_threshold` consecutive failures. Links to files, responses that aren't
+    HTML or text, and pages over `max_download_bytes` are skipped. Skipped URLs are reported
+    with the reason in the batch metadata.
+
+    Downloaded pages are handed over a bounded queue to an extraction stage, which parses them on
+    a process pool sized to the machine's cores, since parsing is CPU bound and would otherwise
+    serialize on the GIL. While the queue is full, no new downloads start.
+
+    Extracted text is cached by canonical URL. Cached articles younger than
+    `revalidate_after_seconds` are used without any request; older ones are revalidated with a
+    conditional request, and only reparsed if they changed. Dead links and skipped pages are
+    cached for `dead_link_ttl_seconds`.
+    """
+
+    max_concurrency: int = 32
+    max_per_host: int = 2
+    max_attempts: int = 4
+    max_retry_delay_seconds: float = 60
+    timeout_seconds: float = 20
+    time_budget_seconds: Optional[float] = 15 * 60
+    breaker_failure_threshold: int = 3
+    breaker_cooldown_seconds: float = 5 * 60
+    max_download_bytes: int = 5_000_000
+    use_cache: bool = True
+    revalidate_after_seconds: int = 7 * 24 * 60 * 60
+    dead_link_ttl_seconds: int = 24 * 60 * 60
+    extraction_workers: Optional[int] = None
+    extraction_queue_size: int = 64
+
+    def fetch_article_content_batch(self, urls: List[str]) -> List[Optional[str]]:
+        return self.fetch_article_batch(urls).contents
+
+    def fetch_article_batch(self, urls: List[str]) -> ArticleBatch:
+        cache = DbArticleContentCache.from_env() if self.use_cache else None
+        workers = self.extraction_workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as extraction_pool:
+            return asyncio.run(self._fetch_batch(urls, cache, extraction_pool, workers))
+
+    async def _fetch_batch(
+        self,
+        urls: List[str],
+        cache: Optional[ArticleContentCache],
+        extraction_pool: ProcessPoolExecutor,
+        workers: int,
+    ) -> ArticleBatch:
+        start = time.time()
+        deadline = start + self.time_budget_seconds if self.time_budget_seconds else math.inf
+        stats = BatchStats()
+        results: List[Optional[str]] = [None] * len(urls)
+        queue: asyncio.Queue[Optional[DownloadedArticle]] = asyncio.Queue(
+            maxsize=self.extraction_queue_size
+        )
+
+        global_limit = asyncio.Semaphore(self.max_concurrency)
+        buffer_limit = asyncio.Semaphore(self.max_concurrency)
+        host_limits: Dict[str, asyncio.Semaphore] = defaultdict(
+            lambda: asyncio.Semaphore(self.max_per_host)
+        )
+        breakers: Dict[str, CircuitBreaker] = defaultdict(
+            lambda: CircuitBreaker(self.breaker_failure_threshold, self.breaker_cooldown_seconds)
+        )
+        limits = httpx.Limits(
+            max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency
+        )
+        async with httpx.AsyncClient(
+            limits=limits,
+            timeout=self.timeout_seconds,
+            follow_redirects=True,
+            headers={"User-Agent": USER_AGENT},
+        ) as client:
+
+            async def download(index: int, url: str):
+                host = urlsplit(url).hostname or ""
+                try:
+                    # held until the page is queued, so that pages waiting on a full queue
+                    # hold up new downloads instead of piling up in memory
+                    async with buffer_limit:
+                        downloaded = await self._download_article(
+                            client, index, url, cache, results, stats, deadline,
+                            global_limit, host_limits[host], breakers[host],
+                        )
+                        if downloaded is not None:
+                            await queue.put(downloaded)
+                except SkipArticle as e:
+                    logger.info("Skipped %s: %s", url, e)
+                    stats.skipped[url] = str(e)
+                except Exception as e:
+                    logger.warning("Error fetching content for %s: %s", url, e)
+                    stats.failed[url] = str(e) or type(e).__name__
+
+            async def extract():
+                loop = asyncio.get_running_loop()
+                while (article := await queue.get()) is not None:
+                    if time.time() >= deadline:
+                        stats.skipped[article.url] = "time budget exhausted before parsing"
+                        continue
+                    stats.parse_start = stats.parse_start or time.time()
+                    try:
+                        text, cpu_seconds = await loop.run_in_executor(
+                            extraction_pool, extract_article_text_timed, article.url, article.html
+                        )
+                    except Exception as e:
+                        logger.warning("Error extracting content for %s: %s", article.url, e)
+                        stats.failed[article.url] = f"extraction failed: {e}"
+                        continue
+                    finally:
+                        stats.parse_end = time.time()
+                    logger.info("Got content for %s, length %d", article.url, len(text))
+                    stats.parsed += 1
+                    stats.parse_cpu_seconds += cpu_seconds
+                    results[article.index] = text
+                    if cache is not None:
+                        cache.put_article(CachedArticle(
+                            url=article.canonical_url, content=text, status=STATUS_OK,
+                            etag=article.etag, last_modified=article.last_modified,
+                            fetched_at=time.time()))
+
+            extractors = [asyncio.create_task(extract()) for _ in range(workers)]
+            await asyncio.gather(*(download(index, url) for index, url in enumerate(urls)))
+            for _ in extractors:
+                await queue.put(None)
+            await asyncio.gather(*extractors)
+
+        return ArticleBatch(contents=results, metadata=stats.metadata(start))
+
+    async def _download_article(
+        self,
+        client: httpx.AsyncClient,
+        index: int,
+        url: str,
+        cache: Optional[ArticleContentCache],
+        results: List[Optional[str]],
+        stats: BatchStats,
+        deadline: float,
+        global_limit: asyncio.Semaphore,
+        host_limit: asyncio.Semaphore,
+        breaker: CircuitBreaker,
+    ) -> Optional[DownloadedArticle]:
+        """Downloads `url` unless the cache can answer for it, in which case its result is filled
+        in directly and nothing is returned."""
+        canonical_url = canonicalize_url(url)
+        cached = cache.get_article(canonical_url) if cache is not None else None
+        now = time.time()
+
+        headers = {}
+        if cached is not None:
+            ttl = self.revalidate_after_seconds if cached.status == STATUS_OK else self.dead_link_ttl_seconds
+            if now - cached.fetched_at < ttl:
+                stats.cache_hits += 1
+                results[index] = cached.content
+                return None
+            if cached.status == STATUS_OK:
+                if cached.etag:
+                    headers["If-None-Match"] = cached.etag
+                if cached.last_modified:
+                    headers["If-Modified-Since"] = cached.last_modified
+
+        try:
+            if urlsplit(url).path.lower().endswith(SKIPPED_EXTENSIONS):
+                raise SkipArticle("links to a file")
+            response = await self._download(
+                client, url, headers, deadline, global_limit, host_limit, breaker
+            )
+        except SkipArticle as e:
+            if cache is not None and not str(e).startswith(TRANSIENT_SKIP_PREFIXES):
+                cache.put_article(CachedArticle(
+                    url=canonical_url, content=None, status=STATUS_SKIPPED,
+                    etag=None, last_modified=None, fetched_at=now))
+            raise
+        stats.downloads += 1
+        stats.download_bytes += response.size
+        stats.download_end = time.time()
+
+        if response.status_code == 304 and cached is not None:
+            logger.info("Content unchanged for %s", url)
+            stats.revalidated += 1
+            cached.fetched_at = now
+            cache.put_article(cached)
+            results[index] = cached.content
+            return None
+
+        if response.status_code in DEAD_LINK_STATUS_CODES:
+            if cache is not None:
+                cache.put_article(CachedArticle(
+                    url=canonical_url, content=None, status=STATUS_DEAD,
+                    etag=None, last_modified=None, fetched_at=now))
+        if response.status_code != 200:
+            raise ValueError(f"HTTP {response.status_code}")
+
+        return DownloadedArticle(
+            index=index,
+            url=url,
+            canonical_url=canonical_url,
+            html=response.text,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+        )
+
+    async def _download(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        headers: Dict[str, str],
+        deadline: float,
+        global_limit: asyncio.Semaphore,
+        host_limit: asyncio.Semaphore,
+        breaker: CircuitBreaker,
+    ) -> DownloadResult:
+        for attempt in range(self.max_attempts):
+            async with host_limit, global_limit:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise SkipArticle(f"{TIME_BUDGET_EXHAUSTED} before downloading")
+                if not breaker.allow():
+                    raise SkipArticle(f"{CIRCUIT_OPEN} for {urlsplit(url).hostname}")
+                try:
+                    response = await self._read(client, url, headers, min(self.timeout_seconds, remaining))
+                except httpx.TimeoutException:
+                    if remaining < self.timeout_seconds:
+                        # cut short by the time budget, which says nothing about the host
+                        raise SkipArticle(f"{TIME_BUDGET_EXHAUSTED} while downloading")
+                    breaker.record_failure()
+                    raise
+                except httpx.TransportError:
+                    breaker.record_failure()
+                    raise
+            if response.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+
+            if response.status_code not in RETRYABLE_STATUS_CODES or attempt == self.max_attempts - 1:
+                break
+            # wait without holding a slot, so other hosts can use it in the meantime
+            delay = min(
+                retry_after_seconds(response.headers) or 2 ** attempt, self.max_retry_delay_seconds
+            )
+            if time.time() + delay >= deadline:
+                raise SkipArticle(f"{TIME_BUDGET_EXHAUSTED} waiting to retry")
+            await asyncio.sleep(delay)
+        return response
+
+    async def _read(
+        self, client: httpx.AsyncClient, url: str, headers: Dict[str, str], timeout: float
+    ) -> DownloadResult:
+        """Streams the response, giving up as soon as it's clearly not an article page."""
+        async with client.stream("GET", url, headers=headers, timeout=timeout) as response:
+            if response.status_code != 200:
+                return DownloadResult(response.status_code, response.headers, "", 0)
+
+            content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+            if content_type and not content_type.startswith(TEXT_CONTENT_TYPES):
+                raise SkipArticle(f"content type {content_type}")
+            content_length = response.headers.get("Content-Length", "")
+            if content_length.isdigit() and int(content_length) > self.max_download_bytes:
+                raise SkipArticle(f"too large ({content_length} bytes)")
+
+            body = bytearray()
+            async for chunk in response.aiter_bytes():
+                if not body and looks_binary(chunk):
+                    raise SkipArticle("binary content")
+                body += chunk
+                if len(body) > self.max_download_bytes:
+                    raise SkipArticle(f"too large (over {self.max_download_bytes} bytes)")
+
+            text = bytes(body).decode(response.encoding or "utf-8", errors="replace")
+            return DownloadResult(response.status_code, response.headers, text, len(body))
+
+
+def looks_binary(chunk: bytes) -> bool:
+    head = chunk[:1024]
+    return head.startswith(b"%PDF") or b"\x00" in head
+
+
+def retry_after_seconds(headers: httpx.Headers) -> Optional[float]:
+    """The delay requested by a Retry-After header, given either in seconds or as an HTTP date."""
+    retry_after = headers.get("Retry-After")
+    if retry_after is None:
+        return None
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0)
+
+
+def extract_article_text(url: str, html: str) -> str:
+    article = Article(url)
+    article.download(input_html=html)
+    article.parse()
+    return article.text
+
+
+def extract_article_text_timed(url: str, html: str) -> Tuple[str, float]:
+    """Runs in the extraction pool's worker processes, so it also reports the CPU time it used."""
+    start = time.process_time()
+    text = extract_article_text(url, html)
+    return text, time.process_time() - start
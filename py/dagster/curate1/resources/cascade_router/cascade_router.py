@@ -0,0 +1,167 @@
+import json
+import os
+import zlib
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from dagster import ConfigurableResource, InitResourceContext
+from pydantic import BaseModel
+
+from ..agent.filter_spec import system_prompt_template_highly_relevant
+from ..agent.tokens import count_tokens
+from ..database.database import Database
+from ..semantic_prefilter.semantic_prefilter import AUDIT_BUCKETS, read_spec
+
+ACCEPT = "accepted"
+ESCALATE = "escalated"
+REJECT = "rejected"
+# would have been accepted or rejected, but escalated to check the calibration
+AUDIT = "audited"
+
+ESCALATION_MODEL = "gpt-4o"
+
+# US dollars per million input tokens
+INPUT_PRICE_PER_MILLION_TOKENS = {"gpt-4o": 5.0, "gpt-3.5-turbo": 0.5}
+
+# stated probabilities are calibrated in bins of this many
+CALIBRATION_BINS = 10
+
+# a bin is calibrated from history once this many of its documents have been escalated
+MIN_BIN_SAMPLES = 20
+
+
+def stated_probability(verdict: Dict[str, Any]) -> Optional[float]:
+    """The cheap model's probability that the document is relevant, from its verdict and its
+    confidence in it, or None for verdicts without a confidence."""
+    confidence = verdict.get("confidence")
+    if isinstance(confidence, bool) or not isinstance(confidence, (int, float)):
+        return None
+    confidence = min(max(float(confidence), 0.0), 1.0)
+    return confidence if verdict.get("relevant") else 1 - confidence
+
+
+def _bin(probability: float) -> int:
+    return min(int(probability * CALIBRATION_BINS), CALIBRATION_BINS - 1)
+
+
+class Calibration(BaseModel):
+    """Maps the cheap model's stated probabilities to the rate at which the expensive model went
+    on to find such documents highly relevant, in the bins with enough history."""
+
+    rates: List[Optional[float]]
+    samples: int
+
+    def calibrate(self, probability: float) -> float:
+        rate = self.rates[_bin(probability)]
+        return probability if rate is None else rate
+
+
+def fit_calibration(history: Sequence[Tuple[float, bool]]) -> Calibration:
+    """Fits a calibration to (stated probability, highly relevant) pairs, smoothing each bin's
+    rate towards a half."""
+    counts = [0] * CALIBRATION_BINS
+    hits = [0] * CALIBRATION_BINS
+    for probability, highly_relevant in history:
+        counts[_bin(probability)] += 1
+        hits[_bin(probability)] += highly_relevant
+    return Calibration(
+        rates=[(h + 1) / (n + 2) if n >= MIN_BIN_SAMPLES else None for h, n in zip(hits, counts)],
+        samples=len(history),
+    )
+
+
+def escalation_cost(spec_name: str, documents: Sequence[str]) -> float:
+    """What judging `documents` with the expensive model would cost in input tokens, in US dollars."""
+    prompt_tokens = count_tokens(system_prompt_template_highly_relevant + read_spec(spec_name), ESCALATION_MODEL)
+    tokens = sum(prompt_tokens + count_tokens(document, ESCALATION_MODEL) for document in documents)
+    return tokens * INPUT_PRICE_PER_MILLION_TOKENS[ESCALATION_MODEL] / 1_000_000
+
+
+class CascadeRouter(ConfigurableResource):
+    """Decides which of the cheap model's verdicts need the expensive model.
+
+    The cheap model's confidence is calibrated against how the expensive model judged earlier
+    documents. Documents whose calibrated probability of being highly relevant is at least the
+    spec's accept threshold are accepted without asking the expensive model, those at most its
+    reject threshold are rejected, and the rest are escalated. Verdicts without a confidence are
+    escalated if relevant and rejected otherwise.
+
+    Only escalated documents are judged by the expensive model, so an `audit_rate` share of the
+    documents that would be accepted or rejected, picked by a hash of their text, are escalated
+    too. Their verdicts are an unbiased sample of those bins, so a bin calibrated too high or
+    too low is corrected once enough of its audited documents have been judged.
+
+    The cheap model is only asked for its confidence with `request_confidence`. That changes its
+    prompt, so turning it on means its cached responses are all asked for again; until then
+    every verdict goes the way of those without a confidence.
+    """
+
+    request_confidence: bool = False
+
+    accept_thresholds: Dict[str, float] = {}
+    reject_thresholds: Dict[str, float] = {}
+    default_accept_threshold: float = 0.95
+    default_reject_threshold: float = 0.2
+    history_limit: int = 2000
+    audit_rate: float = 0.05
+    _database: Optional[Database] = None
+
+    def _get_database(self) -> Database:
+        if self._database is None:
+            db_path = os.getenv('SQLITE_DATABASE_PATH')
+            if db_path is None:
+                raise ValueError("SQLITE_DATABASE_PATH environment variable is not set.")
+            database = Database(db_path=db_path)
+            database.create_tables()
+            self._database = database
+        return self._database
+
+    def teardown_after_execution(self, context: InitResourceContext) -> None:
+        if self._database is not None:
+            self._database.close()
+            self._database = None
+
+    def thresholds(self, spec_name: str) -> Tuple[float, float]:
+        return (
+            self.accept_thresholds.get(spec_name, self.default_accept_threshold),
+            self.reject_thresholds.get(spec_name, self.default_reject_threshold),
+        )
+
+    def calibration(self, spec_name: str) -> Calibration:
+        """Fitted to the most recent `history_limit` documents the expensive model judged for the
+        spec, whether escalated as uncertain or audited."""
+        rows = self._get_database().get_escalated_verdicts(
+            f"filter_spec_{spec_name}_maybe_relevant", f"filter_spec_{spec_name}_highly_relevant", self.history_limit)
+
+        history = []
+        for maybe_value, highly_value in rows:
+            maybe_verdict, highly_verdict = json.loads(maybe_value), json.loads(highly_value)
+            probability = stated_probability(maybe_verdict)
+            # verdicts the expensive model didn't give itself say nothing about it
+            if probability is None or "decided_by" in highly_verdict:
+                continue
+            history.append((probability, bool(highly_verdict.get("relevant"))))
+        return fit_calibration(history)
+
+    def is_audited(self, document: str) -> bool:
+        return zlib.crc32(document.encode()) % AUDIT_BUCKETS < self.audit_rate * AUDIT_BUCKETS
+
+    def route(
+        self, spec_name: str, verdicts: Sequence[Dict[str, Any]], documents: Sequence[str], calibration: Calibration
+    ) -> List[Tuple[str, Optional[float]]]:
+        """The route for each verdict on the document at the same position in `documents`, with
+        its calibrated probability of being highly relevant."""
+        accept_threshold, reject_threshold = self.thresholds(spec_name)
+        routes: List[Tuple[str, Optional[float]]] = []
+        for verdict, document in zip(verdicts, documents):
+            probability = stated_probability(verdict)
+            if probability is None:
+                routes.append((ESCALATE if verdict.get("relevant") else REJECT, None))
+                continue
+            calibrated = calibration.calibrate(probability)
+            if reject_threshold < calibrated < accept_threshold:
+                routes.append((ESCALATE, calibrated))
+            elif self.is_audited(document):
+                routes.append((AUDIT, calibrated))
+            else:
+                routes.append((ACCEPT if calibrated >= accept_threshold else REJECT, calibrated))
+        return routes
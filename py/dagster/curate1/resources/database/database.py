@@ -27,6 +27,9 @@ class Database:
     self.conn = sqlite3.connect(db_path)
     self.cursor = self.conn.cursor()
 
+  def close(self):
+    self.conn.close()
+
   def recreate_db(self):
     print("Recreating database...")
     
@@ -38,6 +41,11 @@ class Database:
     # Create a new database
     self.conn = sqlite3.connect(self.db_path)
     self.cursor = self.conn.cursor()
+    self.create_tables()
+    print("New database created.")
+
+  def create_tables(self):
+    """Creates any missing tables, so tables added since a database was created can be used with it."""
     self.cursor.execute('''
       CREATE TABLE IF NOT EXISTS document (
         id INTEGER PRIMARY KEY,
@@ -68,8 +76,50 @@ class Database:
         created_at INTEGER
       )
     ''')
+
+    self.cursor.execute('''
+      CREATE TABLE IF NOT EXISTS llm_raw_response (
+        id INTEGER PRIMARY KEY,
+        model TEXT,
+        prompt TEXT,
+        response TEXT,
+        created_at INTEGER
+      )
+    ''')
+
+    self.cursor.execute('''
+      CREATE TABLE IF NOT EXISTS llm_pending_batch (
+        batch_id TEXT PRIMARY KEY,
+        requests TEXT,
+        submitted_at REAL
+      )
+    ''')
+
+    self.cursor.execute('''
+      CREATE TABLE IF NOT EXISTS llm_call_metric (
+        id INTEGER PRIMARY KEY,
+        model TEXT,
+        prompt_tokens INTEGER,
+        completion_tokens INTEGER,
+        latency_seconds REAL,
+        attempts INTEGER,
+        cache_hit BOOLEAN,
+        cost REAL,
+        created_at INTEGER
+      )
+    ''')
+
+    self.cursor.execute('''
+      CREATE TABLE IF NOT EXISTS article_content_cache (
+        url TEXT PRIMARY KEY,
+        content TEXT,
+        status TEXT,
+        etag TEXT,
+        last_modified TEXT,
+        fetched_at REAL
+      )
+    ''')
     self.conn.commit()
-    print("New database created.")
     
   def delete_documents_partition(self, partition_start: datetime, partition_end: datetime):
     self.cursor.execute(f'''
@@ -132,6 +182,61 @@ class Database:
     ''', (model, prompt, response, datetime.now().timestamp()))
     self.conn.commit()
 
+  def get_llm_raw_responses(self, prompt: str, model: str) -> List[str]:
+    """Every response received for the prompt, valid or not, oldest first."""
+    self.cursor.execute('''
+      SELECT response FROM llm_raw_response WHERE prompt = ? AND model = ? ORDER BY id
+    ''', (prompt, model))
+    return [row[0] for row in self.cursor.fetchall()]
+
+  def insert_llm_raw_response(self, prompt: str, model: str, response: str):
+    self.cursor.execute('''
+      INSERT INTO llm_raw_response (model, prompt, response, created_at)
+      VALUES (?, ?, ?, ?)
+    ''', (model, prompt, response, datetime.now().timestamp()))
+    self.conn.commit()
+
+  def insert_llm_pending_batch(self, batch_id: str, requests: str, submitted_at: float):
+    self.cursor.execute('''
+      INSERT OR REPLACE INTO llm_pending_batch (batch_id, requests, submitted_at)
+      VALUES (?, ?, ?)
+    ''', (batch_id, requests, submitted_at))
+    self.conn.commit()
+
+  def get_llm_pending_batches(self):
+    """Every batch submitted and not collected yet, as (batch id, requests, submitted at) rows,
+    oldest first."""
+    self.cursor.execute('''
+      SELECT batch_id, requests, submitted_at FROM llm_pending_batch ORDER BY submitted_at
+    ''')
+    return self.cursor.fetchall()
+
+  def delete_llm_pending_batch(self, batch_id: str):
+    self.cursor.execute('''
+      DELETE FROM llm_pending_batch WHERE batch_id = ?
+    ''', (batch_id,))
+    self.conn.commit()
+
+  def insert_llm_call_metric(self, model: str, prompt_tokens: int, completion_tokens: int, latency_seconds: float, attempts: int, cache_hit: bool, cost: float):
+    self.cursor.execute('''
+      INSERT INTO llm_call_metric (model, prompt_tokens, completion_tokens, latency_seconds, attempts, cache_hit, cost, created_at)
+      VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (model, prompt_tokens, completion_tokens, latency_seconds, attempts, cache_hit, cost, datetime.now().timestamp()))
+    self.conn.commit()
+
+  def get_article_content(self, url: str):
+    self.cursor.execute('''
+      SELECT url, content, status, etag, last_modified, fetched_at FROM article_content_cache WHERE url = ?
+    ''', (url,))
+    return self.cursor.fetchone()
+
+  def upsert_article_content(self, url: str, content: Optional[str], status: str, etag: Optional[str], last_modified: Optional[str], fetched_at: float):
+    self.cursor.execute('''
+      INSERT OR REPLACE INTO article_content_cache (url, content, status, etag, last_modified, fetched_at)
+      VALUES (?, ?, ?, ?, ?, ?)
+    ''', (url, content, status, etag, last_modified, fetched_at))
+    self.conn.commit()
+
   def get_documents(self, partition_start: datetime, partition_end: datetime):
     self.cursor.execute(f'''
       SELECT * FROM document WHERE created_at >= ? AND created_at < ?
@@ -145,3 +250,40 @@ class Database:
     print(q)
     self.cursor.execute(q, (partition_start.timestamp(), partition_end.timestamp()))
     return self.cursor.fetchall()
+
+  def get_recent_documents(self, limit: int):
+    """The most recent documents, as (title, content) rows."""
+    self.cursor.execute('''
+      SELECT title, content FROM document ORDER BY created_at DESC LIMIT ?
+    ''', (limit,))
+    return self.cursor.fetchall()
+
+  def get_labelled_documents(self, label: str, limit: int):
+    """The most recent documents with an attribute `label`, as (title, content, value) rows."""
+    self.cursor.execute('''
+      SELECT document.title, document.content, document_attribute.value
+      FROM document_attribute JOIN document ON document_attribute.document_id = document.id
+      WHERE document_attribute.label = ?
+      ORDER BY document_attribute.created_at DESC
+      LIMIT ?
+    ''', (label, limit))
+    return self.cursor.fetchall()
+
+  def get_escalated_verdicts(self, cheap_label: str, expensive_label: str, limit: int):
+    """The most recent documents with attributes under both labels, as (cheap value, expensive
+    value) rows."""
+    self.cursor.execute('''
+      SELECT cheap.value, expensive.value
+      FROM document_attribute AS cheap JOIN document_attribute AS expensive ON cheap.document_id = expensive.document_id
+      WHERE cheap.label = ? AND expensive.label = ?
+      ORDER BY expensive.created_at DESC
+      LIMIT ?
+    ''', (cheap_label, expensive_label, limit))
+    return self.cursor.fetchall()
+
+  def get_llm_responses(self):
+    """Every cached response, as (prompt, model, response) rows."""
+    self.cursor.execute('''
+      SELECT prompt, model, response FROM llm_response_cache
+    ''')
+    return self.cursor.fetchall()
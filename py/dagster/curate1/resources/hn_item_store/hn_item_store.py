@@ -0,0 +1,157 @@
+import json
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+HNItemRecord = Dict[str, Any]
+
+# (item, fetched_at)
+StoredItem = Tuple[HNItemRecord, float]
+
+# (item id, item time)
+TimeCheckpoint = Tuple[int, int]
+
+# keep well under SQLite's limit on bound parameters per statement
+QUERY_CHUNK_SIZE = 500
+
+
+class HNItemStore(ABC):
+    @abstractmethod
+    def get_items(self, item_ids: Iterable[int]) -> Dict[int, StoredItem]:
+        pass
+
+    @abstractmethod
+    def put_items(self, items: List[HNItemRecord], fetched_at: float):
+        pass
+
+    @abstractmethod
+    def touch_items(self, start_id: int, end_id: int, fetched_at: float):
+        pass
+
+    @abstractmethod
+    def get_max_item_id(self) -> Optional[Tuple[int, float]]:
+        pass
+
+    @abstractmethod
+    def put_max_item_id(self, max_item_id: int, fetched_at: float):
+        pass
+
+    @abstractmethod
+    def get_time_bracket(
+        self, timestamp: int
+    ) -> Tuple[Optional[TimeCheckpoint], Optional[TimeCheckpoint]]:
+        pass
+
+    @abstractmethod
+    def put_time_checkpoints(self, checkpoints: Iterable[TimeCheckpoint]):
+        pass
+
+
+class SqliteHNItemStore(HNItemStore):
+    """Stores raw item JSON keyed by item id, along with when it was fetched."""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        # the store is shared by the fetch threads of a bulk fetch, so serialize access
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS hn_item (
+                id INTEGER PRIMARY KEY,
+                time INTEGER,
+                item TEXT,
+                fetched_at REAL
+            )
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS hn_time_checkpoint (
+                id INTEGER PRIMARY KEY,
+                time INTEGER
+            )
+        ''')
+        self.conn.execute('''
+            CREATE INDEX IF NOT EXISTS hn_time_checkpoint_time ON hn_time_checkpoint (time, id)
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS hn_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT,
+                fetched_at REAL
+            )
+        ''')
+        self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def get_items(self, item_ids: Iterable[int]) -> Dict[int, StoredItem]:
+        ids = list(item_ids)
+        found: Dict[int, StoredItem] = {}
+        with self.lock:
+            for i in range(0, len(ids), QUERY_CHUNK_SIZE):
+                chunk = ids[i:i + QUERY_CHUNK_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.conn.execute(f'''
+                    SELECT id, item, fetched_at FROM hn_item WHERE id IN ({placeholders})
+                ''', chunk).fetchall()
+                for item_id, item, fetched_at in rows:
+                    found[item_id] = (json.loads(item), fetched_at)
+        return found
+
+    def put_items(self, items: List[HNItemRecord], fetched_at: float):
+        rows = [(item["id"], item.get("time"), json.dumps(item), fetched_at) for item in items]
+        with self.lock:
+            self.conn.executemany('''
+                INSERT OR REPLACE INTO hn_item (id, time, item, fetched_at) VALUES (?, ?, ?, ?)
+            ''', rows)
+            self.conn.commit()
+
+    def touch_items(self, start_id: int, end_id: int, fetched_at: float):
+        """Marks the stored items with ids from `start_id` to `end_id` as fetched at
+        `fetched_at`, for items known not to have changed since they were fetched."""
+        with self.lock:
+            self.conn.execute('''
+                UPDATE hn_item SET fetched_at = ? WHERE id BETWEEN ? AND ? AND fetched_at < ?
+            ''', (fetched_at, start_id, end_id, fetched_at))
+            self.conn.commit()
+
+    def get_max_item_id(self) -> Optional[Tuple[int, float]]:
+        with self.lock:
+            row = self.conn.execute('''
+                SELECT value, fetched_at FROM hn_meta WHERE key = 'max_item_id'
+            ''').fetchone()
+        if row is None:
+            return None
+        return int(row[0]), row[1]
+
+    def put_max_item_id(self, max_item_id: int, fetched_at: float):
+        with self.lock:
+            self.conn.execute('''
+                INSERT OR REPLACE INTO hn_meta (key, value, fetched_at) VALUES ('max_item_id', ?, ?)
+            ''', (str(max_item_id), fetched_at))
+            self.conn.commit()
+
+    def get_time_bracket(
+        self, timestamp: int
+    ) -> Tuple[Optional[TimeCheckpoint], Optional[TimeCheckpoint]]:
+        """Returns the latest checkpoint before `timestamp` and the earliest one at or after it."""
+        with self.lock:
+            lower = self.conn.execute('''
+                SELECT id, time FROM hn_time_checkpoint WHERE time < ?
+                ORDER BY time DESC, id DESC LIMIT 1
+            ''', (timestamp,)).fetchone()
+            upper = self.conn.execute('''
+                SELECT id, time FROM hn_time_checkpoint WHERE time >= ?
+                ORDER BY time ASC, id ASC LIMIT 1
+            ''', (timestamp,)).fetchone()
+        return (tuple(lower) if lower else None, tuple(upper) if upper else None)
+
+    def put_time_checkpoints(self, checkpoints: Iterable[TimeCheckpoint]):
+        with self.lock:
+            self.conn.executemany('''
+                INSERT OR REPLACE INTO hn_time_checkpoint (id, time) VALUES (?, ?)
+            ''', list(checkpoints))
+            self.conn.commit()
@@ -1,12 +1,18 @@
-import gzip
-import json
+import os
+import time
 from abc import ABC, abstractmethod
-from typing import Any, Dict, Optional
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
 
 import requests
+import tenacity
 from dagster import ConfigurableResource
 from dagster._utils import file_relative_path
 from dagster._utils.cached_method import cached_method
+from requests.adapters import HTTPAdapter
+
+from .hn_item_store.hn_item_store import SqliteHNItemStore, TimeCheckpoint
+from .hn_snapshot.hn_snapshot import HNSnapshot, convert_json_snapshot
 
 HNItemRecord = Dict[str, Any]
 
@@ -26,35 +32,259 @@ class HNClient(ConfigurableResource, ABC):
     def min_item_id(self) -> int:
         pass
 
+    def fetch_items_by_ids(self, item_ids: Sequence[int]) -> List[Optional[HNItemRecord]]:
+        """Fetches many items at once. Results are returned in the same order as `item_ids`."""
+        return [self.fetch_item_by_id(item_id) for item_id in item_ids]
+
+    def fetch_updated_item_ids(self) -> List[int]:
+        """Ids of recently changed items, for clients backed by a live feed."""
+        return []
+
+    def refresh_items_by_ids(self, item_ids: Sequence[int]) -> List[Optional[HNItemRecord]]:
+        """Like `fetch_items_by_ids`, but bypasses any local copies of the items."""
+        return self.fetch_items_by_ids(item_ids)
+
+    def mark_items_current(self, start_id: int, end_id: int):
+        """Vouches that any local copies of items `start_id` through `end_id` are up to date,
+        for callers that follow every change to them."""
+        pass
+
+    def time_bracket(
+        self, timestamp: int
+    ) -> Tuple[Optional[TimeCheckpoint], Optional[TimeCheckpoint]]:
+        """Known (id, time) checkpoints on either side of `timestamp`, if the client keeps any."""
+        return None, None
+
+    def record_time_checkpoints(self, checkpoints: Iterable[TimeCheckpoint]):
+        pass
+
+    def close(self):
+        """Releases any connections or files the client holds."""
+        pass
+
+
+retry_strategy = tenacity.retry_if_exception_type(requests.RequestException)
+
 
 class HNAPIClient(HNClient):
+    """Fetches items from the Firebase API over a pooled keep-alive session.
+
+    Bulk fetches run `max_concurrency` requests at a time. Each request is retried up to
+    `max_attempts` times, and if `hedge_after_seconds` is set, a duplicate request is sent
+    for any item which hasn't responded by then, taking whichever response arrives first.
+    """
+
+    max_concurrency: int = 32
+    max_attempts: int = 4
+    hedge_after_seconds: Optional[float] = None
+    _session: Optional[requests.Session] = None
+
+    def _get_session(self) -> requests.Session:
+        if self._session is None:
+            session = requests.Session()
+            # one host, so a single pool sized to the number of concurrent requests
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+            session.mount("https://", adapter)
+            self._session = session
+        return self._session
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def _get_json(self, url: str) -> Any:
+        response = self._get_session().get(url, timeout=5)
+        response.raise_for_status()
+        return response.json()
+
     def fetch_item_by_id(self, item_id: int) -> Optional[HNItemRecord]:
-        item_url = f"{HN_BASE_URL}/item/{item_id}.json"
-        item = requests.get(item_url, timeout=5).json()
-        return item
+        return self._get_json(f"{HN_BASE_URL}/item/{item_id}.json")
 
     def fetch_max_item_id(self) -> int:
-        return requests.get(f"{HN_BASE_URL}/maxitem.json", timeout=5).json()
+        return self._get_json(f"{HN_BASE_URL}/maxitem.json")
+
+    def fetch_updated_item_ids(self) -> List[int]:
+        return self._get_json(f"{HN_BASE_URL}/updates.json")["items"]
+
+    def fetch_items_by_ids(self, item_ids: Sequence[int]) -> List[Optional[HNItemRecord]]:
+        fetch_with_retry = tenacity.retry(
+            retry=retry_strategy,
+            wait=tenacity.wait_exponential(multiplier=0.5, max=10),
+            stop=tenacity.stop_after_attempt(self.max_attempts),
+            reraise=True,
+        )(self.fetch_item_by_id)
+
+        if self.hedge_after_seconds is None:
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                return list(executor.map(fetch_with_retry, item_ids))
+
+        # hedged requests run on their own pool, so that a worker waiting on its hedge
+        # can never starve the pool that the hedge itself needs to run on
+        hedge_executor = ThreadPoolExecutor(max_workers=2 * self.max_concurrency)
+
+        def fetch_hedged(item_id: int) -> Optional[HNItemRecord]:
+            return _first_result(hedge_executor, fetch_with_retry, item_id, self.hedge_after_seconds)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                return list(executor.map(fetch_hedged, item_ids))
+        finally:
+            # don't wait for the losing side of each hedge to finish
+            hedge_executor.shutdown(wait=False, cancel_futures=True)
 
     def min_item_id(self) -> int:
         return 1
 
 
+def _first_result(executor: ThreadPoolExecutor, fn, arg, hedge_after_seconds) -> Any:
+    """Runs `fn(arg)`, starting a second identical call if the first is slower than
+    `hedge_after_seconds`, and returns the first successful result."""
+    pending: set[Future] = {executor.submit(fn, arg)}
+    done, pending = wait(pending, timeout=hedge_after_seconds)
+    if not done:
+        pending.add(executor.submit(fn, arg))
+
+    error: Optional[BaseException] = None
+    while done or pending:
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+        if not pending:
+            break
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+    raise error if error is not None else RuntimeError(f"No result for {arg}")
+
+
+class CachingHNClient(HNClient):
+    """Wraps another client, keeping every item it fetches in a local item store.
+
+    Items are immutable apart from fields like score, descendants and kids, which keep
+    changing for a while after an item is posted. An item whose cached copy was fetched
+    at least `settle_seconds` after it was posted is treated as final and always served
+    from the store. Younger copies are refetched when read, once they are older than
+    `refresh_after_seconds`, or never if it is None, as for stores staging a capture.
+
+    Every `checkpoint_stride`-th fetched item is also added to a sparse time->id index,
+    which seeds the id range search for time partitions.
+    """
+
+    inner: HNClient
+    store_path: str
+    settle_seconds: int = 2 * 24 * 60 * 60
+    refresh_after_seconds: Optional[int] = 15 * 60
+    max_item_ttl_seconds: int = 60
+    checkpoint_stride: int = 500
+    _store: Optional[SqliteHNItemStore] = None
+
+    def _get_store(self) -> SqliteHNItemStore:
+        if self._store is None:
+            self._store = SqliteHNItemStore(self.store_path)
+        return self._store
+
+    def close(self):
+        """Closes the item store. The inner client is left open, since it's passed in."""
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+    def _is_fresh(self, item: HNItemRecord, fetched_at: float, now: float) -> bool:
+        if fetched_at - item.get("time", 0) >= self.settle_seconds:
+            return True
+        if self.refresh_after_seconds is None:
+            return True
+        return now - fetched_at < self.refresh_after_seconds
+
+    def fetch_item_by_id(self, item_id: int) -> Optional[HNItemRecord]:
+        return self.fetch_items_by_ids([item_id])[0]
+
+    def fetch_items_by_ids(self, item_ids: Sequence[int]) -> List[Optional[HNItemRecord]]:
+        store = self._get_store()
+        now = time.time()
+        cached = store.get_items(item_ids)
+
+        items: Dict[int, Optional[HNItemRecord]] = {
+            item_id: item
+            for item_id, (item, fetched_at) in cached.items()
+            if self._is_fresh(item, fetched_at, now)
+        }
+        missing = [item_id for item_id in item_ids if item_id not in items]
+        if missing:
+            items.update(zip(missing, self.refresh_items_by_ids(missing)))
+
+        return [items[item_id] for item_id in item_ids]
+
+    def refresh_items_by_ids(self, item_ids: Sequence[int]) -> List[Optional[HNItemRecord]]:
+        store = self._get_store()
+        fetched = self.inner.fetch_items_by_ids(item_ids)
+        # ids past the current max item come back empty, so they are never stored
+        fetched_items = [item for item in fetched if item is not None]
+        store.put_items(fetched_items, time.time())
+        store.put_time_checkpoints(
+            (item["id"], item["time"])
+            for item in fetched_items
+            if item["id"] % self.checkpoint_stride == 0 and "time" in item
+        )
+        return fetched
+
+    def mark_items_current(self, start_id: int, end_id: int):
+        self._get_store().touch_items(start_id, end_id, time.time())
+
+    def fetch_max_item_id(self) -> int:
+        store = self._get_store()
+        now = time.time()
+        cached = store.get_max_item_id()
+        if cached is not None and now - cached[1] < self.max_item_ttl_seconds:
+            return cached[0]
+        max_item_id = self.inner.fetch_max_item_id()
+        store.put_max_item_id(max_item_id, now)
+        return max_item_id
+
+    def min_item_id(self) -> int:
+        return self.inner.min_item_id()
+
+    def fetch_updated_item_ids(self) -> List[int]:
+        return self.inner.fetch_updated_item_ids()
+
+    def time_bracket(
+        self, timestamp: int
+    ) -> Tuple[Optional[TimeCheckpoint], Optional[TimeCheckpoint]]:
+        return self._get_store().get_time_bracket(timestamp)
+
+    def record_time_checkpoints(self, checkpoints: Iterable[TimeCheckpoint]):
+        self._get_store().put_time_checkpoints(checkpoints)
+
+
 class HNSnapshotClient(HNClient):
+    """Serves items from a columnar snapshot file.
+
+    Legacy gzipped JSON snapshots are converted to the columnar format next to the
+    original file the first time they are opened.
+    """
+
+    snapshot_path: str = file_relative_path(__file__, "../utils/snapshot.hnsnap")
+
     @cached_method
-    def load_items(self) -> Dict[str, HNItemRecord]:
-        file_path = file_relative_path(__file__, "../utils/snapshot.gzip")
-        with gzip.open(file_path, "r") as f:
-            return json.loads(f.read().decode())
+    def load_snapshot(self) -> HNSnapshot:
+        path = self.snapshot_path
+        if path.endswith((".gzip", ".gz")):
+            converted_path = os.path.splitext(path)[0] + ".hnsnap"
+            if not os.path.exists(converted_path) or (
+                os.path.getmtime(converted_path) < os.path.getmtime(path)
+            ):
+                convert_json_snapshot(path, converted_path)
+            path = converted_path
+        return HNSnapshot(path)
 
     def fetch_item_by_id(self, item_id: int) -> Optional[HNItemRecord]:
-        return self.load_items().get(str(item_id))
+        return self.load_snapshot().get(item_id)
 
     def fetch_max_item_id(self) -> int:
-        return int(list(self.load_items().keys())[-1])
+        return self.load_snapshot().max_id()
 
     def min_item_id(self) -> int:
-        return int(next(iter(self.load_items().keys())))
+        return self.load_snapshot().min_id()
 
 
 class HNAPISubsampleClient(HNClient):
@@ -0,0 +1,68 @@
+import os
+from contextlib import closing
+
+from ..hn_resource import CachingHNClient, HNClient
+from .hn_snapshot import SnapshotWriter
+
+# fields kept for non-story items in a stories-only snapshot, enough for id range searches
+STUB_FIELDS = ("id", "time", "type", "deleted", "dead")
+
+
+def _staging_client(hn_client: HNClient, out_path: str) -> CachingHNClient:
+    """A client that stages the items of a capture next to `out_path`. Staged items are never
+    refreshed, so resuming a capture doesn't fetch them again, however recent they are."""
+    return CachingHNClient(inner=hn_client, store_path=out_path + ".partial", refresh_after_seconds=None)
+
+
+def capture_snapshot(
+    hn_client: HNClient,
+    out_path: str,
+    start_id: int,
+    end_id: int,
+    stories_only: bool = False,
+    batch_size: int = 1000,
+) -> int:
+    """Captures items `start_id` through `end_id` (inclusive) into a snapshot at `out_path`.
+
+    Items are staged in an item store next to the output as they're fetched, so an
+    interrupted capture picks up where it left off when it is run again, however long after.
+    Each batch is streamed to the snapshot as it arrives, so memory use doesn't grow with the
+    range. With `stories_only`, items other than stories are reduced to their id, time and type.
+    """
+    staging_path = out_path + ".partial"
+
+    with closing(_staging_client(hn_client, out_path)) as staging_client, \
+            SnapshotWriter(out_path) as writer:
+        for batch_start in range(start_id, end_id + 1, batch_size):
+            batch_ids = range(batch_start, min(batch_start + batch_size, end_id + 1))
+            items = [item for item in staging_client.fetch_items_by_ids(batch_ids) if item is not None]
+            if stories_only:
+                items = [
+                    item if item.get("type") == "story" else {k: item[k] for k in STUB_FIELDS if k in item}
+                    for item in items
+                ]
+            writer.add(items)
+            print(f"Captured items up to {batch_ids[-1]} ({batch_ids[-1] - start_id + 1} items)")
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(staging_path + suffix):
+            os.remove(staging_path + suffix)
+    return writer.count
+
+
+def capture_snapshot_for_time(
+    hn_client: HNClient,
+    out_path: str,
+    start_time: int,
+    end_time: int,
+    stories_only: bool = False,
+    batch_size: int = 1000,
+) -> int:
+    """Captures the items created between `start_time` and `end_time` (unix seconds)."""
+    # imported here, since the assets package imports the resources package
+    from curate1.assets.id_range_for_time import _id_range_for_time
+
+    # search through the staging store too, so a resumed capture doesn't repeat the search
+    with closing(_staging_client(hn_client, out_path)) as staging_client:
+        (start_id, end_id), _ = _id_range_for_time(start_time, end_time, staging_client)
+    return capture_snapshot(hn_client, out_path, start_id, end_id, stories_only, batch_size)
@@ -0,0 +1,178 @@
+"""Columnar, memory-mapped snapshot of Hacker News items.
+
+Layout, all integers native little-endian int64:
+
+    magic       8 bytes, b"HNSNAP01"
+    count       number of items
+    block_size  number of items per compressed block
+    ids         count sorted item ids
+    times       count item times, parallel to ids
+    offsets     blocks + 1 offsets into the record blob
+    blob        blocks of block_size newline-separated item JSON records, each zlib-compressed
+
+Lookups binary search the id column in place and only decompress the block they hit.
+Records are compressed in blocks rather than one by one, since single items are too small
+for zlib to do much with.
+"""
+import array
+import bisect
+import gzip
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import zlib
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+HNItemRecord = Dict[str, Any]
+
+MAGIC = b"HNSNAP01"
+HEADER = struct.Struct("<8sqq")
+INT64_SIZE = 8
+BLOCK_SIZE = 64
+
+
+def _check_byte_order():
+    # the columns are read in place with memoryview.cast, which uses native byte order
+    if sys.byteorder != "little":
+        raise ValueError("HN snapshots can only be read and written on little-endian hosts")
+
+
+class SnapshotWriter:
+    """Writes a snapshot from items added in ascending id order, a batch at a time.
+
+    Only the id and time columns are kept in memory. Records are compressed a block at a
+    time into a temporary file, which is copied in after the columns when the writer is
+    closed, and the snapshot replaces `path` only once it is complete.
+    """
+
+    def __init__(self, path: str):
+        _check_byte_order()
+        self.path = path
+        self.ids = array.array("q")
+        self.times = array.array("q")
+        self.offsets = array.array("q", [0])
+        self._pending: List[HNItemRecord] = []
+        self._blob = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path)))
+
+    def __enter__(self) -> "SnapshotWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._blob.close()
+
+    @property
+    def count(self) -> int:
+        return len(self.ids)
+
+    def add(self, items: Iterable[HNItemRecord]):
+        for item in items:
+            if self.ids and item["id"] <= self.ids[-1]:
+                raise ValueError(f"Item {item['id']} added after item {self.ids[-1]}")
+            self.ids.append(item["id"])
+            self.times.append(item.get("time", 0))
+            self._pending.append(item)
+            if len(self._pending) == BLOCK_SIZE:
+                self._flush_block()
+
+    def _flush_block(self):
+        block = "\n".join(json.dumps(item, separators=(",", ":")) for item in self._pending)
+        self._blob.write(zlib.compress(block.encode()))
+        self.offsets.append(self._blob.tell())
+        self._pending = []
+
+    def close(self):
+        if self._pending:
+            self._flush_block()
+        partial_path = self.path + ".tmp"
+        with self._blob, open(partial_path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, self.count, BLOCK_SIZE))
+            f.write(self.ids.tobytes())
+            f.write(self.times.tobytes())
+            f.write(self.offsets.tobytes())
+            self._blob.seek(0)
+            shutil.copyfileobj(self._blob, f)
+        os.replace(partial_path, self.path)
+
+
+def write_snapshot(path: str, items: Iterable[HNItemRecord]) -> int:
+    """Writes `items` to a snapshot at `path`, returning the number of items written."""
+    with SnapshotWriter(path) as writer:
+        writer.add(sorted(items, key=lambda item: item["id"]))
+    return writer.count
+
+
+def convert_json_snapshot(json_gzip_path: str, path: str) -> int:
+    """Converts a legacy gzipped JSON snapshot ({"<id>": item, ...}) to the columnar format."""
+    with gzip.open(json_gzip_path, "r") as f:
+        items = json.loads(f.read().decode())
+    return write_snapshot(path, items.values())
+
+
+class HNSnapshot:
+    def __init__(self, path: str):
+        _check_byte_order()
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, count, block_size = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an HN snapshot")
+        self.count = count
+        self.block_size = block_size
+        blocks = -(-count // block_size)
+        # the last decompressed block, since reads are usually sequential
+        self._block_cache: Tuple[int, List[bytes]] = (-1, [])
+
+        view = memoryview(self._mmap)
+        start = HEADER.size
+        self.ids = view[start:start + count * INT64_SIZE].cast("q")
+        start += count * INT64_SIZE
+        self.times = view[start:start + count * INT64_SIZE].cast("q")
+        start += count * INT64_SIZE
+        self.offsets = view[start:start + (blocks + 1) * INT64_SIZE].cast("q")
+        start += (blocks + 1) * INT64_SIZE
+        self.blob = view[start:]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _index_of(self, item_id: int) -> Optional[int]:
+        index = bisect.bisect_left(self.ids, item_id)
+        if index < self.count and self.ids[index] == item_id:
+            return index
+        return None
+
+    def _record_at(self, index: int) -> HNItemRecord:
+        block_index, position = divmod(index, self.block_size)
+        cached_index, records = self._block_cache
+        if cached_index != block_index:
+            block = self.blob[self.offsets[block_index]:self.offsets[block_index + 1]]
+            records = zlib.decompress(block).split(b"\n")
+            self._block_cache = (block_index, records)
+        return json.loads(records[position])
+
+    def get(self, item_id: int) -> Optional[HNItemRecord]:
+        index = self._index_of(item_id)
+        return self._record_at(index) if index is not None else None
+
+    def time_of(self, item_id: int) -> Optional[int]:
+        index = self._index_of(item_id)
+        return self.times[index] if index is not None else None
+
+    def min_id(self) -> int:
+        return self.ids[0]
+
+    def max_id(self) -> int:
+        return self.ids[self.count - 1]
+
+    def items(self) -> Iterator[HNItemRecord]:
+        for index in range(self.count):
+            yield self._record_at(index)
@@ -1,5 +1,6 @@
 import os
 from abc import ABC, abstractmethod
+from typing import List
 
 from ..database.database import Database
 
@@ -13,6 +14,18 @@ class LlmResponseCache(ABC):
   def insert_llm_response(self, prompt: str, model: str, response: str):
     pass
 
+  @abstractmethod
+  def get_raw_responses(self, prompt: str, model: str) -> List[str]:
+    """Every response received for the prompt, including ones that failed validation."""
+    pass
+
+  @abstractmethod
+  def insert_raw_response(self, prompt: str, model: str, response: str):
+    pass
+
+  def close(self):
+    pass
+
 class DbResponseCache(LlmResponseCache):
   def __init__(self, database: Database):
     self.database = database
@@ -23,10 +36,20 @@ class DbResponseCache(LlmResponseCache):
   def insert_llm_response(self, prompt: str, model: str, response: str):
     self.database.insert_llm_response(prompt, model, response)
 
+  def get_raw_responses(self, prompt: str, model: str) -> List[str]:
+    return self.database.get_llm_raw_responses(prompt, model)
+
+  def insert_raw_response(self, prompt: str, model: str, response: str):
+    self.database.insert_llm_raw_response(prompt, model, response)
+
+  def close(self):
+    self.database.close()
+
   @staticmethod
   def from_env() -> LlmResponseCache:
     db_path = os.getenv('SQLITE_DATABASE_PATH')
     if db_path is None:
         raise ValueError("SQLITE_DATABASE_PATH environment variable is not set.")
     database=Database(db_path=db_path)
+    database.create_tables()
     return DbResponseCache(database)
\ No newline at end of file
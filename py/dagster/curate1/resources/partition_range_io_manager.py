@@ -0,0 +1,38 @@
+from typing import Any, Optional
+
+from dagster import ConfigurableIOManagerFactory, InitResourceContext, OutputContext
+from dagster import _check as check
+from dagster._core.storage.fs_io_manager import PickledObjectFilesystemIOManager
+
+
+class PartitionRangePickledObjectFilesystemIOManager(PickledObjectFilesystemIOManager):
+    """Like the built-in filesystem IO manager, but an asset can also output a dict of values keyed
+    by partition key, which are stored as the individual partitions.
+
+    This lets a single-run backfill over many partitions persist each of them separately.
+    """
+
+    def handle_output(self, context: OutputContext, obj: Any):
+        if (
+            context.has_asset_partitions
+            and isinstance(obj, dict)
+            and set(obj.keys()) == set(context.asset_partition_keys)
+        ):
+            for partition_key, path in self._get_paths_for_partitions(context).items():
+                self.make_directory(path.parent)
+                context.log.debug(self.get_writing_output_log_message(path))
+                self.dump_to_path(context=context, obj=obj[partition_key], path=path)
+            return
+        super().handle_output(context, obj)
+
+
+class PartitionRangeFilesystemIOManager(
+    ConfigurableIOManagerFactory[PartitionRangePickledObjectFilesystemIOManager]
+):
+    base_dir: Optional[str] = None
+
+    def create_io_manager(
+        self, context: InitResourceContext
+    ) -> PartitionRangePickledObjectFilesystemIOManager:
+        base_dir = self.base_dir or check.not_none(context.instance).storage_directory()
+        return PartitionRangePickledObjectFilesystemIOManager(base_dir=base_dir)
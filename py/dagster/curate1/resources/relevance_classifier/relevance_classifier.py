@@ -0,0 +1,281 @@
+import glob
+import json
+import math
+import os
+import zlib
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from dagster import file_relative_path
+from pydantic import BaseModel
+
+from ..agent.filter_spec import Relevance, parse_cached_verdicts
+from ..database.database import Database
+from ..semantic_prefilter.semantic_prefilter import NUM_FEATURES, hashed_features
+
+# (document text, whether the LLM judged it relevant)
+Example = Tuple[str, bool]
+
+# one in this many examples is held out for evaluation, chosen by a hash of the text so the
+# split is the same on every run
+HOLDOUT_EVERY = 5
+
+
+def spec_texts() -> Dict[str, str]:
+    paths = glob.glob(file_relative_path(__file__, "../agent/prompts/specs/*.txt"))
+    texts = {}
+    for path in paths:
+        with open(path, "r") as f:
+            texts[os.path.splitext(os.path.basename(path))[0]] = f.read()
+    return texts
+
+
+def load_examples(database: Database, spec_name: str, relevance: Relevance) -> List[Example]:
+    """Every verdict the LLM gave for the spec and relevance tier, from the LLM response cache
+    and from stored document attributes, one per distinct document."""
+    examples: Dict[str, bool] = {}
+    texts = spec_texts()
+    for prompt, _, response in database.get_llm_responses():
+        for verdict_relevance, verdict_spec, document, relevant in parse_cached_verdicts(prompt, response, texts):
+            if verdict_relevance == relevance and verdict_spec == spec_name:
+                examples[document] = relevant
+
+    label = f"filter_spec_{spec_name}_{relevance.value}"
+    for _, content, value in database.get_labelled_documents(label, -1):
+        verdict = json.loads(value)
+        # verdicts decided without the LLM, by a classifier or the cascade, would teach the
+        # classifier its own mistakes
+        if content and "decided_by" not in verdict:
+            examples.setdefault(content, bool(verdict.get("relevant")))
+    return list(examples.items())
+
+
+def split_examples(examples: Sequence[Example]) -> Tuple[List[Example], List[Example]]:
+    train, test = [], []
+    for example in examples:
+        held_out = zlib.crc32(example[0].encode()) % HOLDOUT_EVERY == 0
+        (test if held_out else train).append(example)
+    return train, test
+
+
+def _vectorize(text: str) -> Tuple[np.ndarray, np.ndarray]:
+    counts = hashed_features(text)
+    indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    values = 1 + np.log(np.fromiter(counts.values(), dtype=np.float64, count=len(counts)))
+    norm = np.linalg.norm(values)
+    return indices, values / norm if norm else values
+
+
+class ThresholdMetrics(BaseModel):
+    threshold: float
+    precision: Optional[float]
+    recall: Optional[float]
+
+
+class ClassifierReport(BaseModel):
+    examples: int
+    relevant: int
+    auto_relevant: int
+    auto_relevant_precision: Optional[float]
+    auto_not_relevant: int
+    relevant_missed: int
+    recall: Optional[float]
+    sent_to_llm: int
+    trade_off: List[ThresholdMetrics]
+
+
+class RelevanceClassifier(BaseModel):
+    """A logistic regression over the same hashed n-gram features as the semantic prefilter,
+    fitted to the verdicts the LLM gave for one spec and relevance tier.
+
+    Documents scoring at least `positive_threshold` are decided relevant, and those scoring at
+    most `negative_threshold` not relevant, without asking the LLM.
+    """
+
+    spec_name: str
+    relevance: str
+    bias: float
+    weights: Dict[int, float]
+    positive_threshold: float = 1.0
+    negative_threshold: float = 0.0
+    report: Optional[ClassifierReport] = None
+
+    def predict(self, texts: Sequence[str]) -> List[float]:
+        probabilities = []
+        for text in texts:
+            indices, values = _vectorize(text)
+            score = self.bias + sum(self.weights.get(int(i), 0.0) * v for i, v in zip(indices, values))
+            probabilities.append(1 / (1 + math.exp(-max(min(score, 30), -30))))
+        return probabilities
+
+    def decide(self, probability: float) -> Optional[bool]:
+        if probability >= self.positive_threshold:
+            return True
+        if probability <= self.negative_threshold:
+            return False
+        return None
+
+    def save(self, model_dir: str):
+        os.makedirs(model_dir, exist_ok=True)
+        with open(model_path(model_dir, self.spec_name, Relevance(self.relevance)), "w") as f:
+            f.write(self.model_dump_json())
+
+    @staticmethod
+    def load(model_dir: str, spec_name: str, relevance: Relevance) -> Optional["RelevanceClassifier"]:
+        path = model_path(model_dir, spec_name, relevance)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return RelevanceClassifier.model_validate_json(f.read())
+
+
+def model_path(model_dir: str, spec_name: str, relevance: Relevance) -> str:
+    return os.path.join(model_dir, f"{spec_name}_{relevance.value}.json")
+
+
+def train_classifier(
+    examples: Sequence[Example],
+    spec_name: str,
+    relevance: Relevance,
+    epochs: int = 20,
+    learning_rate: float = 0.5,
+    l2: float = 1e-4,
+) -> RelevanceClassifier:
+    """Fits the classifier with stochastic gradient descent, weighting each class by its rarity
+    so that the few relevant documents aren't drowned out."""
+    vectors = [_vectorize(text) for text, _ in examples]
+    labels = np.array([1.0 if relevant else 0.0 for _, relevant in examples])
+    positives = labels.sum()
+    class_weights = {
+        1.0: len(labels) / (2 * positives) if positives else 1.0,
+        0.0: len(labels) / (2 * (len(labels) - positives)) if positives < len(labels) else 1.0,
+    }
+
+    weights = np.zeros(NUM_FEATURES)
+    bias = 0.0
+    order = np.random.default_rng(0)
+    for epoch in range(epochs):
+        rate = learning_rate / (1 + epoch)
+        for i in order.permutation(len(vectors)):
+            indices, values = vectors[i]
+            score = bias + weights[indices] @ values
+            probability = 1 / (1 + math.exp(-max(min(score, 30), -30)))
+            gradient = (labels[i] - probability) * class_weights[labels[i]]
+            weights[indices] += rate * (gradient * values - l2 * weights[indices])
+            bias += rate * gradient
+
+    nonzero = np.flatnonzero(np.abs(weights) > 1e-6)
+    return RelevanceClassifier(
+        spec_name=spec_name,
+        relevance=relevance.value,
+        bias=bias,
+        weights={int(i): float(weights[i]) for i in nonzero},
+    )
+
+
+def choose_thresholds(
+    probabilities: Sequence[float], labels: Sequence[bool], target_precision: float, target_recall: float
+) -> Tuple[float, float]:
+    """The lowest positive threshold whose auto-decided positives are at least `target_precision`
+    precise, and the highest negative threshold that still keeps `target_recall` of the relevant
+    documents. Either is left at its extreme, deciding nothing, if the target can't be met."""
+    ranked = sorted(zip(probabilities, labels), reverse=True)
+
+    positive_threshold = 1.0
+    true_positives = 0
+    for count, (probability, relevant) in enumerate(ranked, start=1):
+        true_positives += relevant
+        if true_positives / count >= target_precision:
+            positive_threshold = probability
+
+    relevant_total = sum(labels)
+    allowed_misses = math.floor((1 - target_recall) * relevant_total)
+    negative_threshold = 0.0
+    misses = 0
+    for probability, relevant in reversed(ranked):
+        misses += relevant
+        if misses > allowed_misses:
+            break
+        negative_threshold = probability
+    if negative_threshold >= positive_threshold:
+        negative_threshold = 0.0
+    return positive_threshold, negative_threshold
+
+
+def evaluate(classifier: RelevanceClassifier, examples: Sequence[Example]) -> ClassifierReport:
+    probabilities = classifier.predict([text for text, _ in examples])
+    labels = [relevant for _, relevant in examples]
+    decisions = [classifier.decide(p) for p in probabilities]
+
+    auto_relevant = [relevant for decision, relevant in zip(decisions, labels) if decision is True]
+    auto_not_relevant = [relevant for decision, relevant in zip(decisions, labels) if decision is False]
+    relevant_total = sum(labels)
+
+    trade_off = []
+    for threshold in [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]:
+        predicted = [p >= threshold for p in probabilities]
+        hits = sum(p and r for p, r in zip(predicted, labels))
+        trade_off.append(ThresholdMetrics(
+            threshold=threshold,
+            precision=hits / sum(predicted) if any(predicted) else None,
+            recall=hits / relevant_total if relevant_total else None,
+        ))
+
+    return ClassifierReport(
+        examples=len(examples),
+        relevant=relevant_total,
+        auto_relevant=len(auto_relevant),
+        auto_relevant_precision=sum(auto_relevant) / len(auto_relevant) if auto_relevant else None,
+        auto_not_relevant=len(auto_not_relevant),
+        relevant_missed=sum(auto_not_relevant),
+        recall=1 - sum(auto_not_relevant) / relevant_total if relevant_total else None,
+        sent_to_llm=sum(decision is None for decision in decisions),
+        trade_off=trade_off,
+    )
+
+
+def fit_and_evaluate(
+    examples: Sequence[Example],
+    spec_name: str,
+    relevance: Relevance,
+    target_precision: float,
+    target_recall: float,
+    folds: int = 4,
+) -> RelevanceClassifier:
+    """Trains on all but the held out examples and reports on the held out ones.
+
+    The thresholds are tuned on out-of-fold predictions for the training examples, since a
+    model is always overconfident about the examples it was fitted to.
+    """
+    train, test = split_examples(examples)
+    fold_of = [zlib.crc32(text.encode()) // HOLDOUT_EVERY % folds for text, _ in train]
+    out_of_fold = [0.0] * len(train)
+    for fold in range(folds):
+        fold_model = train_classifier([e for e, f in zip(train, fold_of) if f != fold], spec_name, relevance)
+        fold_indices = [i for i, f in enumerate(fold_of) if f == fold]
+        for i, probability in zip(fold_indices, fold_model.predict([train[i][0] for i in fold_indices])):
+            out_of_fold[i] = probability
+
+    classifier = train_classifier(train, spec_name, relevance)
+    classifier.positive_threshold, classifier.negative_threshold = choose_thresholds(
+        out_of_fold, [relevant for _, relevant in train], target_precision, target_recall)
+    classifier.report = evaluate(classifier, test)
+    return classifier
+
+
+def format_report(name: str, report: ClassifierReport) -> str:
+    def percent(value: Optional[float]) -> str:
+        return "-" if value is None else f"{value:.1%}"
+
+    lines = [
+        f"{name}: {report.examples} examples, {report.relevant} relevant",
+        f"  auto relevant:     {report.auto_relevant} (precision {percent(report.auto_relevant_precision)})",
+        f"  auto not relevant: {report.auto_not_relevant} ({report.relevant_missed} relevant missed, recall {percent(report.recall)})",
+        f"  sent to the LLM:   {report.sent_to_llm}",
+        "  threshold  precision  recall",
+    ]
+    lines += [
+        f"  {m.threshold:9.1f}  {percent(m.precision):>9}  {percent(m.recall):>6}" for m in report.trade_off
+    ]
+    return "\n".join(lines)
+
@@ -0,0 +1,234 @@
+import json
+import math
+import os
+import re
+import zlib
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from dagster import (ConfigurableResource, InitResourceContext,
+                     file_relative_path)
+from pydantic import BaseModel
+
+from ..database.database import Database
+
+# hashed feature space; collisions are rare enough at this size not to matter for ranking
+NUM_FEATURES = 2 ** 20
+
+# only the start of long documents is scored, which is where their topic is set out
+MAX_DOCUMENT_CHARS = 20000
+
+STOPWORDS = frozenset("""
+a about above after again all also am an and any are as at be because been before being below
+between both but by can could did do does doing down during each few for from further had has
+have having he her here hers him his how i if in into is it its itself just me more most my no
+nor not of off on once only or other our out over own same she should so some such than that the
+their them then there these they this those through to too under until up very was we were what
+when where which while who whom why will with would you your
+""".split())
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# the IDF table is fitted once at least this many documents are stored
+MIN_REFERENCE_DOCUMENTS = 200
+
+# granularity of the hash that picks audited documents
+AUDIT_BUCKETS = 10000
+
+Vector = Dict[int, float]
+
+
+def hashed_features(text: str) -> Counter:
+    """Hashed unigram and bigram counts, so that phrases like "infrastructure as code" count for
+    more than their words do separately."""
+    tokens = [t for t in TOKEN_PATTERN.findall(text[:MAX_DOCUMENT_CHARS].lower()) if t not in STOPWORDS]
+    grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    return Counter(zlib.crc32(gram.encode()) % NUM_FEATURES for gram in grams)
+
+
+def _tfidf(counts: Counter, idf: Dict[int, float], default_idf: float) -> Vector:
+    vector = {f: (1 + math.log(n)) * idf.get(f, default_idf) for f, n in counts.items()}
+    norm = math.sqrt(sum(w * w for w in vector.values()))
+    return {f: w / norm for f, w in vector.items()} if norm else {}
+
+
+def document_text(title: Optional[str], content: Optional[str]) -> str:
+    return f"{title or ''}\n{content or ''}"
+
+
+class IdfTable(BaseModel):
+    """Document frequencies of hashed n-grams over a fixed reference corpus.
+
+    n-grams seen in only one reference document are left out to keep the table small; they
+    get the same weight as unseen ones, which is nearly what they'd have had anyway.
+    """
+
+    documents: int
+    df: Dict[int, int]
+
+    @staticmethod
+    def fit(documents: Sequence[str]) -> "IdfTable":
+        df = Counter(f for doc in documents for f in hashed_features(doc))
+        return IdfTable(documents=len(documents), df={f: d for f, d in df.items() if d > 1})
+
+    def weights(self) -> Tuple[Dict[int, float], float]:
+        """The IDF of each known feature, and of features the corpus never had."""
+        n = self.documents + 1
+        return {f: math.log(n / (1 + d)) + 1 for f, d in self.df.items()}, math.log(n) + 1
+
+
+def similarity_scores(spec: str, documents: Sequence[str], idf_table: IdfTable) -> List[float]:
+    """Cosine similarity between the spec and each document, as TF-IDF vectors of hashed n-grams.
+
+    Document frequencies come from `idf_table` rather than the documents being scored, so a
+    document's score doesn't depend on what else happens to be scored with it.
+    """
+    idf, default_idf = idf_table.weights()
+    spec_vector = _tfidf(hashed_features(spec), idf, default_idf)
+    scores = []
+    for doc in documents:
+        vector = _tfidf(hashed_features(doc), idf, default_idf)
+        scores.append(sum(w * spec_vector[f] for f, w in vector.items() if f in spec_vector))
+    return scores
+
+
+def read_spec(spec_name: str) -> str:
+    with open(file_relative_path(__file__, f"../agent/prompts/specs/{spec_name}.txt"), "r") as f:
+        return f.read()
+
+
+def threshold_for_recall(relevant_scores: Sequence[float], recall: float) -> Optional[float]:
+    """The highest threshold that keeps at least `recall` of the relevant documents."""
+    if not relevant_scores:
+        return None
+    ranked = sorted(relevant_scores, reverse=True)
+    return ranked[max(math.ceil(recall * len(ranked)) - 1, 0)]
+
+
+class RecallReport(BaseModel):
+    samples: int
+    relevant: int
+    recall: Optional[float]
+    pass_rate: Optional[float]
+    threshold_for_target_recall: Optional[float]
+
+
+def format_recall_report(name: str, report: RecallReport, target_recall: float) -> str:
+    def percent(value: Optional[float]) -> str:
+        return "-" if value is None else f"{value:.1%}"
+
+    threshold = report.threshold_for_target_recall
+    return "\n".join([
+        f"{name}: {report.samples} audited, {report.relevant} relevant",
+        f"  recall {percent(report.recall)}, pass rate {percent(report.pass_rate)}",
+        f"  threshold for {target_recall:.0%} recall: {'-' if threshold is None else f'{threshold:.3f}'}",
+    ])
+
+
+class SemanticPrefilter(ConfigurableResource):
+    """Scores documents against a spec's description locally, so that keyword candidates which
+    are plainly off topic never reach the LLM.
+
+    A document passes if its score is at least the spec's threshold in `thresholds`, or
+    `default_threshold` for specs without one.
+
+    IDF weights are fitted once, on the `reference_size` most recent documents stored in the
+    database at `db_path` (SQLITE_DATABASE_PATH by default), and kept at `idf_path`
+    (prefilter_idf.json next to the database by default) so thresholds mean the same thing in
+    every partition. Delete the file to refit them.
+
+    An `audit_rate` share of candidates, picked by a hash of their text, reaches the LLM
+    whatever its score. Recall is measured against the LLM's labels on the most recent
+    `history_limit` of those, since every other labelled document already passed the filter.
+    It's reported by the admin `classifier eval` command rather than by every partition.
+    """
+
+    thresholds: Dict[str, float] = {}
+    default_threshold: float = 0.02
+    target_recall: float = 0.95
+    history_limit: int = 500
+    audit_rate: float = 0.05
+    db_path: Optional[str] = None
+    idf_path: Optional[str] = None
+    reference_size: int = 5000
+    _idf_table: Optional[IdfTable] = None
+    _database: Optional[Database] = None
+
+    def _db_path(self) -> str:
+        db_path = self.db_path or os.getenv('SQLITE_DATABASE_PATH')
+        if db_path is None:
+            raise ValueError("SQLITE_DATABASE_PATH environment variable is not set.")
+        return db_path
+
+    def _get_database(self) -> Database:
+        if self._database is None:
+            database = Database(db_path=self._db_path())
+            database.create_tables()
+            self._database = database
+        return self._database
+
+    def close(self):
+        if self._database is not None:
+            self._database.close()
+            self._database = None
+
+    def teardown_after_execution(self, context: InitResourceContext) -> None:
+        self.close()
+
+    def idf_table(self, documents: Sequence[str]) -> IdfTable:
+        """The fixed IDF table, fitted on first use. Until enough documents are stored to fit
+        it, one is fitted on `documents` each time, and not kept."""
+        if self._idf_table is not None:
+            return self._idf_table
+
+        path = self.idf_path or os.path.join(os.path.dirname(self._db_path()), "prefilter_idf.json")
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self._idf_table = IdfTable.model_validate_json(f.read())
+            return self._idf_table
+
+        reference = [document_text(title, content)
+                     for title, content in self._get_database().get_recent_documents(self.reference_size)]
+        if len(reference) < MIN_REFERENCE_DOCUMENTS:
+            return IdfTable.fit(documents)
+        table = IdfTable.fit(reference)
+        # written aside and moved into place, since several assets may fit it at once
+        partial_path = f"{path}.{os.getpid()}.tmp"
+        with open(partial_path, "w") as f:
+            f.write(table.model_dump_json())
+        os.replace(partial_path, path)
+        self._idf_table = table
+        return table
+
+    def threshold(self, spec_name: str) -> float:
+        return self.thresholds.get(spec_name, self.default_threshold)
+
+    def is_audited(self, document: str) -> bool:
+        return zlib.crc32(document.encode()) % AUDIT_BUCKETS < self.audit_rate * AUDIT_BUCKETS
+
+    def score(self, spec_name: str, documents: Sequence[str]) -> List[float]:
+        return similarity_scores(read_spec(spec_name), documents, self.idf_table(documents))
+
+    def historical_recall(self, spec_name: str, label: str) -> RecallReport:
+        """How many of the audited documents the LLM labelled relevant under `label` would have
+        passed."""
+        rows = self._get_database().get_labelled_documents(label, math.ceil(self.history_limit / self.audit_rate))
+        rows = [
+            (document_text(title, content), value) for title, content, value in rows
+            if self.is_audited(document_text(title, content))
+        ][:self.history_limit]
+
+        documents = [document for document, _ in rows]
+        relevant = [bool(json.loads(value).get("relevant")) for _, value in rows]
+        scores = self.score(spec_name, documents)
+        threshold = self.threshold(spec_name)
+
+        relevant_scores = [s for s, r in zip(scores, relevant) if r]
+        passed = [s >= threshold for s in scores]
+        return RecallReport(
+            samples=len(rows),
+            relevant=len(relevant_scores),
+            recall=sum(s >= threshold for s in relevant_scores) / len(relevant_scores) if relevant_scores else None,
+            pass_rate=sum(passed) / len(passed) if passed else None,
+            threshold_for_target_recall=threshold_for_recall(relevant_scores, self.target_recall),
+        )
@@ -0,0 +1,116 @@
+import json
+import time
+
+from dagster import (DagsterRunStatus, PartitionKeyRange, RunRequest,
+                     RunStatusSensorContext, SensorEvaluationContext,
+                     SkipReason, run_status_sensor, sensor)
+
+from .jobs import curate1_job, curate1_stories_job
+from .partitions import hourly_partitions
+from .resources.hn_resource import HNClient
+
+# bounds the work done in one tick, so a tick stays well inside the daemon's time limit
+MAX_ITEMS_PER_TICK = 5000
+
+# the updates feed only lists the last few minutes' changes, so after a longer gap between
+# ticks the tail can't vouch for the items it fetched before
+MAX_TAIL_GAP_SECONDS = 5 * 60
+
+# tags dagster puts on single-partition runs and on single-run backfills of a partition range
+PARTITION_TAG = "dagster/partition"
+PARTITION_RANGE_START_TAG = "dagster/asset_partition_range_start"
+PARTITION_RANGE_END_TAG = "dagster/asset_partition_range_end"
+
+
+@sensor(job=curate1_stories_job, minimum_interval_seconds=60)
+def hn_tail_sensor(context: SensorEvaluationContext, hn_client: HNClient):
+    """Tails new and updated items into the item store, and kicks off each hourly partition
+    as soon as it closes, when its items are already local. Partitions that closed while the
+    sensor was behind are all started once it catches up.
+
+    Since every change to the items tailed is applied as it happens, the local copies of the
+    items of partitions not started yet are marked current on each tick, so their runs are
+    served from the store rather than refetching items that haven't settled.
+
+    Only stories are started here; `stories_done_sensor` follows each with curate1_job."""
+    cursor = json.loads(context.cursor) if context.cursor else {}
+    now = time.time()
+
+    max_item_id = hn_client.fetch_max_item_id()
+    last_item_id = cursor.get("last_item_id", max_item_id)
+    previous_item_id = last_item_id
+    # the first item the tail has followed without a gap, among those of unstarted partitions
+    current_from_id = cursor.get("current_from_id", last_item_id + 1)
+    if now - cursor.get("tailed_at", now) > MAX_TAIL_GAP_SECONDS:
+        current_from_id = last_item_id + 1
+    new_ids = range(last_item_id + 1, min(max_item_id, last_item_id + MAX_ITEMS_PER_TICK) + 1)
+    if new_ids:
+        hn_client.fetch_items_by_ids(new_ids)
+        last_item_id = new_ids[-1]
+
+    updated_ids = hn_client.fetch_updated_item_ids()
+    if updated_ids:
+        hn_client.refresh_items_by_ids(updated_ids)
+    if current_from_id <= last_item_id:
+        hn_client.mark_items_current(current_from_id, last_item_id)
+
+    context.log.info(
+        f"Tailed {len(new_ids)} new items up to {last_item_id}, refreshed {len(updated_ids)} items."
+    )
+
+    # only start a partition once the tail has caught up past its end
+    closed_partition = hourly_partitions.get_last_partition_key()
+    caught_up = last_item_id == max_item_id
+    run_requests = []
+
+    if (
+        caught_up
+        and closed_partition is not None
+        and "last_closed_partition" in cursor
+        and closed_partition != cursor["last_closed_partition"]
+    ):
+        # every partition that closed since the last tick, in case the sensor fell behind
+        newly_closed = hourly_partitions.get_partition_keys_in_range(
+            PartitionKeyRange(cursor["last_closed_partition"], closed_partition))[1:]
+        for partition in newly_closed:
+            run_requests.append(RunRequest(run_key=f"stories-{partition}", partition_key=partition))
+        # the items of the partitions started now were just marked current, so from here on
+        # only those tailed since the last tick, some of which are in the next partition, are
+        current_from_id = max(current_from_id, previous_item_id + 1)
+
+    if caught_up:
+        cursor["last_closed_partition"] = closed_partition
+    cursor["last_item_id"] = last_item_id
+    cursor["current_from_id"] = current_from_id
+    cursor["tailed_at"] = now
+    context.update_cursor(json.dumps(cursor))
+
+    if not run_requests:
+        return SkipReason(f"No partition to start; tailed up to item {last_item_id}.")
+    return run_requests
+
+
+@run_status_sensor(
+    run_status=DagsterRunStatus.SUCCESS,
+    monitored_jobs=[curate1_stories_job],
+    request_job=curate1_job,
+)
+def stories_done_sensor(context: RunStatusSensorContext):
+    """Runs curate1_job for every partition a successful curate1_stories_job run covered.
+
+    stories backfills in single runs, so it can't share a job with the rest of the assets,
+    which back each partition up in its own run. Starting either a partition or a backfill
+    of curate1_stories_job therefore processes the whole pipeline for those partitions."""
+    tags = context.dagster_run.tags
+    if PARTITION_RANGE_START_TAG in tags:
+        partitions = hourly_partitions.get_partition_keys_in_range(PartitionKeyRange(
+            tags[PARTITION_RANGE_START_TAG], tags[PARTITION_RANGE_END_TAG]))
+    elif PARTITION_TAG in tags:
+        partitions = [tags[PARTITION_TAG]]
+    else:
+        return SkipReason(f"Run {context.dagster_run.run_id} wasn't partitioned.")
+
+    return [
+        RunRequest(run_key=f"{context.dagster_run.run_id}-{partition}", partition_key=partition)
+        for partition in partitions
+    ]
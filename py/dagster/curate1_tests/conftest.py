@@ -0,0 +1,23 @@
+from typing import Iterator
+
+import pytest
+
+from curate1.resources.agent.llm_executor import LlmExecutor
+
+from .fake_openai_server import FakeOpenAIServer
+
+
+@pytest.fixture
+def fake_openai(monkeypatch: pytest.MonkeyPatch, tmp_path) -> Iterator[FakeOpenAIServer]:
+    """A local fake of the chat completions endpoint that `OpenAI()` clients are pointed at,
+    with a fresh response cache, for exercising concurrency, rate limiting and caching offline.
+
+    Set `fake_openai.config` to inject latency and errors, and read `fake_openai.stats` after."""
+    server = FakeOpenAIServer().start()
+    monkeypatch.setenv("OPENAI_BASE_URL", server.base_url)
+    monkeypatch.setenv("OPENAI_API_KEY", "fake")
+    monkeypatch.setenv("SQLITE_DATABASE_PATH", str(tmp_path / "curate1.db"))
+    LlmExecutor.reset_shared()
+    yield server
+    LlmExecutor.reset_shared()
+    server.stop()
@@ -0,0 +1,365 @@
+"""A local stand-in for the OpenAI chat completions endpoint, for testing and load-testing the
+agent layer without spending money or hitting real rate limits. It also serves enough of the
+files and batches endpoints to run batch jobs.
+
+Verdicts are deterministic: a document is relevant if it contains one of the configured
+keywords. Latency, rate limiting, server errors and malformed responses can be injected at
+configurable rates, from a seeded random source so runs are repeatable.
+
+Run it on its own with `python -m curate1_tests.fake_openai_server --port 8000`, and point
+OPENAI_BASE_URL at http://127.0.0.1:8000/v1.
+"""
+import argparse
+import email.policy
+import json
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+SEARCH_DESCRIPTION_PATTERN = re.compile(r"^SEARCH DESCRIPTION \((.+)\):$", re.MULTILINE)
+PACKED_DOCUMENT_PATTERN = re.compile(r"^DOCUMENT (\d+):$", re.MULTILINE)
+FILE_CONTENT_PATH_PATTERN = re.compile(r"/files/([^/]+)/content$")
+BATCH_PATH_PATTERN = re.compile(r"/batches/([^/]+)$")
+
+
+@dataclass
+class FakeServerConfig:
+    # "fixed", "uniform" (latency_seconds plus or minus latency_spread of it) or "lognormal"
+    # (median latency_seconds, sigma latency_spread)
+    latency_distribution: str = "fixed"
+    latency_seconds: float = 0.0
+    latency_spread: float = 0.5
+    # fractions of requests answered with a 429, with a 500 or 503, or with malformed JSON
+    rate_limit_rate: float = 0.0
+    server_error_rate: float = 0.0
+    malformed_rate: float = 0.0
+    # how long a 429 asks the client to wait before retrying
+    retry_after_seconds: float = 0.01
+    # documents containing any of these, in any case, are relevant
+    relevant_keywords: List[str] = field(default_factory=lambda: ["terraform", "pulumi", "copilot", "llm"])
+    confidence: float = 0.9
+    # how many times a batch is reported in progress before it completes
+    batch_in_progress_polls: int = 0
+    seed: int = 0
+
+
+@dataclass
+class FakeServerStats:
+    requests: int = 0
+    rate_limited: int = 0
+    server_errors: int = 0
+    malformed: int = 0
+    in_flight: int = 0
+    max_in_flight: int = 0
+    models: Dict[str, int] = field(default_factory=dict)
+
+
+def _document_text(messages: List[Dict[str, Any]]) -> str:
+    """The user prompt the model is answering. When it's being asked again after a bad
+    response, that's the first user message, not the follow-up."""
+    user_messages = [m["content"] for m in messages if m.get("role") == "user"]
+    return user_messages[0] if user_messages else ""
+
+
+def _system_prompt(messages: List[Dict[str, Any]]) -> str:
+    return next((m["content"] for m in messages if m.get("role") == "system"), "")
+
+
+class FakeOpenAIServer:
+    def __init__(self, config: Optional[FakeServerConfig] = None, host: str = "127.0.0.1", port: int = 0):
+        self.config = config or FakeServerConfig()
+        self.stats = FakeServerStats()
+        self.lock = threading.Lock()
+        self.random = random.Random(self.config.seed)
+        # uploaded files' contents and batches, by id
+        self.files: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "FakeOpenAIServer":
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="fake-openai", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset(self, config: Optional[FakeServerConfig] = None):
+        """Starts over with fresh stats, and a new config if given."""
+        with self.lock:
+            self.config = config or self.config
+            self.stats = FakeServerStats()
+            self.random = random.Random(self.config.seed)
+
+    def _latency(self) -> float:
+        config = self.config
+        if config.latency_distribution == "uniform":
+            spread = config.latency_seconds * config.latency_spread
+            return max(self.random.uniform(config.latency_seconds - spread, config.latency_seconds + spread), 0.0)
+        if config.latency_distribution == "lognormal":
+            return self.random.lognormvariate(0, config.latency_spread) * config.latency_seconds
+        return config.latency_seconds
+
+    def _draw(self) -> Tuple[float, Optional[int], bool]:
+        """The latency, injected error status if any, and whether to malform the response."""
+        with self.lock:
+            latency = self._latency()
+            outcome = self.random.random()
+            config = self.config
+            if outcome < config.rate_limit_rate:
+                self.stats.rate_limited += 1
+                return latency, 429, False
+            outcome -= config.rate_limit_rate
+            if outcome < config.server_error_rate:
+                self.stats.server_errors += 1
+                return latency, self.random.choice([500, 503]), False
+            outcome -= config.server_error_rate
+            if outcome < config.malformed_rate:
+                self.stats.malformed += 1
+                return latency, None, True
+            return latency, None, False
+
+    def _relevant(self, document: str) -> bool:
+        document = document.lower()
+        return any(keyword.lower() in document for keyword in self.config.relevant_keywords)
+
+    def _verdict(self, document: str, with_confidence: bool) -> Dict[str, Any]:
+        relevant = self._relevant(document)
+        verdict: Dict[str, Any] = {
+            "relevant": relevant,
+            "reasoning": "The document mentions a topic of interest." if relevant else "The document is off topic.",
+        }
+        if with_confidence:
+            verdict["confidence"] = self.config.confidence
+        return verdict
+
+    def respond(self, messages: List[Dict[str, Any]]) -> str:
+        """The content of a response to `messages`, recognizing the agent layer's prompts."""
+        system_prompt = _system_prompt(messages)
+        user_prompt = _document_text(messages)
+        with_confidence = "confidence: float" in system_prompt
+        descriptions, separator, document = user_prompt.partition("DOCUMENT CONTENT:")
+
+        if "- summary: str" in system_prompt:
+            summary = " ".join(document.split()[:60])
+            return json.dumps({"summary": summary, "reasoning": "Summarized the parts of interest."})
+
+        spec_names = SEARCH_DESCRIPTION_PATTERN.findall(descriptions)
+        if spec_names:
+            return json.dumps({name: self._verdict(document, with_confidence) for name in spec_names})
+
+        packed = PACKED_DOCUMENT_PATTERN.split(user_prompt)
+        if not separator and len(packed) > 1:
+            documents = packed[2::2]
+            return json.dumps([
+                {"index": i, **self._verdict(doc, with_confidence)} for i, doc in enumerate(documents, start=1)
+            ])
+
+        return "```json\n" + json.dumps(self._verdict(document, with_confidence)) + "\n```"
+
+    def complete(self, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any], Dict[str, str]]:
+        """The status, body and headers of the response to a chat completion request."""
+        model = body.get("model", "")
+        with self.lock:
+            stats = self.stats
+            stats.requests += 1
+            stats.models[model] = stats.models.get(model, 0) + 1
+            stats.in_flight += 1
+            stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+            request_number = stats.requests
+        try:
+            latency, status, malformed = self._draw()
+            time.sleep(latency)
+            if status == 429:
+                retry_after = self.config.retry_after_seconds
+                return (
+                    429,
+                    {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                    {"retry-after-ms": str(int(retry_after * 1000)), "retry-after": str(retry_after)},
+                )
+            if status is not None:
+                return status, {"error": {"message": "The server had an error", "type": "server_error"}}, {}
+
+            messages = body.get("messages", [])
+            content = self.respond(messages)
+            if malformed:
+                content = content[:max(len(content) // 2, 1)]
+            prompt_tokens = len(json.dumps(messages)) // 4
+            completion_tokens = len(content) // 4
+            return 200, {
+                "id": f"chatcmpl-fake-{request_number}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": content},
+                }],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            }, {}
+        finally:
+            with self.lock:
+                self.stats.in_flight -= 1
+
+    def create_file(self, data: bytes, filename: str, purpose: str) -> Dict[str, Any]:
+        with self.lock:
+            file_id = f"file-fake-{len(self.files)}"
+            self.files[file_id] = data
+        return {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(data),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+
+    def create_batch(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        """Runs every request in the batch's input file straight away. Failed requests are
+        written to the output with their status code, as the batch API does."""
+        lines = []
+        for line in self.files[body["input_file_id"]].decode().splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            status, response_body, _ = self.complete(request["body"])
+            lines.append({
+                "id": f"batch_req_{len(lines)}",
+                "custom_id": request["custom_id"],
+                "response": {"status_code": status, "body": response_body},
+                "error": None,
+            })
+        output = self.create_file(
+            "".join(json.dumps(line) + "\n" for line in lines).encode(), "batch_output.jsonl", "batch_output")
+        with self.lock:
+            batch_id = f"batch_fake_{len(self.batches)}"
+            self.batches[batch_id] = {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": body["endpoint"],
+                "input_file_id": body["input_file_id"],
+                "completion_window": body["completion_window"],
+                "created_at": int(time.time()),
+                "status": "in_progress",
+                "output_file_id": output["id"],
+                "polls": 0,
+            }
+        return self.retrieve_batch(batch_id)
+
+    def retrieve_batch(self, batch_id: str) -> Dict[str, Any]:
+        """The batch, which stays in progress for the first `batch_in_progress_polls` times it's
+        retrieved."""
+        with self.lock:
+            batch = self.batches[batch_id]
+            batch["polls"] += 1
+            done = batch["polls"] > self.config.batch_in_progress_polls
+            batch["status"] = "completed" if done else "in_progress"
+            return {k: v for k, v in batch.items() if k != "polls" and (done or k != "output_file_id")}
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status: int, body: Any, headers: Optional[Dict[str, str]] = None):
+                data = body if isinstance(body, bytes) else json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/octet-stream" if isinstance(body, bytes) else "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _not_found(self):
+                self._send(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                path = self.path.rstrip("/")
+                if path.endswith("/chat/completions"):
+                    self._send(*server.complete(json.loads(raw or b"{}")))
+                elif path.endswith("/files"):
+                    form = BytesParser(policy=email.policy.HTTP).parsebytes(
+                        f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + raw)
+                    fields = {part.get_param("name", header="content-disposition"): part for part in form.iter_parts()}
+                    self._send(200, server.create_file(
+                        fields["file"].get_payload(decode=True),
+                        fields["file"].get_filename() or "upload",
+                        fields["purpose"].get_content(),
+                    ))
+                elif path.endswith("/batches"):
+                    self._send(200, server.create_batch(json.loads(raw or b"{}")))
+                else:
+                    self._not_found()
+
+            def do_GET(self):
+                match = FILE_CONTENT_PATH_PATTERN.search(self.path)
+                if match and match.group(1) in server.files:
+                    self._send(200, server.files[match.group(1)])
+                    return
+                match = BATCH_PATH_PATTERN.search(self.path)
+                if match and match.group(1) in server.batches:
+                    self._send(200, server.retrieve_batch(match.group(1)))
+                    return
+                self._not_found()
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency-distribution", default="fixed", choices=["fixed", "uniform", "lognormal"])
+    parser.add_argument("--latency-seconds", type=float, default=0.0)
+    parser.add_argument("--latency-spread", type=float, default=0.5)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--server-error-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = FakeServerConfig(
+        latency_distribution=args.latency_distribution,
+        latency_seconds=args.latency_seconds,
+        latency_spread=args.latency_spread,
+        rate_limit_rate=args.rate_limit_rate,
+        server_error_rate=args.server_error_rate,
+        malformed_rate=args.malformed_rate,
+        seed=args.seed,
+    )
+    server = FakeOpenAIServer(config, port=args.port)
+    print(f"Serving fake chat completions at {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import json
+from typing import List, Optional
+
+from curate1.resources.agent.agent_resource import (BatchAgentClient,
+                                                    OpenAIAgentClient)
+from curate1.resources.agent.filter_spec import Relevance
+from curate1.resources.agent.model import AnnotatedDoc
+from curate1.resources.agent.telemetry import CallMetric, CallRecorder, rollup
+
+from .fake_openai_server import FakeOpenAIServer, FakeServerConfig
+
+DOCUMENTS = ["Writing terraform modules", "Growing tomatoes", "An llm for code review"]
+
+RELEVANT = [True, False, True]
+
+
+def verdicts(annotated_docs: List[Optional[AnnotatedDoc]]) -> List[bool]:
+    assert all(doc is not None for doc in annotated_docs)
+    return [json.loads(doc.annotation)["relevant"] for doc in annotated_docs if doc is not None]
+
+
+def assert_cached(client: OpenAIAgentClient, fake_openai: FakeOpenAIServer, documents: List[str], relevant: List[bool]):
+    """Annotating `documents` again is answered from the cache, without any new request."""
+    requests = fake_openai.stats.requests
+    mark = client.call_metrics_mark()
+    annotated_docs = client.filter_spec_batch("iac", Relevance.MAYBE_RELEVANT, documents)
+    assert verdicts(annotated_docs) == relevant
+    assert fake_openai.stats.requests == requests
+    metrics = client.call_metrics_since(mark)
+    assert metrics and all(metric.cache_hit for metric in metrics)
+
+
+def test_filter_spec_batch_sends_one_request_per_document(fake_openai: FakeOpenAIServer):
+    client = OpenAIAgentClient(pack_documents=False)
+    mark = client.call_metrics_mark()
+
+    annotated_docs = client.filter_spec_batch("iac", Relevance.MAYBE_RELEVANT, DOCUMENTS)
+
+    assert verdicts(annotated_docs) == RELEVANT
+    assert fake_openai.stats.requests == 3
+    assert fake_openai.stats.models == {"gpt-3.5-turbo": 3}
+    metrics = client.call_metrics_since(mark)
+    assert len(metrics) == 3
+    assert not any(metric.cache_hit for metric in metrics)
+    assert all(metric.prompt_tokens > 0 and metric.cost > 0 for metric in metrics)
+    assert_cached(client, fake_openai, DOCUMENTS, RELEVANT)
+
+
+def test_filter_spec_batch_packs_short_documents(fake_openai: FakeOpenAIServer):
+    client = OpenAIAgentClient()
+
+    annotated_docs = client.filter_spec_batch("iac", Relevance.MAYBE_RELEVANT, DOCUMENTS)
+
+    assert verdicts(annotated_docs) == RELEVANT
+    assert fake_openai.stats.requests == 1
+    assert [doc.pack_size for doc in annotated_docs if doc is not None] == [3, 3, 3]
+    # verdicts are cached per document, so they're found whatever they're packed with
+    assert_cached(client, fake_openai, DOCUMENTS[::-1], RELEVANT[::-1])
+    assert_cached(client, fake_openai, DOCUMENTS[:1], RELEVANT[:1])
+
+
+def test_filter_multi_spec_batch_judges_every_spec_in_one_request(fake_openai: FakeOpenAIServer):
+    client = OpenAIAgentClient()
+    specs = ["iac", "coding-with-ai"]
+
+    annotated = client.filter_multi_spec_batch(specs, Relevance.MAYBE_RELEVANT, DOCUMENTS)
+
+    assert fake_openai.stats.requests == 3
+    assert [sorted(by_spec) for by_spec in annotated] == [sorted(specs)] * 3
+    for spec_name in specs:
+        assert verdicts([by_spec[spec_name] for by_spec in annotated]) == RELEVANT
+
+    client.filter_multi_spec_batch(specs, Relevance.MAYBE_RELEVANT, DOCUMENTS)
+    assert fake_openai.stats.requests == 3
+
+
+def test_rate_limited_requests_are_retried(fake_openai: FakeOpenAIServer):
+    fake_openai.reset(FakeServerConfig(rate_limit_rate=0.3, seed=2))
+    client = OpenAIAgentClient(pack_documents=False)
+    documents = [f"{document} {i}" for i in range(4) for document in DOCUMENTS]
+    mark = client.call_metrics_mark()
+
+    annotated_docs = client.filter_spec_batch("iac", Relevance.MAYBE_RELEVANT, documents)
+
+    assert verdicts(annotated_docs) == RELEVANT * 4
+    assert fake_openai.stats.rate_limited > 0
+    assert fake_openai.stats.requests == len(documents) + fake_openai.stats.rate_limited
+    assert rollup(client.call_metrics_since(mark))["LLM retries"] == fake_openai.stats.rate_limited
+
+    fake_openai.reset(FakeServerConfig())
+    client.filter_spec_batch("iac", Relevance.MAYBE_RELEVANT, documents)
+    assert fake_openai.stats.requests == 0
+
+
+def test_server_errors_are_retried_and_counted(fake_openai: FakeOpenAIServer):
+    fake_openai.reset(FakeServerConfig(server_error_rate=0.3, seed=4))
+    client = OpenAIAgentClient(pack_documents=False)
+    documents = [f"{document} {i}" for i in range(4) for document in DOCUMENTS]
+    mark = client.call_metrics_mark()
+
+    annotated_docs = client.filter_spec_batch("iac", Relevance.MAYBE_RELEVANT, documents)
+
+    assert verdicts(annotated_docs) == RELEVANT * 4
+    assert fake_openai.stats.server_errors > 0
+    assert fake_openai.stats.requests == len(documents) + fake_openai.stats.server_errors
+    metrics = client.call_metrics_since(mark)
+    assert sum(metric.retries for metric in metrics) == fake_openai.stats.server_errors
+
+
+def test_malformed_responses_are_asked_again(fake_openai: FakeOpenAIServer):
+    fake_openai.reset(FakeServerConfig(malformed_rate=0.3, seed=3))
+    client = OpenAIAgentClient(pack_documents=False)
+    documents = [f"{document} {i}" for i in range(4) for document in DOCUMENTS]
+    mark = client.call_metrics_mark()
+
+    annotated_docs = client.filter_spec_batch("iac", Relevance.MAYBE_RELEVANT, documents)
+
+    assert verdicts(annotated_docs) == RELEVANT * 4
+    assert fake_openai.stats.malformed > 0
+    assert fake_openai.stats.requests == len(documents) + fake_openai.stats.malformed
+    metrics = client.call_metrics_since(mark)
+    assert sum(metric.attempts - 1 for metric in metrics) == fake_openai.stats.malformed
+
+    # only the valid responses were cached, and those are all that's needed
+    fake_openai.reset(FakeServerConfig())
+    client.filter_spec_batch("iac", Relevance.MAYBE_RELEVANT, documents)
+    assert fake_openai.stats.requests == 0
+
+
+def test_requests_answered_by_a_batch_are_counted_once(fake_openai: FakeOpenAIServer, tmp_path):
+    client = BatchAgentClient(
+        batch_backend="local", local_batch_dir=str(tmp_path / "batches"), poll_interval_seconds=0, pack_documents=False)
+    mark = client.call_metrics_mark()
+
+    annotated_docs = client.filter_spec_batch("iac", Relevance.MAYBE_RELEVANT, DOCUMENTS)
+
+    assert verdicts(annotated_docs) == RELEVANT
+    assert fake_openai.stats.requests == 3
+    metrics = client.call_metrics_since(mark)
+    assert len(metrics) == 3
+    assert not any(metric.cache_hit for metric in metrics)
+    # once the batch's calls are settled, the documents are ordinary cache hits
+    assert_cached(client, fake_openai, DOCUMENTS, RELEVANT)
+
+
+def test_failed_calls_are_counted(fake_openai: FakeOpenAIServer):
+    fake_openai.reset(FakeServerConfig(malformed_rate=1.0))
+    client = OpenAIAgentClient(pack_documents=False)
+    mark = client.call_metrics_mark()
+
+    annotated_docs = client.filter_spec_batch("iac", Relevance.MAYBE_RELEVANT, DOCUMENTS)
+
+    assert annotated_docs == [None, None, None]
+    metrics = client.call_metrics_since(mark)
+    assert [metric.error for metric in metrics] == ["ValueError"] * 3
+    assert rollup(metrics)["LLM calls failed"] == 3
+
+
+def test_recorder_keeps_only_the_metrics_open_marks_can_read():
+    recorder = CallRecorder(None)
+
+    def record(n: int):
+        for _ in range(n):
+            recorder.record(CallMetric("gpt-4o", 1, 1, 0.1, 1, False, 0.0))
+
+    record(2)
+    outer = recorder.mark()
+    record(3)
+    inner = recorder.mark()
+    record(1)
+
+    assert len(recorder.since(outer)) == 4
+    assert len(recorder.metrics) == 1
+    record(2)
+    assert len(recorder.since(inner)) == 3
+    assert recorder.metrics == []
+
+    record(5)
+    mark = recorder.mark()
+    record(1)
+    assert len(recorder.since(mark)) == 1
+    assert recorder.metrics == []
@@ -0,0 +1,27 @@
+import pytest
+
+from curate1.resources.article_cache.article_cache import canonicalize_url
+
+
+@pytest.mark.parametrize("variant, url", [
+    ("http://www.example.com:80/post/?utm_source=hn&b=2&a=1#comments", "https://example.com/post?a=1&b=2"),
+    ("https://example.com/post?ref=hackernews", "https://example.com/post"),
+    ("https://example.com:8080/post", "https://example.com:8080/post"),
+    ("http://[::1", "http://[::1"),
+])
+def test_variants_of_a_url_share_a_key(variant: str, url: str):
+    assert canonicalize_url(variant) == url
+
+
+def test_branches_on_code_hosts_are_kept_apart():
+    main = canonicalize_url("https://github.com/org/repo/blob/README.md?ref=main")
+    dev = canonicalize_url("https://github.com/org/repo/blob/README.md?ref=dev")
+    assert main != dev
+    assert canonicalize_url("https://gist.github.com/org/1?ref=main").endswith("?ref=main")
+    assert canonicalize_url("https://notgithub.com/org/repo?ref=main") == "https://notgithub.com/org/repo"
+
+
+def test_hash_routes_are_kept_apart():
+    assert canonicalize_url("https://app.example.com/#/posts/1") == "https://app.example.com/#/posts/1"
+    assert canonicalize_url("https://app.example.com/#!/posts/1") != canonicalize_url("https://app.example.com/#!/posts/2")
+    assert canonicalize_url("https://example.com/post#section-2") == "https://example.com/post"
@@ -0,0 +1,194 @@
+import asyncio
+import email.utils
+import math
+import time
+from collections import Counter, defaultdict
+from typing import Callable, Dict, List, Optional
+
+import httpx
+import pytest
+
+from curate1.resources import article_resource
+from curate1.resources.article_resource import (AsyncWebArticleClient,
+                                                BatchStats, CircuitBreaker,
+                                                SkipArticle,
+                                                retry_after_seconds)
+
+HTML = "<html><body><p>An article.</p></body></html>"
+
+
+def html_response(status_code: int = 200, **kwargs) -> httpx.Response:
+    headers = {"Content-Type": "text/html; charset=utf-8", **kwargs.pop("headers", {})}
+    return httpx.Response(status_code, headers=headers, **kwargs)
+
+
+def download(
+    article_client: AsyncWebArticleClient,
+    handler: Callable,
+    urls: List[str],
+    breakers: Optional[Dict[str, CircuitBreaker]] = None,
+    deadline: float = math.inf,
+) -> List:
+    """Downloads `urls` concurrently against `handler`, as a batch does, returning each
+    download's result or the exception it raised."""
+    breakers = breakers if breakers is not None else defaultdict(lambda: CircuitBreaker(3, 60))
+
+    async def run():
+        global_limit = asyncio.Semaphore(article_client.max_concurrency)
+        host_limits = defaultdict(lambda: asyncio.Semaphore(article_client.max_per_host))
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await asyncio.gather(*(
+                article_client._download(
+                    client, url, {}, deadline, global_limit,
+                    host_limits[httpx.URL(url).host], breakers[httpx.URL(url).host])
+                for url in urls
+            ), return_exceptions=True)
+
+    return asyncio.run(run())
+
+
+def test_downloads_are_limited_per_host():
+    in_flight: Counter = Counter()
+    most_in_flight: Counter = Counter()
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        in_flight[host] += 1
+        most_in_flight[host] = max(most_in_flight[host], in_flight[host])
+        await asyncio.sleep(0.01)
+        in_flight[host] -= 1
+        return html_response(text=HTML)
+
+    urls = [f"https://{host}.example.com/{i}" for host in ("a", "b") for i in range(8)]
+    results = download(AsyncWebArticleClient(max_per_host=2, max_concurrency=32), handler, urls)
+
+    assert all(result.status_code == 200 for result in results)
+    assert most_in_flight == {"a.example.com": 2, "b.example.com": 2}
+
+
+def test_circuit_breaker_opens_after_consecutive_failures(monkeypatch: pytest.MonkeyPatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    breaker = CircuitBreaker(threshold=3, cooldown_seconds=60)
+
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    # half open after the cooldown: one more failure opens it again
+    now[0] += 60
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    # and a success closes it
+    now[0] += 60
+    assert breaker.allow()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.allow()
+
+
+def test_open_circuit_skips_the_host_without_requests():
+    requests: Counter = Counter()
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests[request.url.host] += 1
+        if request.url.host == "down.example.com":
+            return httpx.Response(500)
+        return html_response(text=HTML)
+
+    urls = [f"https://down.example.com/{i}" for i in range(5)] + ["https://up.example.com/"]
+    results = download(AsyncWebArticleClient(max_per_host=1), handler, urls)
+
+    assert [r.status_code for r in results[:3]] == [500] * 3
+    assert all(isinstance(r, SkipArticle) and "circuit open" in str(r) for r in results[3:5])
+    assert results[5].status_code == 200
+    assert requests == {"down.example.com": 3, "up.example.com": 1}
+
+
+def test_rate_limited_downloads_wait_as_long_as_retry_after_asks(monkeypatch: pytest.MonkeyPatch):
+    delays: List[float] = []
+    real_sleep = asyncio.sleep
+
+    async def sleep(delay: float):
+        delays.append(delay)
+        await real_sleep(0)
+
+    monkeypatch.setattr(article_resource.asyncio, "sleep", sleep)
+    attempts: Counter = Counter()
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        attempts[request.url.path] += 1
+        if attempts[request.url.path] == 1:
+            retry_after = {"/short": "3", "/long": "3600", "/none": None}[request.url.path]
+            return httpx.Response(429, headers={"Retry-After": retry_after} if retry_after else {})
+        return html_response(text=HTML)
+
+    urls = ["https://example.com/short", "https://example.com/long", "https://example.com/none"]
+    results = download(AsyncWebArticleClient(max_retry_delay_seconds=60), handler, urls)
+
+    assert all(result.status_code == 200 for result in results)
+    # as asked, capped at max_retry_delay_seconds, or backing off from a second
+    assert sorted(delays) == [1, 3, 60]
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds(httpx.Headers({"Retry-After": "120"})) == 120
+    assert retry_after_seconds(httpx.Headers({"Retry-After": "-5"})) == 0
+    assert retry_after_seconds(httpx.Headers({})) is None
+    assert retry_after_seconds(httpx.Headers({"Retry-After": "soon"})) is None
+    retry_at = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 28 <= retry_after_seconds(httpx.Headers({"Retry-After": retry_at})) <= 30
+
+
+def test_retries_stop_short_of_the_deadline():
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(503, headers={"Retry-After": "30"})
+
+    [result] = download(AsyncWebArticleClient(), handler, ["https://example.com/"], deadline=time.time() + 10)
+
+    assert isinstance(result, SkipArticle) and "time budget exhausted" in str(result)
+
+
+@pytest.mark.parametrize("response, reason", [
+    (httpx.Response(200, headers={"Content-Type": "image/png"}, content=b"\x89PNG"), "content type image/png"),
+    (html_response(headers={"Content-Length": "6000000"}, content=b"x"), "too large (6000000 bytes)"),
+    (httpx.Response(200, content=b"%PDF-1.7 ..."), "binary content"),
+])
+def test_pages_that_arent_articles_are_skipped(response: httpx.Response, reason: str):
+    [result] = download(AsyncWebArticleClient(), lambda request: response, ["https://example.com/page"])
+
+    assert isinstance(result, SkipArticle)
+    assert str(result) == reason
+
+
+def test_streamed_pages_over_the_size_limit_are_skipped():
+    async def body():
+        for _ in range(10):
+            yield b"<p>" + b"x" * 1000 + b"</p>"
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, headers={"Content-Type": "text/html"}, content=body())
+
+    [result] = download(AsyncWebArticleClient(max_download_bytes=5000), handler, ["https://example.com/big"])
+
+    assert isinstance(result, SkipArticle) and str(result) == "too large (over 5000 bytes)"
+
+
+def test_links_to_files_are_skipped_without_a_request():
+    def handler(request: httpx.Request) -> httpx.Response:
+        raise AssertionError(f"Requested {request.url}")
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await AsyncWebArticleClient()._download_article(
+                client, 0, "https://example.com/paper.PDF", None, [None], BatchStats(), math.inf,
+                asyncio.Semaphore(1), asyncio.Semaphore(1), CircuitBreaker(3, 60))
+
+    with pytest.raises(SkipArticle, match="links to a file"):
+        asyncio.run(run())
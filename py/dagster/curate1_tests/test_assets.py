@@ -1 +1,107 @@
+from typing import Any, Dict, Optional, Tuple
 
+import pandas as pd
+import pytest
+from dagster import PartitionKeyRange, materialize
+
+from curate1.assets.items import drop_failed, stories
+from curate1.partitions import hourly_partitions
+from curate1.resources.agent.model import AnnotatedDoc
+from curate1.resources.hn_resource import HNClient, HNItemRecord
+from curate1.resources.partition_range_io_manager import \
+    PartitionRangeFilesystemIOManager
+from curate1.sensors import PARTITION_RANGE_END_TAG, PARTITION_RANGE_START_TAG
+
+
+def annotated(doc: str) -> AnnotatedDoc:
+    return AnnotatedDoc(doc=doc, annotation='{"relevant": true}')
+
+
+def test_drop_failed_keeps_succeeded_rows():
+    docs = pd.DataFrame({"title": ["a", "b", "c"]}, index=[10, 11, 12])
+
+    kept, annotated_docs, failed = drop_failed(docs, [annotated("a"), None, annotated("c")])
+
+    assert list(kept["title"]) == ["a", "c"]
+    assert list(kept.index) == [10, 12]
+    assert [a.doc for a in annotated_docs] == ["a", "c"]
+    assert failed == 1
+
+
+def test_drop_failed_keeps_columns_of_empty_frame():
+    docs = pd.DataFrame({"title": [], "url": []})
+
+    kept, annotated_docs, failed = drop_failed(docs, [])
+
+    assert list(kept.columns) == ["title", "url"]
+    assert len(kept) == 0
+    assert annotated_docs == []
+    assert failed == 0
+
+
+def test_drop_failed_raises_when_every_document_failed():
+    docs = pd.DataFrame({"title": ["a", "b"]})
+
+    with pytest.raises(Exception, match="Annotating all 2 documents failed"):
+        drop_failed(docs, [None, None])
+
+
+HOUR = 60 * 60
+# the start of a partition, and of the item ids in the fake feed
+T0 = 1_700_002_800
+ITEMS_PER_HOUR = 60
+
+
+def item_time(item_id: int) -> int:
+    # a minute apart, except that the third item of every hour was posted before the hour started
+    if item_id % ITEMS_PER_HOUR == 2:
+        return T0 + (item_id // ITEMS_PER_HOUR) * HOUR - 30
+    return T0 + item_id * HOUR // ITEMS_PER_HOUR
+
+
+class FakeTimedClient(HNClient):
+    def fetch_item_by_id(self, item_id: int) -> Optional[HNItemRecord]:
+        return {"id": item_id, "time": item_time(item_id), "type": "story", "url": f"https://example.com/{item_id}"}
+
+    def fetch_max_item_id(self) -> int:
+        return 10 * ITEMS_PER_HOUR
+
+    def min_item_id(self) -> int:
+        return 0
+
+
+def run_stories(tmp_path, first_key: str, last_key: str) -> Tuple[Dict[str, pd.DataFrame], Dict[str, Any]]:
+    """Materializes stories for a range of partitions in one run, as a single-run backfill does."""
+    result = materialize(
+        [stories],
+        resources={"hn_client": FakeTimedClient(), "io_manager": PartitionRangeFilesystemIOManager(base_dir=str(tmp_path))},
+        tags={PARTITION_RANGE_START_TAG: first_key, PARTITION_RANGE_END_TAG: last_key},
+    )
+    metadata = result.asset_materializations_for_node("stories")[0].metadata
+    return result.output_for_node("stories"), {key: value.value for key, value in metadata.items()}
+
+
+def test_stories_splits_partitions_the_same_in_one_run_or_many(tmp_path):
+    keys = hourly_partitions.get_partition_keys_in_range(PartitionKeyRange(
+        hourly_partitions.get_partition_key_for_timestamp(T0 + HOUR),
+        hourly_partitions.get_partition_key_for_timestamp(T0 + 4 * HOUR)))
+
+    together, metadata = run_stories(tmp_path, keys[0], keys[-1])
+    apart = {key: run_stories(tmp_path, key, key)[0][key] for key in keys}
+
+    assert list(together) == keys
+    ids_together = sorted(i for frame in together.values() for i in frame["id"])
+    ids_apart = sorted(i for frame in apart.values() for i in frame["id"])
+    # every item is in exactly one partition either way
+    assert ids_together == ids_apart == sorted(set(ids_apart))
+    out_of_window = 0
+    for key in keys:
+        window = hourly_partitions.time_window_for_partition_key(key)
+        start, end = int(window.start.timestamp()), int(window.end.timestamp())
+        in_window = lambda frame: set(frame[(frame["time"] >= start) & (frame["time"] < end)]["id"])
+        # an item timed in a neighbouring hour can only be put there when the run covers it
+        assert in_window(apart[key]) <= in_window(together[key])
+        out_of_window += len(together[key]) - len(in_window(together[key]))
+    # only the item timed before the first hour is outside the whole window, and it's kept
+    assert metadata["Out-of-window rows"] == out_of_window == 1
+    assert ITEMS_PER_HOUR + 2 in set(together[keys[0]]["id"])
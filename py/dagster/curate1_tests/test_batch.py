@@ -0,0 +1,162 @@
+import json
+from typing import List
+
+import pytest
+from openai import OpenAI
+
+from curate1.resources.agent.batch import (BATCH_PRICE_FACTOR,
+                                           DbPendingBatchStore,
+                                           LocalBatchBackend,
+                                           OpenAIBatchBackend, run_batches)
+from curate1.resources.agent.middleware import LlmRequest, parse_response
+from curate1.resources.agent.telemetry import CallMetric, estimate_cost
+from curate1.resources.llm_response_cache.llm_response_cache import \
+    DbResponseCache
+
+from .fake_openai_server import FakeOpenAIServer, FakeServerConfig
+
+MODEL = "gpt-3.5-turbo"
+
+DOCUMENTS = ["Writing terraform modules", "Growing tomatoes", "An llm for code review"]
+
+
+def filter_request(document: str) -> LlmRequest:
+    messages = [
+        {"role": "system", "content": "Respond in json with the fields:\n- relevant: bool\n- reasoning: str"},
+        {"role": "user", "content": f"\nSEARCH DESCRIPTION:\nInfrastructure as code\n\nDOCUMENT CONTENT:\n{document}\n"},
+    ]
+    return LlmRequest(messages=messages, model=MODEL)
+
+
+def cached(cache: DbResponseCache, request: LlmRequest):
+    return cache.get_llm_response(json.dumps(request.messages), request.model)
+
+
+@pytest.fixture
+def local_backend(fake_openai: FakeOpenAIServer, tmp_path) -> LocalBatchBackend:
+    # no client retries, so injected server errors come back as failed requests straight away
+    client = OpenAI(base_url=fake_openai.base_url, max_retries=0)
+    return LocalBatchBackend(
+        str(tmp_path / "batches"), complete=lambda body: client.chat.completions.create(**body).model_dump())
+
+
+def test_run_batches_caches_valid_responses(fake_openai: FakeOpenAIServer, local_backend: LocalBatchBackend):
+    cache = DbResponseCache.from_env()
+    requests = [filter_request(document) for document in DOCUMENTS]
+    metrics: List[CallMetric] = []
+
+    stats = run_batches(
+        local_backend, cache, requests + requests[:1], 0, 60, record=lambda request, metric: metrics.append(metric))
+
+    assert stats["Batch requests"] == 3
+    assert stats["Batch responses cached"] == 3
+    assert fake_openai.stats.requests == 3
+    assert [json.loads(parse_response(cached(cache, r)))["relevant"] for r in requests] == [True, False, True]
+    assert len(metrics) == 3
+    for metric in metrics:
+        assert not metric.cache_hit
+        assert metric.prompt_tokens > 0
+        assert metric.cost == pytest.approx(
+            estimate_cost(MODEL, metric.prompt_tokens, metric.completion_tokens) * BATCH_PRICE_FACTOR)
+
+    # everything is cached now, so nothing is sent again
+    stats = run_batches(local_backend, cache, requests, 0, 60)
+    assert stats["Batch requests"] == 0
+    assert fake_openai.stats.requests == 3
+
+
+def test_run_batches_leaves_invalid_responses_uncached(fake_openai: FakeOpenAIServer, local_backend: LocalBatchBackend):
+    fake_openai.reset(FakeServerConfig(malformed_rate=1.0))
+    cache = DbResponseCache.from_env()
+    requests = [filter_request(document) for document in DOCUMENTS]
+    metrics: List[CallMetric] = []
+
+    stats = run_batches(local_backend, cache, requests, 0, 60, record=lambda request, metric: metrics.append(metric))
+
+    assert stats["Batch responses invalid"] == 3
+    assert stats["Batch responses cached"] == 0
+    assert all(cached(cache, r) is None for r in requests)
+    # the responses were paid for, so they're kept for repair and counted
+    assert all(len(cache.get_raw_responses(json.dumps(r.messages), MODEL)) == 1 for r in requests)
+    assert len(metrics) == 3
+
+
+def test_run_batches_counts_missing_responses_as_failed(fake_openai: FakeOpenAIServer, local_backend: LocalBatchBackend):
+    fake_openai.reset(FakeServerConfig(server_error_rate=0.5, seed=1))
+    cache = DbResponseCache.from_env()
+    requests = [filter_request(f"{document} {i}") for i in range(4) for document in DOCUMENTS]
+
+    stats = run_batches(local_backend, cache, requests, 0, 60)
+
+    assert fake_openai.stats.server_errors > 0
+    assert stats["Batch requests failed"] == fake_openai.stats.server_errors
+    assert stats["Batch responses cached"] == len(requests) - fake_openai.stats.server_errors
+    assert sum(cached(cache, r) is None for r in requests) == fake_openai.stats.server_errors
+
+
+def test_run_batches_through_openai_batch_api(fake_openai: FakeOpenAIServer):
+    fake_openai.reset(FakeServerConfig(batch_in_progress_polls=2))
+    cache = DbResponseCache.from_env()
+    requests = [filter_request(document) for document in DOCUMENTS]
+
+    stats = run_batches(OpenAIBatchBackend(OpenAI()), cache, requests, 0.01, 60)
+
+    assert stats["Batch responses cached"] == 3
+    assert all(cached(cache, r) is not None for r in requests)
+
+
+def test_run_batches_gives_up_after_timeout(fake_openai: FakeOpenAIServer):
+    fake_openai.reset(FakeServerConfig(batch_in_progress_polls=1000))
+    cache = DbResponseCache.from_env()
+    requests = [filter_request(document) for document in DOCUMENTS]
+
+    stats = run_batches(OpenAIBatchBackend(OpenAI()), cache, requests, 0.01, 0.1)
+
+    assert stats["Batch requests failed"] == 3
+    assert stats["Batch responses cached"] == 0
+    assert all(cached(cache, r) is None for r in requests)
+
+
+def test_run_batches_resumes_batches_left_by_an_earlier_run(fake_openai: FakeOpenAIServer):
+    fake_openai.reset(FakeServerConfig(batch_in_progress_polls=1000))
+    cache = DbResponseCache.from_env()
+    store = DbPendingBatchStore.from_env()
+    requests = [filter_request(document) for document in DOCUMENTS]
+
+    stats = run_batches(OpenAIBatchBackend(OpenAI()), cache, requests, 0.01, 0.1, store=store)
+    assert stats["Batch requests failed"] == 3
+    assert [len(batch.requests) for batch in store.get_batches()] == [3]
+
+    # the batch finishes by the time the next run polls it, which submits nothing new
+    fake_openai.reset(FakeServerConfig())
+    recorded: List[LlmRequest] = []
+    stats = run_batches(
+        OpenAIBatchBackend(OpenAI()), cache, requests, 0.01, 60, store=store,
+        record=lambda request, metric: recorded.append(request))
+
+    assert stats["Batch requests"] == 0
+    assert stats["Batch requests resumed"] == 3
+    assert stats["Batch responses cached"] == 3
+    assert len(fake_openai.batches) == 1
+    assert recorded == requests
+    assert all(cached(cache, r) is not None for r in requests)
+    assert store.get_batches() == []
+
+
+def test_resumed_responses_for_other_runs_are_kept_raw(fake_openai: FakeOpenAIServer):
+    fake_openai.reset(FakeServerConfig(batch_in_progress_polls=1000))
+    cache = DbResponseCache.from_env()
+    store = DbPendingBatchStore.from_env()
+    requests = [filter_request(document) for document in DOCUMENTS]
+    run_batches(OpenAIBatchBackend(OpenAI()), cache, requests, 0.01, 0.1, store=store)
+
+    fake_openai.reset(FakeServerConfig())
+    stats = run_batches(OpenAIBatchBackend(OpenAI()), cache, requests[:1], 0.01, 60, store=store)
+
+    assert stats["Batch responses cached"] == 1
+    assert stats["Batch responses kept for other runs"] == 2
+    assert cached(cache, requests[0]) is not None
+    # without the other runs' validators, their responses wait to be validated when asked for
+    for request in requests[1:]:
+        assert cached(cache, request) is None
+        assert len(cache.get_raw_responses(json.dumps(request.messages), MODEL)) == 1
@@ -0,0 +1,60 @@
+import os
+import time
+from typing import List, Optional
+
+import pytest
+
+from curate1.resources.hn_resource import HNClient, HNItemRecord
+from curate1.resources.hn_snapshot.capture import capture_snapshot
+from curate1.resources.hn_snapshot.hn_snapshot import HNSnapshot
+
+
+class FakeHNClient(HNClient):
+    """Serves items posted just now, failing once asked for an item past `fail_after`."""
+
+    posted_at: int
+    fail_after: Optional[int] = None
+    _fetched: List[int] = []
+
+    def fetch_item_by_id(self, item_id: int) -> Optional[HNItemRecord]:
+        if self.fail_after is not None and item_id > self.fail_after:
+            raise ConnectionError(f"Failed to fetch {item_id}")
+        self._fetched.append(item_id)
+        return {"id": item_id, "time": self.posted_at, "type": "story" if item_id % 3 == 0 else "comment"}
+
+    def fetch_max_item_id(self) -> int:
+        return 30
+
+    def min_item_id(self) -> int:
+        return 1
+
+
+def test_resumed_capture_fetches_only_unstaged_items(tmp_path, monkeypatch: pytest.MonkeyPatch):
+    out_path = str(tmp_path / "items.hnsnap")
+    now = int(time.time())
+
+    interrupted = FakeHNClient(posted_at=now, fail_after=20)
+    with pytest.raises(ConnectionError):
+        capture_snapshot(interrupted, out_path, 1, 30, batch_size=10)
+    assert not os.path.exists(out_path)
+
+    # resumed an hour later, when the staged items are still far from settled
+    monkeypatch.setattr(time, "time", lambda: now + 60 * 60)
+    resumed = FakeHNClient(posted_at=now)
+    count = capture_snapshot(resumed, out_path, 1, 30, batch_size=10)
+
+    assert resumed._fetched == list(range(21, 31))
+    assert count == 30
+    assert [item["id"] for item in HNSnapshot(out_path).items()] == list(range(1, 31))
+    assert not os.path.exists(out_path + ".partial")
+
+
+def test_stories_only_capture_keeps_stubs_of_other_items(tmp_path):
+    out_path = str(tmp_path / "items.hnsnap")
+    client = FakeHNClient(posted_at=1_700_000_000)
+
+    capture_snapshot(client, out_path, 1, 6, stories_only=True)
+
+    snapshot = HNSnapshot(out_path)
+    assert snapshot.get(3) == {"id": 3, "time": 1_700_000_000, "type": "story"}
+    assert snapshot.get(4) == {"id": 4, "time": 1_700_000_000, "type": "comment"}
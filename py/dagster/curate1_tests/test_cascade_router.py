@@ -0,0 +1,97 @@
+import random
+from typing import List, Tuple
+
+import pytest
+
+from curate1.resources.cascade_router.cascade_router import (
+    ACCEPT, AUDIT, ESCALATE, REJECT, Calibration, CascadeRouter, fit_calibration)
+from curate1.resources.database.database import (Database, Document,
+                                                 DocumentAttribute)
+
+SURE = {"relevant": True, "reasoning": "", "confidence": 0.99}
+
+
+@pytest.fixture
+def database(monkeypatch: pytest.MonkeyPatch, tmp_path) -> Database:
+    db_path = str(tmp_path / "curate1.db")
+    monkeypatch.setenv("SQLITE_DATABASE_PATH", db_path)
+    database = Database(db_path)
+    database.create_tables()
+    return database
+
+
+def test_a_sample_of_sure_verdicts_is_audited():
+    router = CascadeRouter(audit_rate=0.1)
+    documents = [f"Document {i}" for i in range(2000)]
+    verdicts = [SURE if i % 2 else {**SURE, "relevant": False} for i in range(2000)]
+
+    routes = [route for route, _ in router.route("iac", verdicts, documents, Calibration(rates=[None] * 10, samples=0))]
+
+    audited = [i for i, route in enumerate(routes) if route == AUDIT]
+    assert 0.08 < len(audited) / len(routes) < 0.12
+    assert {routes[i] for i in range(2000) if i not in audited} == {ACCEPT, REJECT}
+    # the same documents every time
+    assert [route for route, _ in router.route("iac", verdicts, documents, Calibration(rates=[None] * 10, samples=0))] == routes
+
+
+def test_uncertain_and_unconfident_verdicts_are_never_audited():
+    router = CascadeRouter(audit_rate=1.0)
+    verdicts = [
+        {"relevant": True, "reasoning": "", "confidence": 0.6},
+        {"relevant": True, "reasoning": ""},
+        {"relevant": False, "reasoning": ""},
+    ]
+
+    routes = router.route("iac", verdicts, ["a", "b", "c"], Calibration(rates=[None] * 10, samples=0))
+
+    assert [route for route, _ in routes] == [ESCALATE, ESCALATE, REJECT]
+
+
+def store_verdicts(database: Database, rounds: List[Tuple[str, str, bool]], start: int):
+    """Stores the cheap model's verdict on each (document, route, highly relevant) and, for
+    those escalated or audited, the expensive model's."""
+    ids = database.insert_documents([
+        Document(id=None, title="", content=document, source_url="https://example.com/", created_at=start + i)
+        for i, (document, _, _) in enumerate(rounds)
+    ])
+    attributes = []
+    for i, (document_id, (_, route, highly_relevant)) in enumerate(zip(ids, rounds)):
+        attributes.append(DocumentAttribute(
+            id=None, document_id=document_id, value=SURE, label="filter_spec_iac_maybe_relevant", created_at=start + i))
+        highly = {"relevant": highly_relevant, "reasoning": ""}
+        if route == ACCEPT:
+            highly["decided_by"] = "cascade"
+        attributes.append(DocumentAttribute(
+            id=None, document_id=document_id, value=highly, label="filter_spec_iac_highly_relevant", created_at=start + i))
+    database.insert_document_attributes(attributes)
+
+
+def test_an_accept_bin_with_poor_precision_is_corrected(database: Database):
+    # the cheap model is sure about every document, but only half are highly relevant
+    router = CascadeRouter(audit_rate=0.1)
+    rng = random.Random(0)
+    accepted_share = []
+    for batch in range(6):
+        documents = [f"Document {batch}-{i}" for i in range(100)]
+        calibration = router.calibration("iac")
+        routes = [route for route, _ in router.route("iac", [SURE] * len(documents), documents, calibration)]
+        accepted_share.append(routes.count(ACCEPT) / len(routes))
+        store_verdicts(database, [(d, route, rng.random() < 0.5) for d, route in zip(documents, routes)], batch * 100)
+
+    # accepted at first on the cheap model's word, until enough audits showed it wrong
+    assert accepted_share[0] > 0.8
+    assert accepted_share[-1] == 0
+    calibration = router.calibration("iac")
+    assert calibration.rates[-1] == pytest.approx(0.5, abs=0.2)
+    assert router.route("iac", [SURE], ["Another document"], calibration)[0][0] == ESCALATE
+
+
+def test_fit_calibration_smooths_bins_with_enough_samples():
+    history = [(0.99, i < 10) for i in range(20)] + [(0.5, True)] * 5
+
+    calibration = fit_calibration(history)
+
+    assert calibration.rates[9] == pytest.approx(11 / 22)
+    assert calibration.rates[5] is None
+    assert calibration.calibrate(0.55) == 0.55
+    assert calibration.samples == 25
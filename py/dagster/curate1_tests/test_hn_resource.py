@@ -0,0 +1,135 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+import pytest
+import requests
+
+from curate1.resources.hn_resource import HNAPIClient, _first_result
+
+
+class FakeResponse:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.payload
+
+
+class FakeSession:
+    """Answers item requests with `respond(item_id, attempt)`, counting the requests per item.
+    Raising from `respond` fails the request."""
+
+    def __init__(self, respond: Callable[[int, int], dict]):
+        self.respond = respond
+        self.attempts: Dict[int, int] = {}
+        self.lock = threading.Lock()
+
+    def get(self, url: str, timeout: float) -> FakeResponse:
+        item_id = int(url.rsplit("/", 1)[1].removesuffix(".json"))
+        with self.lock:
+            attempt = self.attempts[item_id] = self.attempts.get(item_id, 0) + 1
+        return FakeResponse(self.respond(item_id, attempt))
+
+    def close(self):
+        pass
+
+
+def api_client(session: FakeSession, **config) -> HNAPIClient:
+    client = HNAPIClient(**config)
+    client._session = session  # type: ignore
+    return client
+
+
+def test_fetch_items_by_ids_keeps_order():
+    session = FakeSession(lambda item_id, attempt: {"id": item_id})
+    item_ids = list(range(100, 0, -1))
+
+    items = api_client(session, max_concurrency=8).fetch_items_by_ids(item_ids)
+
+    assert [item["id"] for item in items] == item_ids
+    assert all(attempts == 1 for attempts in session.attempts.values())
+
+
+def test_fetch_items_by_ids_retries_failed_requests():
+    def respond(item_id: int, attempt: int) -> dict:
+        if item_id % 2 == 0 and attempt == 1:
+            raise requests.ConnectionError("connection reset")
+        return {"id": item_id}
+
+    session = FakeSession(respond)
+
+    items = api_client(session).fetch_items_by_ids(list(range(1, 11)))
+
+    assert [item["id"] for item in items] == list(range(1, 11))
+    assert session.attempts == {item_id: 2 if item_id % 2 == 0 else 1 for item_id in range(1, 11)}
+
+
+def test_fetch_items_by_ids_gives_up_after_max_attempts():
+    def respond(item_id: int, attempt: int) -> dict:
+        raise requests.ConnectionError("connection refused")
+
+    session = FakeSession(respond)
+
+    with pytest.raises(requests.ConnectionError):
+        api_client(session, max_attempts=2).fetch_items_by_ids([1])
+    assert session.attempts == {1: 2}
+
+
+def test_fetch_items_by_ids_hedges_slow_requests():
+    def respond(item_id: int, attempt: int) -> dict:
+        if attempt == 1:
+            time.sleep(2)
+        return {"id": item_id, "attempt": attempt}
+
+    session = FakeSession(respond)
+
+    start = time.monotonic()
+    items = api_client(session, hedge_after_seconds=0.05).fetch_items_by_ids([1, 2, 3])
+
+    assert time.monotonic() - start < 1
+    assert items == [{"id": item_id, "attempt": 2} for item_id in [1, 2, 3]]
+
+
+def test_first_result_skips_the_hedge_when_the_first_call_is_quick():
+    calls: List[int] = []
+
+    def fn(arg: int) -> int:
+        calls.append(arg)
+        return arg * 2
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert _first_result(executor, fn, 21, 1.0) == 42
+    assert calls == [21]
+
+
+def test_first_result_takes_the_hedge_when_the_first_call_fails():
+    attempts: List[int] = []
+    lock = threading.Lock()
+
+    def fn(arg: int) -> int:
+        with lock:
+            attempts.append(arg)
+            attempt = len(attempts)
+        if attempt == 1:
+            time.sleep(0.1)
+            raise requests.ConnectionError("connection reset")
+        return arg
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert _first_result(executor, fn, 7, 0.01) == 7
+    assert len(attempts) == 2
+
+
+def test_first_result_raises_when_both_calls_fail():
+    def fn(arg: int) -> int:
+        time.sleep(0.05)
+        raise requests.ConnectionError(f"no {arg}")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with pytest.raises(requests.ConnectionError):
+            _first_result(executor, fn, 7, 0.01)
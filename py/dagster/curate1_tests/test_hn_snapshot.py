@@ -0,0 +1,95 @@
+import gzip
+import json
+import os
+import random
+
+import pytest
+
+from curate1.resources.hn_snapshot.hn_snapshot import (BLOCK_SIZE, HNSnapshot,
+                                                       SnapshotWriter,
+                                                       convert_json_snapshot,
+                                                       write_snapshot)
+
+
+def make_items(count: int):
+    # ids with gaps, so lookups of ids between items are misses
+    return [
+        {"id": 3 * i + 1, "time": 1_700_000_000 + i, "type": "story", "title": f"Item {i}", "kids": list(range(i % 4))}
+        for i in range(count)
+    ]
+
+
+ITEMS = make_items(3 * BLOCK_SIZE + 5)
+
+
+def test_snapshot_round_trips_items_added_in_batches(tmp_path):
+    path = str(tmp_path / "items.hnsnap")
+    with SnapshotWriter(path) as writer:
+        for start in range(0, len(ITEMS), 50):
+            writer.add(ITEMS[start:start + 50])
+
+    snapshot = HNSnapshot(path)
+
+    assert len(snapshot) == writer.count == len(ITEMS)
+    assert list(snapshot.items()) == ITEMS
+    assert (snapshot.min_id(), snapshot.max_id()) == (ITEMS[0]["id"], ITEMS[-1]["id"])
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_snapshot_reads_any_item_across_block_boundaries(tmp_path):
+    path = str(tmp_path / "items.hnsnap")
+    write_snapshot(path, ITEMS)
+    snapshot = HNSnapshot(path)
+
+    boundaries = [0, BLOCK_SIZE - 1, BLOCK_SIZE, 2 * BLOCK_SIZE - 1, 2 * BLOCK_SIZE, 3 * BLOCK_SIZE, len(ITEMS) - 1]
+    indices = boundaries + random.Random(0).sample(range(len(ITEMS)), 100)
+    # jump back and forth between blocks, so the cached block keeps changing
+    for index in indices + indices[::-1]:
+        item = ITEMS[index]
+        assert snapshot.get(item["id"]) == item
+        assert snapshot.time_of(item["id"]) == item["time"]
+
+    for missing_id in [0, 2, 3 * BLOCK_SIZE, ITEMS[-1]["id"] + 1]:
+        assert snapshot.get(missing_id) is None
+        assert snapshot.time_of(missing_id) is None
+
+
+def test_write_snapshot_sorts_items(tmp_path):
+    path = str(tmp_path / "items.hnsnap")
+    shuffled = list(ITEMS)
+    random.Random(1).shuffle(shuffled)
+
+    assert write_snapshot(path, shuffled) == len(ITEMS)
+    assert list(HNSnapshot(path).items()) == ITEMS
+
+
+def test_empty_snapshot(tmp_path):
+    path = str(tmp_path / "items.hnsnap")
+    write_snapshot(path, [])
+
+    snapshot = HNSnapshot(path)
+
+    assert len(snapshot) == 0
+    assert snapshot.get(1) is None
+    assert list(snapshot.items()) == []
+
+
+def test_writer_rejects_items_out_of_order_and_leaves_no_snapshot(tmp_path):
+    path = str(tmp_path / "items.hnsnap")
+
+    with pytest.raises(ValueError):
+        with SnapshotWriter(path) as writer:
+            writer.add(ITEMS[:10])
+            writer.add(ITEMS[5:6])
+
+    assert not os.path.exists(path)
+
+
+def test_convert_json_snapshot(tmp_path):
+    json_path = str(tmp_path / "items.json.gzip")
+    with gzip.open(json_path, "w") as f:
+        f.write(json.dumps({str(item["id"]): item for item in ITEMS}).encode())
+    path = str(tmp_path / "items.hnsnap")
+
+    assert convert_json_snapshot(json_path, path) == len(ITEMS)
+    assert list(HNSnapshot(path).items()) == ITEMS
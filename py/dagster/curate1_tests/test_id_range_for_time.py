@@ -0,0 +1,130 @@
+import bisect
+import math
+from typing import Dict, List, Optional, Tuple
+
+import pytest
+
+from curate1.assets.id_range_for_time import (
+    _id_range_for_time, interpolation_search_first_at_or_after)
+
+
+def synthetic_times() -> List[int]:
+    """Item times for ids 1 to 2000: ten seconds apart, with runs of items posted in the same
+    second, and a quiet hour halfway through."""
+    times = []
+    t = 1_700_000_000
+    for item_id in range(1, 2001):
+        if not 300 <= item_id < 320 and not 1500 <= item_id < 1504:
+            t += 10
+        if item_id == 1000:
+            t += 60 * 60
+        times.append(t)
+    return times
+
+
+class FakeTimeClient:
+    """Serves item times from a list, optionally seeded with time->id checkpoints, counting
+    the items fetched."""
+
+    def __init__(self, times: List[int], checkpoints: Optional[Dict[int, int]] = None):
+        self.times = times
+        self.checkpoints = dict(checkpoints or {})
+        self.fetches = 0
+
+    def fetch_item_by_id(self, item_id: int):
+        self.fetches += 1
+        if not 1 <= item_id <= len(self.times):
+            return None
+        return {"id": item_id, "time": self.times[item_id - 1]}
+
+    def fetch_max_item_id(self) -> int:
+        return len(self.times)
+
+    def min_item_id(self) -> int:
+        return 1
+
+    def time_bracket(self, timestamp: int) -> Tuple[Optional[Tuple[int, int]], Optional[Tuple[int, int]]]:
+        lows = [(i, t) for i, t in self.checkpoints.items() if t < timestamp]
+        highs = [(i, t) for i, t in self.checkpoints.items() if t >= timestamp]
+        return max(lows, default=None), min(highs, default=None)
+
+    def record_time_checkpoints(self, checkpoints):
+        self.checkpoints.update(checkpoints)
+
+
+def first_id_at_or_after(times: List[int], target: int) -> int:
+    return bisect.bisect_left(times, target) + 1
+
+
+TIMES = synthetic_times()
+
+TARGETS = sorted({
+    TIMES[0] - 100, TIMES[0], TIMES[1] - 5,
+    # inside and around the run of equal times
+    TIMES[298], TIMES[299], TIMES[299] + 1, TIMES[319],
+    # on either side of the quiet hour
+    TIMES[998], TIMES[998] + 1, TIMES[999] - 1, TIMES[999],
+    TIMES[1499], TIMES[-1],
+})
+
+
+@pytest.mark.parametrize("target", TARGETS)
+def test_interpolation_search_finds_the_first_id_at_or_after_target(target: int):
+    def get_value(item_id: int) -> int:
+        return TIMES[item_id - 1]
+
+    low, high = interpolation_search_first_at_or_after(get_value, (0, None), (len(TIMES) + 1, None), target)
+
+    assert high[0] - low[0] == 1
+    assert high[0] == first_id_at_or_after(TIMES, target)
+
+
+def test_interpolation_search_falls_back_to_bisecting():
+    # almost every item is in the first second, so interpolating between the bounds' times
+    # keeps probing next to the high bound
+    times = [0] * 9999 + [1_000_000]
+    probes: List[int] = []
+
+    def get_value(item_id: int) -> int:
+        probes.append(item_id)
+        return times[item_id - 1]
+
+    _, high = interpolation_search_first_at_or_after(get_value, (1, 0), (len(times), times[-1]), 1)
+
+    assert high[0] == len(times)
+    assert len(probes) <= 2 * math.ceil(math.log2(len(times)))
+
+
+@pytest.mark.parametrize("start, end", [
+    (TIMES[0], TIMES[99]),
+    # a window inside the run of equal times, and one ending on it
+    (TIMES[299], TIMES[299]),
+    (TIMES[250], TIMES[299]),
+    # a window inside the quiet hour holds no items
+    (TIMES[998] + 1, TIMES[999] - 1),
+    (TIMES[900], TIMES[1100]),
+])
+def test_id_range_for_time_includes_items_at_both_ends(start: int, end: int):
+    client = FakeTimeClient(TIMES)
+
+    (start_id, end_id), metadata = _id_range_for_time(start, end, client)
+
+    in_window = [i for i, t in enumerate(TIMES, start=1) if start <= t <= end]
+    if in_window:
+        assert (start_id, end_id) == (in_window[0], in_window[-1])
+    else:
+        assert end_id == start_id - 1
+    # items timed exactly at `end` are in the range, and the next one isn't
+    assert TIMES[end_id - 1] <= end < TIMES[end_id]
+    assert metadata["search_fetches"] == client.fetches
+
+
+def test_id_range_for_time_starts_from_checkpoints():
+    start, end = TIMES[1200], TIMES[1299]
+    unseeded = FakeTimeClient(TIMES)
+    seeded = FakeTimeClient(TIMES, {1190: TIMES[1189], 1210: TIMES[1209], 1290: TIMES[1289], 1310: TIMES[1309]})
+
+    assert _id_range_for_time(start, end, seeded)[0] == _id_range_for_time(start, end, unseeded)[0] == (1201, 1300)
+    assert seeded.fetches < unseeded.fetches
+    # the bounds found are recorded for the next search
+    assert seeded.checkpoints[1201] == TIMES[1200] and seeded.checkpoints[1301] == TIMES[1300]
@@ -0,0 +1,55 @@
+import random
+import re
+
+import pytest
+
+from curate1.assets.keyword_matcher import KeywordMatcher
+
+SPEC_KEYWORDS = {
+    "iac": ["infrastructure as code", "terraform"],
+    "code": ["code", "code review"],
+    "ml": ["machine", "machine learning", "ml"],
+    "go": ["go", "golang"],
+}
+
+
+@pytest.mark.parametrize("text, keywords", [
+    # overlapping keywords are all found
+    ("Infrastructure as code at scale", {"infrastructure as code", "code"}),
+    ("Code review for terraform", {"code", "code review", "terraform"}),
+    # a keyword stands for the shorter keywords it starts with, but only at a word boundary
+    ("Machine learning in Go", {"machine", "machine learning", "go"}),
+    ("Machine learnings", {"machine"}),
+    ("Golang generics", {"golang"}),
+    ("Machinery and codes", set()),
+    # keywords inside longer words don't match
+    ("Google ships HTML tooling", set()),
+    ("mlops, go-to-market, (code)", {"go", "code"}),
+    ("", set()),
+])
+def test_match(text, keywords):
+    assert KeywordMatcher(SPEC_KEYWORDS).match(text) == keywords
+
+
+def test_specs_for_matched_keywords():
+    matcher = KeywordMatcher(SPEC_KEYWORDS)
+
+    assert matcher.specs_for(matcher.match("Code review")) == {"code"}
+    assert matcher.specs_for(matcher.match("infrastructure as code")) == {"iac", "code"}
+    assert matcher.specs_for(set()) == set()
+
+
+def test_matches_as_a_regex_per_keyword_would():
+    rng = random.Random(0)
+    words = ["go", "golang", "gopher", "code", "codes", "review", "machine", "learning", "ml",
+             "infrastructure", "as", "terraform", "-", ",", "Go", "CODE", "_go", "go_"]
+    keywords = [keyword for spec in SPEC_KEYWORDS.values() for keyword in spec]
+    matcher = KeywordMatcher(SPEC_KEYWORDS)
+
+    for _ in range(500):
+        text = " ".join(rng.choice(words) for _ in range(rng.randint(1, 8)))
+        expected = {
+            keyword for keyword in keywords
+            if re.search(r"\b" + re.escape(keyword) + r"\b", text, re.IGNORECASE)
+        }
+        assert matcher.match(text) == expected, text
@@ -0,0 +1,105 @@
+import asyncio
+from typing import List
+
+import pytest
+
+from curate1.resources.agent import llm_executor
+from curate1.resources.agent.llm_executor import TokenBucket
+
+
+class FakeClock:
+    """Stands in for the monotonic clock, moving on only when a bucket sleeps."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps: List[float] = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep(self, delay: float):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(llm_executor.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(llm_executor.asyncio, "sleep", clock.sleep)
+    return clock
+
+
+def admission_times(clock: FakeClock, bucket: TokenBucket, amounts: List[int]) -> List[float]:
+    async def acquire_all() -> List[float]:
+        times = []
+        for amount in amounts:
+            await bucket.acquire(amount)
+            times.append(clock.now)
+        return times
+    return asyncio.run(acquire_all())
+
+
+def most_in_a_minute(times: List[float], amounts: List[int]) -> int:
+    return max(
+        sum(amount for t, amount in zip(times, amounts) if start <= t < start + 60)
+        for start in times
+    )
+
+
+def test_requests_are_admitted_at_the_requests_per_minute(clock: FakeClock):
+    bucket = TokenBucket(120)
+    amounts = [1] * 360
+
+    times = admission_times(clock, bucket, amounts)
+
+    # a minute's worth at once, then one every half second
+    assert times[:120] == [0.0] * 120
+    assert times[120:] == pytest.approx([0.5 * i for i in range(1, 241)])
+    # no more than two minutes' worth in any minute, counting the initial burst
+    assert most_in_a_minute(times, amounts) <= 2 * 120
+    assert most_in_a_minute(times[120:], amounts[120:]) <= 120
+
+
+def test_tokens_are_admitted_at_the_tokens_per_minute(clock: FakeClock):
+    bucket = TokenBucket(30000)
+    amounts = [10000] * 9
+
+    times = admission_times(clock, bucket, amounts)
+
+    assert times[:3] == [0.0] * 3
+    assert times[3:] == pytest.approx([20.0 * i for i in range(1, 7)])
+    assert most_in_a_minute(times[3:], amounts[3:]) <= 30000
+
+
+def test_usage_over_the_estimate_delays_later_requests(clock: FakeClock):
+    bucket = TokenBucket(30000)
+    admission_times(clock, bucket, [10000] * 3)
+
+    # the three requests used twice the tokens they were estimated to
+    for _ in range(3):
+        bucket.adjust(10000)
+
+    assert admission_times(clock, bucket, [10000]) == pytest.approx([80.0])
+
+
+def test_usage_under_the_estimate_is_given_back(clock: FakeClock):
+    bucket = TokenBucket(30000)
+    admission_times(clock, bucket, [10000] * 3)
+    bucket.adjust(-10000)
+
+    assert admission_times(clock, bucket, [10000]) == [0.0]
+
+
+def test_requests_larger_than_a_minutes_worth_still_run(clock: FakeClock):
+    bucket = TokenBucket(1000)
+
+    assert admission_times(clock, bucket, [5000, 5000]) == pytest.approx([0.0, 60.0])
+
+
+def test_lowered_limits_apply_to_waiting_requests(clock: FakeClock):
+    bucket = TokenBucket(60)
+    admission_times(clock, bucket, [1] * 60)
+    bucket.per_minute = 30
+
+    assert admission_times(clock, bucket, [1] * 3) == pytest.approx([2.0, 4.0, 6.0])
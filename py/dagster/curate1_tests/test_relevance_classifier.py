@@ -0,0 +1,92 @@
+import random
+
+import pytest
+
+from curate1.resources.agent.filter_spec import Relevance
+from curate1.resources.database.database import (Database, Document,
+                                                 DocumentAttribute)
+from curate1.resources.relevance_classifier.relevance_classifier import (
+    HOLDOUT_EVERY, choose_thresholds, fit_and_evaluate, load_examples,
+    split_examples, train_classifier)
+
+WORDS = ["terraform", "pulumi", "ansible", "modules", "state", "drift", "cloud", "review",
+         "rust", "python", "garden", "recipes", "football", "music", "travel", "finance"]
+
+
+def examples(size: int, seed: int = 0, noise: float = 0.0):
+    """Documents with a few random words and a unique token each, relevant if they mention
+    terraform, with a `noise` share of labels flipped."""
+    rng = random.Random(seed)
+    result = []
+    for i in range(size):
+        text = " ".join(rng.choice(WORDS) for _ in range(6)) + f" doc{seed}x{i}"
+        relevant = "terraform" in text
+        result.append((text, relevant != (rng.random() < noise)))
+    return result
+
+
+def test_split_is_the_same_on_every_run_and_in_any_order():
+    all_examples = examples(500)
+    train, test = split_examples(all_examples)
+
+    shuffled_train, shuffled_test = split_examples(random.Random(1).sample(all_examples, len(all_examples)))
+    assert sorted(shuffled_train) == sorted(train)
+    assert sorted(shuffled_test) == sorted(test)
+    # examples stay on their side as more arrive
+    more_train, more_test = split_examples(all_examples + examples(100, seed=2))
+    assert set(test) <= set(more_test) and set(train) <= set(more_train)
+    assert 0.5 / HOLDOUT_EVERY < len(test) / len(all_examples) < 1.5 / HOLDOUT_EVERY
+
+
+def test_choose_thresholds():
+    probabilities = [0.95, 0.9, 0.8, 0.7, 0.4, 0.3, 0.2, 0.1]
+    labels = [True, True, False, True, True, False, False, False]
+
+    assert choose_thresholds(probabilities, labels, 1.0, 1.0) == (0.9, 0.3)
+    # the thresholds would cross, so nothing is decided not relevant
+    assert choose_thresholds(probabilities, labels, 0.75, 0.75) == (0.4, 0.0)
+    # no threshold meets the precision, so nothing is decided relevant
+    assert choose_thresholds(probabilities, [False] + labels[1:], 1.0, 1.0)[0] == 1.0
+
+
+def test_thresholds_are_tuned_on_out_of_fold_predictions():
+    # labels are a coin flip, which a model can memorize but never learn
+    noise = [(text, random.Random(text).random() < 0.5) for text, _ in examples(400)]
+
+    in_sample = train_classifier(noise, "iac", Relevance.MAYBE_RELEVANT)
+    in_sample_thresholds = choose_thresholds(
+        in_sample.predict([text for text, _ in noise]), [relevant for _, relevant in noise], 0.95, 0.98)
+    classifier = fit_and_evaluate(noise, "iac", Relevance.MAYBE_RELEVANT, 0.95, 0.98)
+
+    # fitted to its own examples, the model looks confident enough to decide by itself
+    assert in_sample_thresholds[0] < 1.0
+    # but held out from them, it isn't
+    assert classifier.positive_threshold == 1.0
+    assert classifier.report.auto_relevant <= 1
+
+
+def test_classifier_decides_what_it_has_learned():
+    classifier = fit_and_evaluate(examples(600, noise=0.01), "iac", Relevance.MAYBE_RELEVANT, 0.95, 0.98)
+
+    assert classifier.positive_threshold < 1.0
+    assert classifier.report.auto_relevant_precision >= 0.9
+    assert classifier.report.recall >= 0.9
+
+
+def test_examples_decided_without_the_llm_are_left_out(tmp_path):
+    database = Database(str(tmp_path / "curate1.db"))
+    database.create_tables()
+    ids = database.insert_documents([
+        Document(id=None, title="", content=content, source_url="https://example.com/", created_at=0)
+        for content in ["by the llm", "by a classifier", "by the cascade"]
+    ])
+    database.insert_document_attributes([
+        DocumentAttribute(id=None, document_id=document_id, value=value, label="filter_spec_iac_maybe_relevant", created_at=0)
+        for document_id, value in zip(ids, [
+            {"relevant": True},
+            {"relevant": True, "decided_by": "classifier"},
+            {"relevant": False, "decided_by": "cascade"},
+        ])
+    ])
+
+    assert load_examples(database, "iac", Relevance.MAYBE_RELEVANT) == [("by the llm", True)]
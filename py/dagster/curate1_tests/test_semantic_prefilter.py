@@ -0,0 +1,119 @@
+import json
+import random
+
+import pytest
+
+from curate1.resources.database.database import (Database, Document,
+                                                 DocumentAttribute)
+from curate1.resources.semantic_prefilter.semantic_prefilter import (
+    MIN_REFERENCE_DOCUMENTS, IdfTable, SemanticPrefilter, similarity_scores,
+    threshold_for_recall)
+
+TOPICS = ["terraform modules", "kubernetes operators", "rust compilers", "python packaging",
+          "llm coding agents", "database indexes", "infrastructure as code"]
+
+
+def corpus(size: int, seed: int = 0):
+    rng = random.Random(seed)
+    return [f"Notes on {rng.choice(TOPICS)} and {rng.choice(TOPICS)}, part {i}" for i in range(size)]
+
+
+@pytest.mark.parametrize("scores, recall, threshold", [
+    ([0.9, 0.1, 0.5, 0.3], 0.5, 0.5),
+    ([0.9, 0.1, 0.5, 0.3], 0.75, 0.3),
+    ([0.9, 0.1, 0.5, 0.3], 1.0, 0.1),
+    ([0.9, 0.1, 0.5, 0.3], 0.0, 0.9),
+    # a recall between ranks rounds down the threshold, so at least that much is kept
+    ([0.9, 0.1, 0.5, 0.3], 0.6, 0.3),
+    ([0.4], 0.95, 0.4),
+    ([], 0.95, None),
+])
+def test_threshold_for_recall(scores, recall, threshold):
+    assert threshold_for_recall(scores, recall) == threshold
+
+
+def test_threshold_for_recall_keeps_the_target_share():
+    rng = random.Random(1)
+    scores = [rng.random() for _ in range(101)]
+    for recall in [0.5, 0.9, 0.95, 0.99]:
+        threshold = threshold_for_recall(scores, recall)
+        assert sum(s >= threshold for s in scores) >= recall * len(scores)
+        assert sum(s > threshold for s in scores) < recall * len(scores)
+
+
+def test_idf_table_doesnt_depend_on_document_order():
+    documents = corpus(300)
+    shuffled = random.Random(2).sample(documents, len(documents))
+
+    assert IdfTable.fit(documents) == IdfTable.fit(shuffled)
+
+
+def test_idf_table_is_fitted_once_and_kept(tmp_path):
+    db_path = str(tmp_path / "curate1.db")
+    database = Database(db_path)
+    database.create_tables()
+    database.insert_documents([
+        Document(id=None, title=f"Story {i}", content=text, source_url=f"https://example.com/{i}", created_at=i)
+        for i, text in enumerate(corpus(MIN_REFERENCE_DOCUMENTS))
+    ])
+
+    prefilter = SemanticPrefilter(db_path=db_path)
+    table = prefilter.idf_table(["scored now"])
+    scores = prefilter.score("iac", corpus(20, seed=3))
+
+    # more documents arrive, but a new resource reads the kept table rather than refitting it
+    database.insert_documents([
+        Document(id=None, title="Later", content="something else entirely", source_url="https://example.com/", created_at=10_000)
+    ] * 50)
+    reloaded = SemanticPrefilter(db_path=db_path)
+    assert (tmp_path / "prefilter_idf.json").exists()
+    assert reloaded.idf_table(["scored later"]) == table
+    assert reloaded.score("iac", corpus(20, seed=3)) == scores
+    prefilter.close()
+    reloaded.close()
+
+
+def test_too_few_documents_fit_a_table_per_call(tmp_path):
+    prefilter = SemanticPrefilter(db_path=str(tmp_path / "curate1.db"))
+    documents = corpus(10)
+
+    assert prefilter.idf_table(documents) == IdfTable.fit(documents)
+    assert not (tmp_path / "prefilter_idf.json").exists()
+    prefilter.close()
+
+
+def test_scores_dont_depend_on_what_else_is_scored():
+    table = IdfTable.fit(corpus(300))
+    documents = corpus(10, seed=4)
+
+    together = similarity_scores("terraform modules", documents, table)
+    apart = [similarity_scores("terraform modules", [document], table)[0] for document in documents]
+    assert together == apart
+
+
+def test_historical_recall_uses_one_database_and_only_audited_documents(tmp_path):
+    db_path = str(tmp_path / "curate1.db")
+    database = Database(db_path)
+    database.create_tables()
+    documents = corpus(400, seed=5)
+    ids = database.insert_documents([
+        Document(id=None, title="", content=text, source_url="https://example.com/", created_at=i)
+        for i, text in enumerate(documents)
+    ])
+    database.insert_document_attributes([
+        DocumentAttribute(id=None, document_id=document_id, value={"relevant": "terraform" in text},
+                          label="filter_spec_iac_maybe_relevant", created_at=i)
+        for i, (document_id, text) in enumerate(zip(ids, documents))
+    ])
+
+    prefilter = SemanticPrefilter(db_path=db_path, audit_rate=0.2, idf_path=str(tmp_path / "idf.json"))
+    report = prefilter.historical_recall("iac", "filter_spec_iac_maybe_relevant")
+    connection = prefilter._database
+    assert prefilter.historical_recall("iac", "filter_spec_iac_maybe_relevant") == report
+    assert prefilter._database is connection
+
+    audited = [text for text in documents if prefilter.is_audited(f"\n{text}")]
+    assert report.samples == len(audited)
+    assert report.relevant == sum("terraform" in text for text in audited)
+    prefilter.close()
+    assert prefilter._database is None
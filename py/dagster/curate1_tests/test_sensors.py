@@ -0,0 +1,106 @@
+import time
+from typing import List, Optional, Sequence
+
+import pytest
+from dagster import build_sensor_context
+
+from curate1.resources.hn_resource import CachingHNClient, HNClient, HNItemRecord
+from curate1.sensors import MAX_TAIL_GAP_SECONDS, hn_tail_sensor
+
+START = 1_700_000_000
+
+
+class Clock:
+    def __init__(self):
+        self.now = float(START)
+
+    def time(self) -> float:
+        return self.now
+
+
+class Feed:
+    def __init__(self):
+        self.max_id = 100
+        self.updated: List[int] = []
+        self.fetched: List[int] = []
+
+
+# the sensor is given copies of its resources, so the feed they serve is kept outside them
+FEED = Feed()
+
+
+class FakeFeedClient(HNClient):
+    """Serves the items of `FEED`, all posted at `START`."""
+
+    def fetch_item_by_id(self, item_id: int) -> Optional[HNItemRecord]:
+        FEED.fetched.append(item_id)
+        return {"id": item_id, "time": START, "type": "story"}
+
+    def fetch_items_by_ids(self, item_ids: Sequence[int]) -> List[Optional[HNItemRecord]]:
+        return [self.fetch_item_by_id(item_id) for item_id in item_ids]
+
+    def fetch_max_item_id(self) -> int:
+        return FEED.max_id
+
+    def fetch_updated_item_ids(self) -> List[int]:
+        return FEED.updated
+
+    def min_item_id(self) -> int:
+        return 1
+
+
+@pytest.fixture
+def feed() -> Feed:
+    FEED.__init__()
+    return FEED
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(time, "time", clock.time)
+    return clock
+
+
+def tick(client: HNClient, cursor: Optional[str]) -> Optional[str]:
+    with build_sensor_context(cursor=cursor, resources={"hn_client": client}) as context:
+        hn_tail_sensor(context)
+        return context.cursor
+
+
+def test_tailed_items_are_served_from_the_store(tmp_path, feed: Feed, clock: Clock):
+    client = CachingHNClient(inner=FakeFeedClient(), store_path=str(tmp_path / "items.db"), max_item_ttl_seconds=0)
+
+    cursor = tick(client, None)
+    feed.max_id = 150
+    cursor = tick(client, cursor)
+    assert feed.fetched == list(range(101, 151))
+
+    # ticks keep going long past the store's refresh time, with one item changing
+    feed.updated = [120]
+    for _ in range(6):
+        clock.now += 4 * 60
+        cursor = tick(client, cursor)
+
+    feed.fetched = []
+    items = client.fetch_items_by_ids(range(101, 151))
+    assert [item["id"] for item in items if item is not None] == list(range(101, 151))
+    assert feed.fetched == []
+
+
+def test_items_tailed_before_a_gap_are_refreshed(tmp_path, feed: Feed, clock: Clock):
+    client = CachingHNClient(inner=FakeFeedClient(), store_path=str(tmp_path / "items.db"), max_item_ttl_seconds=0)
+
+    cursor = tick(client, None)
+    feed.max_id = 150
+    cursor = tick(client, cursor)
+
+    # the sensor was paused long enough to miss changes, then tails a few more items
+    clock.now += MAX_TAIL_GAP_SECONDS + 60
+    feed.max_id = 160
+    cursor = tick(client, cursor)
+    clock.now += client.refresh_after_seconds - 60
+
+    feed.fetched = []
+    client.fetch_items_by_ids(range(101, 161))
+    assert feed.fetched == list(range(101, 151))